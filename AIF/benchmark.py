@@ -0,0 +1,309 @@
+import os
+import sys
+import json
+import logging
+import argparse
+import subprocess
+from datetime import date, datetime
+import numpy as np
+import pandas as pd
+from config import config, engine
+from database import execute_query
+from main import process_files
+from metrics import start_run, finish_run
+from profiling import configure as configure_profiling
+
+logger = logging.getLogger()
+
+SCALES = {'100k': 100_000, '1m': 1_000_000, '10m': 10_000_000, '100m': 100_000_000}
+# Строк в одном сгенерированном чанке: 100M строк не помещаются в память целиком.
+GENERATE_CHUNK_ROWS = 1_000_000
+# Выгрузка Mindbox режет события на несколько файлов.
+EVENTS_FILE_ROWS = 5_000_000
+DATE_FORMAT = '%d.%m.%Y %H:%M'
+ORDERS_PER_CUSTOMER = 4
+# Клиентов с событиями в несколько раз больше, чем покупателей.
+EVENT_CUSTOMERS_FACTOR = 3
+# Форма распределения Парето для весов клиентов: меньше — сильнее перекос
+# в сторону постоянных покупателей.
+PARETO_SHAPE = 2.0
+STATUSES = ('Paid', 'Cancelled', 'Returned', 'Created')
+STATUS_WEIGHTS = (0.8, 0.1, 0.05, 0.05)
+CUSTOMER_ID_BASE = 1_000_000
+ORDER_ID_BASE = 10_000_000
+ACTION_ID_BASE = 500_000_000
+EVENT_ID_BASE = 2_000_000_000
+REPORT_FIELDS = ('wall_seconds', 'cpu_seconds', 'rows_in', 'rows_out', 'rows_per_sec',
+                 'rss_peak_mb', 'status')
+# Этапы короче этого не сравниваются с базовым отчётом: шум больше разницы.
+MIN_COMPARE_SECONDS = 1.0
+
+def parse_rows(value):
+    """Переводит '100k', '1m' или число в число строк."""
+    label = value.lower()
+    if label in SCALES:
+        return SCALES[label]
+    multiplier = {'k': 1_000, 'm': 1_000_000}.get(label[-1])
+    return int(float(label[:-1]) * multiplier) if multiplier else int(label)
+
+def _customers(rng, count, days):
+    """Возвращает CDF весов клиентов и минуту привлечения каждого.
+
+    Веса — распределение Парето, поэтому частоты покупок по клиентам
+    имеют тяжёлый хвост, как у реальных доноров. База растёт к концу периода.
+    """
+    weights = rng.pareto(PARETO_SHAPE, count) + 1
+    cdf = np.cumsum(weights)
+    cdf /= cdf[-1]
+    acquired = (rng.random(count) ** 0.7 * days * 1440).astype(np.int64)
+    return cdf, acquired
+
+def _draw(rng, cdf, acquired, size, span_minutes):
+    """Выбирает клиентов по весам и время действия после их привлечения."""
+    customers = np.minimum(np.searchsorted(cdf, rng.random(size)), len(cdf) - 1)
+    start = acquired[customers]
+    minutes = start + (rng.random(size) * (span_minutes - start)).astype(np.int64)
+    return customers, minutes
+
+def _format_dates(start, minutes):
+    return (pd.Timestamp(start) + pd.to_timedelta(minutes, unit='m')).strftime(DATE_FORMAT)
+
+def _write_chunk(df, path, header):
+    with open(path, 'a' if not header else 'w', encoding='utf-8', newline='') as f:
+        df.to_csv(f, sep=';', index=False, header=header, float_format='%.2f')
+
+def generate_dataset(out_dir, rows, events_per_order=2, months=24, end=None, seed=42):
+    """Генерирует orders.csv и events_NNN.csv в формате выгрузки Mindbox.
+
+    rows — строк в orders, событий — rows * events_per_order. Данные
+    пишутся чанками по GENERATE_CHUNK_ROWS. Если в out_dir уже лежит набор
+    с теми же параметрами (dataset.json), он используется повторно.
+    """
+    end = end or date.today().replace(day=1)
+    params = {
+        'rows': rows, 'events_per_order': events_per_order, 'months': months,
+        'end': end.isoformat(), 'seed': seed,
+    }
+    manifest_path = os.path.join(out_dir, 'dataset.json')
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            if json.load(f) == params:
+                logger.info(f"Набор данных в {out_dir} уже сгенерирован, используем его.")
+                return out_dir
+    os.makedirs(out_dir, exist_ok=True)
+    for name in os.listdir(out_dir):
+        if name.endswith('.csv'):
+            os.remove(os.path.join(out_dir, name))
+
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp(end) - pd.DateOffset(months=months)
+    days = (pd.Timestamp(end) - start).days
+    span_minutes = days * 1440
+    customers = max(rows // ORDERS_PER_CUSTOMER, 1)
+    cdf, acquired = _customers(rng, customers, days)
+    # Первые customers клиентов с событиями — те же покупатели.
+    event_cdf, event_acquired = _customers(rng, customers * EVENT_CUSTOMERS_FACTOR, days)
+    event_acquired[:customers] = acquired
+
+    logger.info(f"Генерируем {rows} заказов и {rows * events_per_order} событий в {out_dir}.")
+    orders_path = os.path.join(out_dir, 'orders.csv')
+    for offset in range(0, rows, GENERATE_CHUNK_ROWS):
+        size = min(GENERATE_CHUNK_ROWS, rows - offset)
+        customer, minutes = _draw(rng, cdf, acquired, size, span_minutes)
+        ids = np.arange(offset, offset + size)
+        orders = pd.DataFrame({
+            'OrderIdsMindboxId': ORDER_ID_BASE + ids,
+            'OrderCustomerIdsMindboxId': CUSTOMER_ID_BASE + customer,
+            'OrderFirstActionIdsMindboxId': ACTION_ID_BASE + ids,
+            'OrderFirstActionDateTimeUtc': _format_dates(start, minutes),
+            'OrderTotalPrice': np.round(rng.lognormal(7.5, 0.8, size), 2),
+            'OrderLineStatusIdsExternalId': rng.choice(STATUSES, size, p=STATUS_WEIGHTS),
+        })
+        _write_chunk(orders, orders_path, header=offset == 0)
+
+    events = rows * events_per_order
+    for offset in range(0, events, GENERATE_CHUNK_ROWS):
+        size = min(GENERATE_CHUNK_ROWS, events - offset)
+        customer, minutes = _draw(rng, event_cdf, event_acquired, size, span_minutes)
+        part = offset // EVENTS_FILE_ROWS + 1
+        events_df = pd.DataFrame({
+            'CustomerActionIdsMindboxId': EVENT_ID_BASE + np.arange(offset, offset + size),
+            'CustomerActionCustomerIdsMindboxId': CUSTOMER_ID_BASE + customer,
+            'CustomerActionDateTimeUtc': _format_dates(start, minutes),
+        })
+        _write_chunk(
+            events_df,
+            os.path.join(out_dir, f"events_{part:03d}.csv"),
+            header=offset % EVENTS_FILE_ROWS == 0
+        )
+
+    with open(manifest_path, 'w') as f:
+        json.dump(params, f)
+    logger.info(f"Набор данных {out_dir} сгенерирован.")
+    return out_dir
+
+def reset_database(engine):
+    """Удаляет таблицы и представления схемы public, кроме объектов расширений."""
+    reset_query = """
+    DO $$
+    DECLARE r RECORD;
+    BEGIN
+        FOR r IN
+            SELECT c.relname, c.relkind
+            FROM pg_class c
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname = 'public'
+                AND c.relkind IN ('r', 'p', 'v', 'm')
+                AND NOT EXISTS (
+                    SELECT 1 FROM pg_depend d WHERE d.objid = c.oid AND d.deptype = 'e'
+                )
+        LOOP
+            EXECUTE format(
+                'DROP %s IF EXISTS %I CASCADE',
+                CASE r.relkind
+                    WHEN 'v' THEN 'VIEW'
+                    WHEN 'm' THEN 'MATERIALIZED VIEW'
+                    ELSE 'TABLE'
+                END,
+                r.relname
+            );
+        END LOOP;
+    END $$;
+    """
+    execute_query(
+        engine,
+        reset_query,
+        "База очищена перед прогоном.",
+        "Ошибка при очистке базы"
+    )
+
+def run_scale(label, rows, data_dir):
+    """Прогоняет разбор, загрузку и все витрины на наборе rows строк.
+
+    Возвращает метрики этапов {этап: {...}} из metrics.
+    """
+    out_dir = generate_dataset(os.path.join(data_dir, label), rows)
+    reset_database(engine)
+    run_id = start_run(f"bench_{label}_{datetime.now():%Y%m%d%H%M%S}")
+    configure_profiling(
+        config['profile'], config['profile_dir'], run_id, config['profile_interval_ms'])
+    files = sorted(
+        os.path.join(out_dir, name) for name in os.listdir(out_dir) if name.endswith('.csv'))
+    process_files(engine, out_dir, files)
+    records = finish_run(engine, config)
+    return {r['stage']: {field: r.get(field) for field in REPORT_FIELDS} for r in records}
+
+def _git_commit():
+    try:
+        result = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        )
+        return result.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmark(scales, data_dir):
+    """Прогоняет набор масштабов и возвращает отчёт."""
+    # Без этого одинаковые наборы данных пропускались бы по отпечаткам витрин.
+    config['force_marts'] = True
+    report = {
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'commit': _git_commit(),
+        'settings': {
+            key: config[key] for key in (
+                'rfm_engine', 'rfm_scoring', 'rr_engine', 'mart_backend', 'mart_workers',
+                'mart_shards', 'mart_snapshot', 'mart_shadow', 'events_hll', 'memory_budget_mb'
+            )
+        },
+        'scales': {},
+    }
+    for label in scales:
+        rows = parse_rows(label)
+        logger.info(f"Прогон на {rows} строк ({label}).")
+        report['scales'][label] = {'rows': rows, 'stages': run_scale(label, rows, data_dir)}
+    return report
+
+def compare(report, baseline, threshold):
+    """Сравнивает время этапов с базовым отчётом и возвращает регрессии.
+
+    Регрессия — этап дольше базового больше чем на threshold процентов
+    (этапы короче MIN_COMPARE_SECONDS не учитываются).
+    """
+    regressions = []
+    for label, scale in report['scales'].items():
+        base_scale = baseline['scales'].get(label)
+        if base_scale is None:
+            logger.info(f"{label}: нет в базовом отчёте.")
+            continue
+        logger.info(f"{label}: этап, база, сейчас, изменение")
+        stages = scale['stages']
+        base_stages = base_scale['stages']
+        for name in sorted(set(stages) | set(base_stages)):
+            now = stages.get(name, {}).get('wall_seconds')
+            base = base_stages.get(name, {}).get('wall_seconds')
+            if now is None or base is None:
+                logger.info(f"  {name}: {base if base is not None else '—'} -> "
+                            f"{now if now is not None else '—'}")
+                continue
+            change = (now - base) / base * 100 if base else 0.0
+            regressed = change > threshold and max(now, base) >= MIN_COMPARE_SECONDS
+            logger.info(f"  {name}: {base:.1f} с -> {now:.1f} с ({change:+.0f}%)"
+                        + (" РЕГРЕССИЯ" if regressed else ""))
+            if regressed:
+                regressions.append((label, name, base, now))
+    return regressions
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Синтетические данные и замеры пайплайна AIF.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    generate = subparsers.add_parser('generate', help="сгенерировать набор данных")
+    generate.add_argument('--scale', default='100k', help="строк в orders: 100k, 1m, 10m, 100m")
+    generate.add_argument('--out', default='bench_data', help="каталог наборов данных")
+    generate.add_argument('--events-per-order', type=int, default=2)
+    generate.add_argument('--months', type=int, default=24)
+    generate.add_argument('--seed', type=int, default=42)
+
+    run = subparsers.add_parser('run', help="прогнать пайплайн на наборах данных")
+    run.add_argument('--scale', action='append', help="масштаб, можно несколько раз")
+    run.add_argument('--data-dir', default='bench_data')
+    run.add_argument('--report', default='bench_report.json', help="куда записать отчёт")
+    run.add_argument('--baseline', help="базовый отчёт для сравнения")
+    run.add_argument('--threshold', type=float, default=10.0,
+                     help="допустимое замедление этапа, %%")
+    run.add_argument('--force', action='store_true',
+                     help="разрешить прогон в базе без 'bench' в имени")
+    return parser, parser.parse_args()
+
+def main():
+    parser, args = parse_args()
+    if args.command == 'generate':
+        generate_dataset(
+            os.path.join(args.out, args.scale),
+            parse_rows(args.scale),
+            args.events_per_order,
+            args.months,
+            seed=args.seed
+        )
+        return
+
+    # Прогон удаляет все таблицы базы, поэтому только в отдельной базе.
+    if 'bench' not in (config['database_name'] or '') and not args.force:
+        parser.error(f"База {config['database_name']} не похожа на тестовую: "
+                     "прогон удаляет все таблицы, используйте --force.")
+    report = run_benchmark(args.scale or ['100k'], args.data_dir)
+    with open(args.report, 'w') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    logger.info(f"Отчёт записан в {args.report}.")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            logger.warning(f"Регрессий: {len(regressions)}.")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 import os
 import logging
+from datetime import date
 from sqlalchemy import create_engine
 from dotenv import load_dotenv
 import yadisk
@@ -26,6 +27,33 @@ def get_config():
         'password': os.getenv('DB_PASSWORD'),
         'database_name': os.getenv('DB_NAME'),
         'host': os.getenv('DB_HOST'),
+        'rfm_engine': os.getenv('RFM_ENGINE', 'sql'),
+        'rfm_scoring': os.getenv('RFM_SCORING', 'stddev'),
+        'rfm_incremental': os.getenv('RFM_INCREMENTAL', '0') == '1',
+        'cdr_incremental': os.getenv('CDR_INCREMENTAL', '0') == '1',
+        'rr_engine': os.getenv('RR_ENGINE', 'sql'),
+        'events_hll': os.getenv('EVENTS_HLL', '0') == '1',
+        'cohort_incremental': os.getenv('COHORT_INCREMENTAL', '0') == '1',
+        'mart_workers': int(os.getenv('MART_WORKERS', '4')),
+        'force_marts': os.getenv('FORCE_MARTS', '0') == '1',
+        'mart_snapshot': os.getenv('MART_SNAPSHOT', '1') == '1',
+        'mart_shadow': os.getenv('MART_SHADOW', '1') == '1',
+        'mart_keep_versions': int(os.getenv('MART_KEEP_VERSIONS', '2')),
+        'mart_backend': os.getenv('MART_BACKEND', 'tables'),
+        'mart_shards': int(os.getenv('MART_SHARDS', '1')),
+        'query_plans': os.getenv('QUERY_PLANS', '0') == '1',
+        'mart_profiles': os.getenv(
+            'MART_PROFILES', 
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), 'session_profiles.json')
+        ),
+        'memory_budget_mb': int(os.getenv('MEMORY_BUDGET_MB')) if os.getenv('MEMORY_BUDGET_MB') else None,
+        'memory_trace': os.getenv('MEMORY_TRACE', '0') == '1',
+        'profile': os.getenv('PROFILE') or None,
+        'profile_dir': os.getenv('PROFILE_DIR', 'profiles'),
+        'profile_interval_ms': int(os.getenv('PROFILE_INTERVAL_MS', '10')),
+        'metrics_textfile': os.getenv('METRICS_TEXTFILE'),
+        'metrics_json': os.getenv('METRICS_JSON'),
+        'as_of': date.fromisoformat(os.getenv('AS_OF')) if os.getenv('AS_OF') else None,
     }
     
 def init_services():
@@ -36,8 +64,12 @@ def init_services():
         config['ya_token']
     )
 
+    # По соединению на каждый поток планировщика витрин и каждый шард его
+    # запроса, одно держит экспортированный снимок и одно остаётся основному потоку.
     engine = create_engine(
-        f'postgresql://{config["username"]}:{config["password"]}@{config["host"]}/{config["database_name"]}'
+        f'postgresql://{config["username"]}:{config["password"]}@{config["host"]}/{config["database_name"]}',
+        pool_size=config['mart_workers'] * max(config['mart_shards'], 1) + 2,
+        max_overflow=0
     )
     
     return config, yadisk_client, engine
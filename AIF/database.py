@@ -1,34 +1,98 @@
+import io
+import os
+import re
+import json
+import time
 import logging
+import itertools
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from sqlalchemy import text
 from utils import terminate_script 
+from memory import frame_chunk_rows
 
 logger = logging.getLogger()
 
-def load_to_database(engine, new_orders_data, new_events_data):
-    """Основная функция для загрузки данных в базу."""
+# Соединение со снимком, параметры сессии, режим снятия планов и счётчик строк,
+# с которыми выполняются запросы текущего потока.
+_query_context = threading.local()
+_rows_lock = threading.Lock()
+
+# Параметры Postgres, которые можно задавать в профилях шагов.
+SESSION_SETTINGS = (
+    'work_mem',
+    'hash_mem_multiplier',
+    'maintenance_work_mem',
+    'max_parallel_workers_per_gather',
+    'jit',
+    'statement_timeout',
+    'temp_buffers',
+)
+
+# Номер пачки загрузки в orders и events: по нему, а не по id Mindbox,
+# инкрементальные витрины находят новые строки.
+LOAD_BATCH_COLUMN = 'load_batch'
+
+def load_to_database(engine, new_orders_data, new_events_data, budget_mb=None):
+    """Основная функция для загрузки данных в базу.
+
+    С budget_mb датафреймы пишутся пачками, размер которых подобран под
+    бюджет памяти. Все строки получают номер новой пачки загрузки.
+    """
     try:
-        load_orders(engine, new_orders_data)
-        load_events(engine, new_events_data)
+        batch = start_load_batch(engine)
+        load_orders(engine, new_orders_data, budget_mb, batch)
+        load_events(engine, new_events_data, budget_mb, batch)
         check_duplicates(engine)
         create_indexes(engine)
     except Exception as e:
         logger.error(f"Ошибка при загрузке данных или создании индексов: {e}")
         terminate_script()
 
-def load_orders(engine, new_orders_data):
-    """Загружает orders в базу."""
+def load_chunks_to_database(engine, chunks):
+    """Загружает данные по частям и возвращает число записанных строк.
+
+    chunks — итератор пар (таблица, датафрейм), например utils.iter_datasets.
+    Все части пишутся в одной транзакции: если чтение оборвалось на
+    середине файла, в базе не остаётся его начала.
+    """
+    rows = 0
+    try:
+        batch = start_load_batch(engine)
+        with engine.begin() as conn:
+            for table, chunk in chunks:
+                chunk[LOAD_BATCH_COLUMN] = batch
+                chunk.to_sql(table, conn, if_exists='append', index=False)
+                rows += len(chunk)
+        logger.info(f"Данные загружены по частям: {rows} строк.")
+        check_duplicates(engine)
+        create_indexes(engine)
+    except Exception as e:
+        logger.error(f"Ошибка при загрузке данных или создании индексов: {e}")
+        terminate_script()
+    return rows
+
+def load_orders(engine, new_orders_data, budget_mb=None, batch=None):
+    """Загружает orders в базу, проставляя номер пачки загрузки batch."""
     if new_orders_data is not None:
         logger.info("Загружаем orders в базу данных..")
-        new_orders_data.to_sql('orders', engine, if_exists='append', index=False)
+        if batch is not None:
+            new_orders_data[LOAD_BATCH_COLUMN] = batch
+        chunksize = frame_chunk_rows(new_orders_data, budget_mb) if budget_mb else None
+        new_orders_data.to_sql('orders', engine, if_exists='append', index=False, chunksize=chunksize)
         logger.info("Данные из orders загружены.")
     else:
         logger.info("Нет данных для загрузки orders.")
 
-def load_events(engine, new_events_data):
-    """Загружает events в базу."""
+def load_events(engine, new_events_data, budget_mb=None, batch=None):
+    """Загружает events в базу, проставляя номер пачки загрузки batch."""
     if new_events_data is not None:
         logger.info("Загружаем events в базу данных..")
-        new_events_data.to_sql('events', engine, if_exists='append', index=False)
+        if batch is not None:
+            new_events_data[LOAD_BATCH_COLUMN] = batch
+        chunksize = frame_chunk_rows(new_events_data, budget_mb) if budget_mb else None
+        new_events_data.to_sql('events', engine, if_exists='append', index=False, chunksize=chunksize)
         logger.info("Данные из events загружены.")
     else:
         logger.info("Нет данных для загрузки events.")
@@ -66,13 +130,23 @@ def create_indexes(engine):
     CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_mindbox_id 
     ON orders ("OrderIdsMindboxId");
     """
+    create_orders_customer_index_query = """
+    CREATE INDEX IF NOT EXISTS idx_orders_customer_id 
+    ON orders ("OrderCustomerIdsMindboxId");
+    """
     create_events_index_query = """
     CREATE UNIQUE INDEX IF NOT EXISTS idx_events_mindbox_id 
     ON events ("CustomerActionIdsMindboxId");
     """   
-    with engine.connect() as conn:
+    create_load_batch_index_query = f"""
+    CREATE INDEX IF NOT EXISTS idx_orders_load_batch ON orders ({LOAD_BATCH_COLUMN});
+    CREATE INDEX IF NOT EXISTS idx_events_load_batch ON events ({LOAD_BATCH_COLUMN});
+    """
+    with engine.begin() as conn:
         conn.execute(text(create_orders_index_query))
+        conn.execute(text(create_orders_customer_index_query))
         conn.execute(text(create_events_index_query))
+        conn.execute(text(create_load_batch_index_query))
 
     logger.info("Индексы успешно созданы.")
         
@@ -83,23 +157,55 @@ def execute_query(
     error_message="", 
     fetch_results=False, 
     retries=3, 
-    retry_delay=5
+    retry_delay=5,
+    raise_errors=True
 ):
-    """Выполняет запрос в базу."""
+    """Выполняет запрос в базу.
+
+    После retries неудачных попыток исключение пробрасывается вызывающему,
+    чтобы планировщик витрин мог остановить зависящие шаги. С
+    raise_errors=False ошибка только логируется, а функция, как раньше,
+    возвращает (None, None) при fetch_results и None без него. Внутри
+    snapshot_transaction запрос выполняется в общей транзакции потока
+    без повторов: после ошибки транзакция всё равно прервана. Внутри
+    session_profile параметры сессии задаются локально для транзакции,
+    внутри capture_plans планы запросов без fetch_results сохраняются
+    в pipeline_query_plans. Изменённые строки учитываются в count_rows
+    только после успешного выполнения, повторы их не удваивают.
+    """
+    settings = _settings_query()
+    capture = None if fetch_results else getattr(_query_context, 'plans', None)
+    failed = (None, None) if fetch_results else None
+
+    def run(conn):
+        if settings:
+            conn.execute(text(settings))
+        if capture is not None:
+            return _execute_with_plans(conn, query, capture)
+        result = conn.execute(text(query))
+        if fetch_results:
+            return (result.fetchall(), result.keys()), None
+        return None, result.rowcount
+
+    conn = getattr(_query_context, 'connection', None)
+    if conn is not None:
+        try:
+            output, changed = run(conn)
+        except Exception as e:
+            logger.error(f"{error_message}: {e}")
+            if raise_errors:
+                raise
+            return failed
+        _add_rows(changed)
+        if success_message:
+            logger.info(success_message)
+        return output if fetch_results else None
+
     attempt = 0
     while attempt < retries:
         try:
             with engine.begin() as conn:
-                result = conn.execute(text(query))  
-                if fetch_results:
-                    data = result.fetchall()
-                    columns = result.keys()
-                    if success_message:  
-                        logger.info(success_message)
-                    return data, columns
-                if success_message: 
-                    logger.info(success_message)
-            break  
+                output, changed = run(conn)
         except Exception as e:
             attempt += 1
             if attempt < retries:
@@ -108,7 +214,752 @@ def execute_query(
                 time.sleep(retry_delay)  
             else:
                 logger.error(f"{error_message}: {e}. Превышено количество попыток ({retries}). Операция прервана.")
-                return None, None if fetch_results else None
+                if raise_errors:
+                    raise
+                return failed
+        else:
+            # Строки неудачных попыток откатились, поэтому учитываются только после фиксации.
+            _add_rows(changed)
+            if success_message:
+                logger.info(success_message)
+            return output if fetch_results else None
+
+def load_session_profiles(path, environ=os.environ):
+    """Читает профили параметров сессии для шагов витрин.
+
+    Файл path — JSON вида {"default": {...}, "<шаг>": {...}}; переменная
+    окружения MART_PROFILE_<ШАГ> ("work_mem=512MB,jit=off") дополняет
+    профиль шага. Допускаются только параметры из SESSION_SETTINGS.
+    """
+    profiles = {}
+    if path and os.path.exists(path):
+        with open(path, 'r') as f:
+            profiles = json.load(f)
+    for key, value in environ.items():
+        if key.startswith('MART_PROFILE_') and value:
+            step = key[len('MART_PROFILE_'):].lower()
+            profile = profiles.setdefault(step, {})
+            for item in value.split(','):
+                name, _, setting = item.partition('=')
+                profile[name.strip()] = setting.strip()
+    for step, profile in profiles.items():
+        unknown = set(profile) - set(SESSION_SETTINGS)
+        if unknown:
+            raise ValueError(
+                f"Недопустимые параметры в профиле {step}: {', '.join(sorted(unknown))}. "
+                f"Допустимые: {', '.join(SESSION_SETTINGS)}")
+    return profiles
+
+@contextmanager
+def session_profile(settings):
+    """Задаёт параметры сессии для всех execute_query текущего потока."""
+    previous = getattr(_query_context, 'settings', None)
+    _query_context.settings = dict(settings or {})
+    try:
+        yield
+    finally:
+        _query_context.settings = previous
+
+def _settings_query():
+    """Собирает set_config(..., true) для параметров текущего потока."""
+    settings = getattr(_query_context, 'settings', None)
+    if not settings:
+        return ""
+    calls = []
+    for name, value in settings.items():
+        value = str(value).replace("'", "''")
+        calls.append(f"set_config('{name}', '{value}', true)")
+    return f"SELECT {', '.join(calls)};"
+
+def create_query_plans_table(engine):
+    """Создает таблицу планов запросов, снятых в режиме capture_plans."""
+    create_table_query = """
+    CREATE TABLE IF NOT EXISTS pipeline_query_plans (
+        run_id TEXT,
+        step TEXT,
+        query_no INT,
+        statement TEXT,
+        plan JSONB,
+        planning_ms NUMERIC,
+        execution_ms NUMERIC,
+        actual_rows BIGINT,
+        shared_hit_blocks BIGINT,
+        shared_read_blocks BIGINT,
+        temp_read_blocks BIGINT,
+        temp_written_blocks BIGINT,
+        spill_kb BIGINT,
+        recorded_at TIMESTAMP DEFAULT NOW(),
+        PRIMARY KEY (run_id, step, query_no)
+    );
+    """
+    execute_query(
+        engine,
+        create_table_query,
+        error_message="Ошибка при создании таблицы pipeline_query_plans"
+    )
+
+@contextmanager
+def capture_plans(run_id, step):
+    """Выполняет запросы текущего потока под EXPLAIN ANALYZE и сохраняет планы.
+
+    Планы пишутся в pipeline_query_plans с ключом (run_id, step, номер
+    запроса) в той же транзакции, что и сам запрос. EXPLAIN ANALYZE
+    добавляет накладные расходы на замер времени узлов, поэтому режим
+    включается только для диагностики.
+    """
+    previous = getattr(_query_context, 'plans', None)
+    _query_context.plans = {
+        'run_id': run_id, 'step': step, 'counter': itertools.count(1)}
+    try:
+        yield
+    finally:
+        _query_context.plans = previous
+
+def _split_statements(query):
+    """Делит текст на операторы по ';' вне строк, идентификаторов, $$-блоков и комментариев."""
+    statements = []
+    start = i = 0
+    quote = None
+    while i < len(query):
+        if quote is not None:
+            if query.startswith(quote, i):
+                i += len(quote)
+                quote = None
+            else:
+                i += 1
+            continue
+        if query.startswith('--', i):
+            end = query.find('\n', i)
+            i = len(query) if end == -1 else end
+        elif query[i] in ("'", '"'):
+            quote = query[i]
+            i += 1
+        elif query.startswith('$', i):
+            end = query.find('$', i + 1)
+            tag = query[i:end + 1] if end != -1 else ''
+            if tag and (tag == '$$' or tag[1:-1].isidentifier()):
+                quote = tag
+                i += len(tag)
+            else:
+                i += 1
+        elif query[i] == ';':
+            statements.append(query[start:i])
+            start = i = i + 1
+        else:
+            i += 1
+    statements.append(query[start:])
+    return [s for s in statements if s.strip()]
+
+def _is_explainable(statement):
+    """Проверяет, что оператор можно выполнить под EXPLAIN ANALYZE."""
+    lines = [
+        line for line in statement.strip().splitlines() 
+        if not line.strip().startswith('--')
+    ]
+    words = " ".join(lines).split(None, 1)
+    return bool(words) and words[0].upper() in (
+        'SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'MERGE')
+
+def _plan_nodes(node):
+    yield node
+    for child in node.get('Plans', ()):
+        yield from _plan_nodes(child)
+
+def _plan_rows(plan):
+    """Возвращает число строк, обработанных оператором, по JSON-плану."""
+    root = plan[0]['Plan']
+    # У ModifyTable без RETURNING Actual Rows = 0, строки видны у его входа.
+    if root.get('Node Type') == 'ModifyTable' and root.get('Plans'):
+        return root['Plans'][0].get('Actual Rows', 0)
+    return root.get('Actual Rows', 0)
 
+def _plan_summary(plan):
+    """Извлекает из JSON-плана время, буферы и объём сброса на диск."""
+    top = plan[0]
+    root = top['Plan']
+    spill_kb = 0
+    for node in _plan_nodes(root):
+        if node.get('Sort Space Type') == 'Disk':
+            spill_kb += node.get('Sort Space Used', 0)
+        spill_kb += node.get('Disk Usage', 0)
+    return {
+        'planning_ms': top.get('Planning Time'),
+        'execution_ms': top.get('Execution Time'),
+        'actual_rows': root.get('Actual Rows'),
+        'shared_hit_blocks': root.get('Shared Hit Blocks'),
+        'shared_read_blocks': root.get('Shared Read Blocks'),
+        'temp_read_blocks': root.get('Temp Read Blocks'),
+        'temp_written_blocks': root.get('Temp Written Blocks'),
+        'spill_kb': spill_kb,
+    }
 
+def _execute_with_plans(conn, query, capture):
+    """Выполняет операторы запроса, снимая планы с тех, что поддерживают EXPLAIN.
 
+    Возвращает (None, число изменённых строк) — как run в execute_query.
+    """
+    rows = []
+    changed = 0
+    for statement in _split_statements(query):
+        if not _is_explainable(statement):
+            result = conn.execute(text(statement))
+            changed += max(result.rowcount or 0, 0)
+            continue
+        plan = conn.execute(
+            text(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {statement}")).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        changed += _plan_rows(plan) or 0
+        rows.append({
+            'run_id': capture['run_id'],
+            'step': capture['step'],
+            'query_no': next(capture['counter']),
+            'statement': statement.strip(),
+            'plan': json.dumps(plan),
+            **_plan_summary(plan),
+        })
+    if rows:
+        conn.execute(
+            text("""
+            INSERT INTO pipeline_query_plans (
+                run_id, step, query_no, statement, plan, 
+                planning_ms, execution_ms, actual_rows, 
+                shared_hit_blocks, shared_read_blocks, 
+                temp_read_blocks, temp_written_blocks, spill_kb
+            )
+            VALUES (
+                :run_id, :step, :query_no, :statement, CAST(:plan AS JSONB), 
+                :planning_ms, :execution_ms, :actual_rows, 
+                :shared_hit_blocks, :shared_read_blocks, 
+                :temp_read_blocks, :temp_written_blocks, :spill_kb
+            )
+            ON CONFLICT (run_id, step, query_no) DO NOTHING;
+            """),
+            rows
+        )
+    return None, changed
+
+@contextmanager
+def count_rows():
+    """Считает строки, изменённые запросами execute_query текущего потока.
+
+    Число берётся из rowcount драйвера; для запроса из нескольких
+    операторов драйвер сообщает rowcount последнего.
+    """
+    previous = getattr(_query_context, 'rows', None)
+    counter = {'rows': 0}
+    _query_context.rows = counter
+    try:
+        yield counter
+    finally:
+        _query_context.rows = previous
+
+def _add_rows(count):
+    counter = getattr(_query_context, 'rows', None)
+    if counter is not None and count and count > 0:
+        with _rows_lock:
+            counter['rows'] += count
+
+def run_parallel(engine, queries, max_workers=4, error_message=""):
+    """Выполняет независимые запросы параллельно, каждый в своём соединении.
+
+    Внутри snapshot_transaction запросы выполняются последовательно в её
+    соединении: незафиксированные изменения не видны другим соединениям.
+    Параметры сессии, режим capture_plans и счётчик count_rows передаются
+    потокам шардов. Ошибка
+    первого упавшего запроса пробрасывается после завершения остальных.
+    """
+    if getattr(_query_context, 'connection', None) is not None:
+        for query in queries:
+            execute_query(engine, query, error_message=error_message)
+        return
+    context = {
+        name: getattr(_query_context, name, None) 
+        for name in ('settings', 'plans', 'rows')
+    }
+
+    def run(query):
+        for name, value in context.items():
+            setattr(_query_context, name, value)
+        try:
+            execute_query(engine, query, error_message=error_message)
+        finally:
+            for name in context:
+                setattr(_query_context, name, None)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(run, query) for query in queries]
+    errors = [future.exception() for future in futures if future.exception()]
+    if errors:
+        raise errors[0]
+
+def create_watermarks_table(engine):
+    """Создает таблицу с водяными знаками инкрементальных витрин."""
+    create_table_query = """
+    CREATE TABLE IF NOT EXISTS etl_watermarks (
+        name TEXT PRIMARY KEY,
+        value BIGINT,
+        updated_at TIMESTAMP DEFAULT NOW()
+    );
+    """
+    execute_query(
+        engine,
+        create_table_query,
+        error_message="Ошибка при создании таблицы etl_watermarks"
+    )
+
+def get_watermark(engine, name):
+    """Возвращает последнее обработанное значение (номер пачки или id) для витрины name."""
+    data, _ = execute_query(
+        engine,
+        f"SELECT value FROM etl_watermarks WHERE name = '{name}';",
+        error_message=f"Ошибка при чтении водяного знака {name}",
+        fetch_results=True
+    )
+    return data[0][0] if data else None
+
+def set_watermark(engine, name, value):
+    """Сохраняет последнее обработанное значение (номер пачки или id) для витрины name."""
+    if value is None:
+        return
+    execute_query(
+        engine,
+        f"""
+        INSERT INTO etl_watermarks (name, value, updated_at)
+        VALUES ('{name}', {int(value)}, NOW())
+        ON CONFLICT (name) DO UPDATE SET
+            value = EXCLUDED.value,
+            updated_at = EXCLUDED.updated_at;
+        """,
+        f"Водяной знак {name} обновлен: {value}.",
+        f"Ошибка при обновлении водяного знака {name}"
+    )
+
+def get_max_id(engine, table, id_column):
+    """Возвращает максимальный идентификатор в таблице."""
+    data, _ = execute_query(
+        engine,
+        f'SELECT MAX("{id_column}") FROM {table};',
+        error_message=f"Ошибка при чтении максимального идентификатора {table}",
+        fetch_results=True
+    )
+    return data[0][0] if data else None
+
+def ensure_load_batch_columns(engine):
+    """Добавляет в базовые таблицы столбец load_batch с номером пачки загрузки.
+
+    Строки, загруженные до появления столбца, получают пачку 0. DEFAULT
+    с константой не переписывает таблицу.
+    """
+    alter_query = "\n".join(
+        f"ALTER TABLE IF EXISTS {table} "
+        f"ADD COLUMN IF NOT EXISTS {LOAD_BATCH_COLUMN} BIGINT NOT NULL DEFAULT 0;"
+        for table in ('orders', 'events')
+    )
+    execute_query(
+        engine,
+        alter_query,
+        error_message="Ошибка при добавлении столбца load_batch"
+    )
+
+def start_load_batch(engine):
+    """Возвращает номер новой пачки загрузки для строк orders и events."""
+    ensure_load_batch_columns(engine)
+    execute_query(
+        engine,
+        "CREATE SEQUENCE IF NOT EXISTS load_batch_seq;",
+        error_message="Ошибка при создании последовательности load_batch_seq"
+    )
+    data, _ = execute_query(
+        engine,
+        "SELECT nextval('load_batch_seq');",
+        error_message="Ошибка при получении номера пачки загрузки",
+        fetch_results=True
+    )
+    batch = int(data[0][0])
+    logger.info(f"Номер пачки загрузки: {batch}.")
+    return batch
+
+def get_max_batch(engine, table):
+    """Возвращает номер последней загруженной в таблицу пачки."""
+    return get_max_id(engine, table, LOAD_BATCH_COLUMN)
+
+def batch_watermark(name):
+    """Имя водяного знака по пачкам загрузки.
+
+    Прежние водяные знаки хранили id Mindbox, поэтому у знаков по пачкам
+    своё имя: первый запуск после перехода пересчитывает витрину целиком.
+    """
+    return f"{name}:batch"
+
+def batch_filter(last_batch, max_batch, column=LOAD_BATCH_COLUMN):
+    """Условие на строки пачек после last_batch и не позже max_batch.
+
+    Пачки, а не id Mindbox: догруженная история приходит с меньшими id,
+    чем уже обработанные, но с новым номером пачки.
+    """
+    condition = f"{column} <= {int(max_batch)}"
+    if last_batch is not None:
+        condition += f" AND {column} > {int(last_batch)}"
+    return condition
+
+def copy_dataframe(engine, df, table, columns=None):
+    """Записывает датафрейм в таблицу одной командой COPY."""
+    columns = list(columns or df.columns)
+    buffer = io.StringIO()
+    df[columns].to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    column_list = ", ".join(f'"{c}"' for c in columns)
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.copy_expert(
+                f"COPY {table} ({column_list}) FROM STDIN WITH (FORMAT csv)",
+                buffer
+            )
+        conn.commit()
+    finally:
+        conn.close()
+    _add_rows(len(df))
+    logger.info(f"В таблицу {table} записано {len(df)} строк.")
+
+def create_fingerprints_table(engine):
+    """Создает таблицу с отпечатками входных данных витрин."""
+    create_table_query = """
+    CREATE TABLE IF NOT EXISTS mart_fingerprints (
+        step TEXT PRIMARY KEY,
+        fingerprint TEXT,
+        inputs JSONB,
+        updated_at TIMESTAMP DEFAULT NOW()
+    );
+    """
+    execute_query(
+        engine,
+        create_table_query,
+        error_message="Ошибка при создании таблицы mart_fingerprints"
+    )
+
+def get_fingerprints(engine):
+    """Возвращает сохранённые отпечатки витрин: {шаг: (отпечаток, входы)}."""
+    data, _ = execute_query(
+        engine,
+        "SELECT step, fingerprint, inputs FROM mart_fingerprints;",
+        error_message="Ошибка при чтении отпечатков витрин",
+        fetch_results=True
+    )
+    return {step: (fingerprint, inputs) for step, fingerprint, inputs in data or []}
+
+def set_fingerprint(engine, step, fingerprint, inputs):
+    """Сохраняет отпечаток входных данных витрины после успешного расчёта."""
+    inputs_json = json.dumps(inputs, sort_keys=True, default=str).replace("'", "''")
+    execute_query(
+        engine,
+        f"""
+        INSERT INTO mart_fingerprints (step, fingerprint, inputs, updated_at)
+        VALUES ('{step}', '{fingerprint}', '{inputs_json}'::JSONB, NOW())
+        ON CONFLICT (step) DO UPDATE SET
+            fingerprint = EXCLUDED.fingerprint,
+            inputs = EXCLUDED.inputs,
+            updated_at = EXCLUDED.updated_at;
+        """,
+        error_message=f"Ошибка при сохранении отпечатка витрины {step}"
+    )
+
+@contextmanager
+def exported_snapshot(engine):
+    """Открывает транзакцию REPEATABLE READ и отдаёт идентификатор её снимка.
+
+    Снимок можно импортировать в других соединениях, пока блок не завершён.
+    """
+    with engine.connect() as conn:
+        with conn.begin() as transaction:
+            conn.execute(text("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ"))
+            snapshot_id = conn.execute(text("SELECT pg_export_snapshot()")).scalar()
+            logger.info(f"Экспортирован снимок базы {snapshot_id}.")
+            try:
+                yield snapshot_id
+            finally:
+                transaction.rollback()
+
+@contextmanager
+def snapshot_transaction(engine, snapshot_id):
+    """Выполняет все execute_query текущего потока в одной транзакции со снимком.
+
+    Транзакция видит базу в состоянии на момент экспорта снимка и свои
+    собственные изменения; при выходе без ошибок изменения фиксируются.
+    """
+    with engine.connect() as conn:
+        with conn.begin():
+            conn.execute(text("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ"))
+            conn.execute(text(f"SET TRANSACTION SNAPSHOT '{snapshot_id}'"))
+            _query_context.connection = conn
+            try:
+                yield conn
+            finally:
+                _query_context.connection = None
+
+@contextmanager
+def pinned_views(engine, batches):
+    """Создаёт представления <таблица>_pinned только с пачками загрузки до batches[таблица].
+
+    Шаги, которые не могут выполняться в транзакции снимка, читают базовые
+    таблицы через эти представления и видят те же пачки, что и снимок.
+    Отдаёт {таблица: представление}; при выходе представления удаляются.
+    """
+    def condition(batch):
+        # В пустой таблице снимок не видел ни одной пачки.
+        return batch_filter(None, batch) if batch is not None else "FALSE"
+
+    views = {table: f"{table}_pinned" for table in batches}
+    create_query = "\n".join(
+        f"""
+        DROP VIEW IF EXISTS {view};
+        CREATE VIEW {view} AS SELECT * FROM {table} WHERE {condition(batches[table])};
+        """
+        for table, view in views.items()
+    )
+    execute_query(
+        engine,
+        create_query,
+        error_message="Ошибка при создании представлений с закреплёнными пачками"
+    )
+    try:
+        yield views
+    finally:
+        execute_query(
+            engine,
+            "\n".join(f"DROP VIEW IF EXISTS {view};" for view in views.values()),
+            error_message="Ошибка при удалении представлений с закреплёнными пачками",
+            raise_errors=False
+        )
+
+def _table_exists(engine, table):
+    data, _ = execute_query(
+        engine,
+        f"SELECT to_regclass('{table}') IS NOT NULL;",
+        error_message=f"Ошибка при проверке таблицы {table}",
+        fetch_results=True
+    )
+    return bool(data and data[0][0])
+
+def _table_versions(engine, table, suffix='old'):
+    """Возвращает сохранённые версии таблицы, от новых к старым."""
+    data, _ = execute_query(
+        engine,
+        f"""
+        SELECT tablename FROM pg_tables
+        WHERE schemaname = current_schema()
+            AND tablename ~ '^{table}__{suffix}_[0-9]{{14}}$'
+        ORDER BY tablename DESC;
+        """,
+        error_message=f"Ошибка при чтении версий таблицы {table}",
+        fetch_results=True
+    )
+    return [name for (name,) in data or []]
+
+def swap_tables(engine, table, shadow, lock_timeout='5s', index_names=()):
+    """Подменяет table на shadow переименованием в одной короткой транзакции.
+
+    Прежняя таблица сохраняется как {table}__old_<время>. index_names —
+    пары (индекс table, индекс shadow): в той же транзакции индексы копии
+    получают имена индексов живой таблицы, а прежняя версия — имена копии,
+    так что имена не растут от подмены к подмене. Если блокировку не
+    удаётся взять за lock_timeout, execute_query повторит попытку.
+    """
+    version = f"{table}__old_{time.strftime('%Y%m%d%H%M%S')}"
+    renames = "".join(
+        f"""
+        ALTER INDEX {name} RENAME TO {table}__swap_{i};
+        ALTER INDEX {shadow_name} RENAME TO {name};
+        ALTER INDEX {table}__swap_{i} RENAME TO {shadow_name};"""
+        for i, (name, shadow_name) in enumerate(index_names)
+    )
+    execute_query(
+        engine,
+        f"""
+        SET LOCAL lock_timeout = '{lock_timeout}';
+        ALTER TABLE IF EXISTS {table} RENAME TO {version};
+        ALTER TABLE {shadow} RENAME TO {table};{renames}
+        """,
+        f"Таблица {table} обновлена, прежняя версия сохранена как {version}.",
+        f"Ошибка при подмене таблицы {table}"
+    )
+
+def _dependent_views(engine, table):
+    """Возвращает представления, чьи правила ссылаются на таблицу."""
+    data, _ = execute_query(
+        engine,
+        f"""
+        SELECT DISTINCT v.oid::regclass::TEXT
+        FROM pg_depend d
+        JOIN pg_rewrite r ON r.oid = d.objid
+        JOIN pg_class v ON v.oid = r.ev_class
+        WHERE d.classid = 'pg_rewrite'::regclass
+            AND d.refobjid = to_regclass('{table}')
+            AND v.oid <> d.refobjid
+        ORDER BY 1;
+        """,
+        error_message=f"Ошибка при поиске представлений над таблицей {table}",
+        fetch_results=True
+    )
+    return [name for (name,) in data or []]
+
+def drop_old_versions(engine, table, keep_versions=2):
+    """Удаляет сохранённые версии таблицы сверх keep_versions последних.
+
+    Версии, на которые ещё ссылаются представления, не удаляются: DROP
+    без CASCADE на них падает, а CASCADE удалил бы сами представления.
+    """
+    for version in _table_versions(engine, table)[keep_versions:]:
+        views = _dependent_views(engine, version)
+        if views:
+            logger.warning(f"Версия {version} не удалена: на неё ссылаются "
+                           f"представления {', '.join(views)}.")
+            continue
+        execute_query(
+            engine,
+            f"DROP TABLE IF EXISTS {version};",
+            error_message=f"Ошибка при удалении версии {version}"
+        )
+
+def _create_shadow(engine, table, shadow):
+    """Создает теневую копию table: столбцы и первичный ключ, без прочих индексов.
+
+    Первичный ключ нужен сразу: шаги витрин пишут через ON CONFLICT по нему.
+    """
+    data, _ = execute_query(
+        engine,
+        f"""
+        SELECT pg_get_constraintdef(oid) FROM pg_constraint
+        WHERE conrelid = to_regclass('{table}') AND contype = 'p';
+        """,
+        error_message=f"Ошибка при чтении первичного ключа таблицы {table}",
+        fetch_results=True
+    )
+    primary_key = f"ALTER TABLE {shadow} ADD {data[0][0]};" if data else ""
+    execute_query(
+        engine,
+        f"""
+        CREATE TABLE {shadow} (
+            LIKE {table} INCLUDING DEFAULTS INCLUDING GENERATED INCLUDING IDENTITY
+        );
+        {primary_key}
+        """,
+        error_message=f"Ошибка при создании таблицы {shadow}"
+    )
+
+_INDEX_TARGET = re.compile(r'^CREATE (UNIQUE )?INDEX \S+ ON (ONLY )?\S+')
+
+def _copy_indexes(engine, table, shadow):
+    """Строит на shadow индексы table, которых там ещё нет, уже после загрузки."""
+    data, _ = execute_query(
+        engine,
+        f"""
+        SELECT pg_get_indexdef(i.indexrelid)
+        FROM pg_index i
+        WHERE i.indrelid = to_regclass('{table}')
+            AND NOT EXISTS (
+                SELECT 1 FROM pg_constraint c WHERE c.conindid = i.indexrelid)
+        ORDER BY i.indexrelid;
+        """,
+        error_message=f"Ошибка при чтении индексов таблицы {table}",
+        fetch_results=True
+    )
+    for (definition,) in data or []:
+        # Имена индексов уникальны в схеме, поэтому на копии имя выбирает
+        # Postgres; исходные имена возвращает swap_tables.
+        definition = _INDEX_TARGET.sub(
+            lambda m: f"CREATE {m.group(1) or ''}INDEX ON {shadow}", definition)
+        execute_query(
+            engine,
+            definition,
+            error_message=f"Ошибка при создании индекса таблицы {shadow}"
+        )
+
+def _table_indexes(engine, table):
+    """Возвращает пары (имя, определение) индексов таблицы из pg_indexes."""
+    data, _ = execute_query(
+        engine,
+        f"""
+        SELECT indexname, indexdef FROM pg_indexes
+        WHERE schemaname = current_schema() AND tablename = '{table}'
+        ORDER BY indexname;
+        """,
+        error_message=f"Ошибка при чтении индексов таблицы {table}",
+        fetch_results=True
+    )
+    return [tuple(row) for row in data or []]
+
+def _pair_indexes(indexes, shadow_indexes):
+    """Сопоставляет индексы таблицы и копии по определению без имён.
+
+    Возвращает пары (имя индекса таблицы, имя индекса копии) для
+    индексов, чьи имена различаются.
+    """
+    by_definition = {}
+    for name, definition in shadow_indexes:
+        by_definition.setdefault(_INDEX_TARGET.sub(r'\1', definition), []).append(name)
+    pairs = []
+    for name, definition in indexes:
+        candidates = by_definition.get(_INDEX_TARGET.sub(r'\1', definition))
+        if candidates:
+            shadow_name = candidates.pop(0)
+            if shadow_name != name:
+                pairs.append((name, shadow_name))
+    return pairs
+
+def shadow_build(engine, table, build, keep_versions=2):
+    """Строит таблицу в теневой копии и подменяет ею живую.
+
+    build(имя_таблицы) заполняет переданную таблицу с нуля. Пока идёт
+    расчёт, дашборд читает прежнюю версию без блокировок строк. Копия
+    получает столбцы и первичный ключ живой таблицы, остальные индексы
+    строятся после загрузки; при подмене индексы получают прежние имена. Если над таблицей есть представления,
+    переименование оставило бы их на прежней версии, поэтому такая
+    таблица пересчитывается на месте.
+    """
+    views = _dependent_views(engine, table)
+    if views:
+        logger.warning(f"Над таблицей {table} есть представления {', '.join(views)}, "
+                       f"теневая сборка пропущена, таблица пересчитывается на месте.")
+        build(table)
+        return
+    shadow = f"{table}__shadow"
+    execute_query(
+        engine,
+        f"DROP TABLE IF EXISTS {shadow};",
+        error_message=f"Ошибка при удалении таблицы {shadow}"
+    )
+    exists = _table_exists(engine, table)
+    if exists:
+        _create_shadow(engine, table, shadow)
+    build(shadow)
+    index_names = ()
+    if exists:
+        _copy_indexes(engine, table, shadow)
+        index_names = _pair_indexes(
+            _table_indexes(engine, table), _table_indexes(engine, shadow))
+    swap_tables(engine, table, shadow, index_names=index_names)
+    drop_old_versions(engine, table, keep_versions)
+
+def rollback_table(engine, table):
+    """Возвращает последнюю сохранённую версию таблицы.
+
+    Текущая версия сохраняется как {table}__rolled_back_<время>. Отпечатки
+    витрин при этом не меняются, поэтому следующий запуск стоит делать
+    с FORCE_MARTS=1.
+    """
+    versions = _table_versions(engine, table)
+    if not versions:
+        logger.warning(f"Нет сохранённых версий таблицы {table} для отката.")
+        return
+    rolled_back = f"{table}__rolled_back_{time.strftime('%Y%m%d%H%M%S')}"
+    execute_query(
+        engine,
+        f"""
+        ALTER TABLE IF EXISTS {table} RENAME TO {rolled_back};
+        ALTER TABLE {versions[0]} RENAME TO {table};
+        """,
+        f"Таблица {table} откачена к версии {versions[0]}.",
+        f"Ошибка при откате таблицы {table}"
+    )
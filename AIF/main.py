@@ -1,10 +1,15 @@
 import os
 import json
 import logging
+import argparse
 from config import config, yadisk_client, engine
-from database import load_to_database
-from query import rfm_analysis, cohort_analysis, calculate_cdr, transpon
-from utils import download_file, create_datasets, clean_local_files, shutdown
+from database import load_to_database, load_chunks_to_database
+from memory import fits_in_budget, start_tracing
+from metrics import start_run, stage, finish_run
+from profiling import PROFILE_MODES, configure as configure_profiling
+from query import calculate_events_hll, create_events_hll_views
+from scheduler import run_marts
+from utils import download_file, create_datasets, iter_datasets, clean_local_files, shutdown
 
 logger = logging.getLogger()
 
@@ -19,6 +24,52 @@ def check_token():
     except Exception as e:
         logger.error(f'Ошибка при проверке токена: {e}')
 
+def process_files(engine, local_path, local_files):
+    """Разбирает скачанные файлы, загружает их в базу и формирует витрины."""
+    budget_mb = config['memory_budget_mb']
+    if budget_mb and not fits_in_budget(local_files, budget_mb):
+        logging.info("Данные не помещаются в бюджет памяти. Загружаем их в базу по частям.")
+        with stage('load') as record:
+            record['rows_out'] = load_chunks_to_database(
+                engine, iter_datasets(local_path, budget_mb))
+            record['rows_in'] = record['rows_out']
+        loaded = record['rows_out'] > 0
+    else:
+        logging.info("Новые данные были скачаны. Формируем датафреймы.")
+        with stage('parse') as record:
+            new_orders_data, new_events_data = create_datasets(local_path)
+            record['rows_out'] = sum(
+                len(df) for df in (new_orders_data, new_events_data) if df is not None)
+        parsed_rows = record['rows_out']
+
+        loaded = new_orders_data is not None or new_events_data is not None
+        if loaded:
+            logging.info("Загрузка данных в базу.")
+            with stage('load', rows_in=parsed_rows) as record:
+                load_to_database(engine, new_orders_data, new_events_data, budget_mb)
+                record['rows_out'] = parsed_rows
+        # Датафреймы больше не нужны, освобождаем память до расчёта витрин.
+        del new_orders_data, new_events_data
+
+    if loaded:
+        if config['events_hll']:
+            try:
+                with stage('events_hll'):
+                    calculate_events_hll(engine)
+                    create_events_hll_views(engine)
+            except Exception as e:
+                logging.error(f"Ошибка при обновлении HLL-скетчей событий: {e}")
+        logging.info("Формируем витрины данных.")
+        # execute_query пробрасывает ошибки: сбой служебных таблиц витрин
+        # не должен помешать очистке скачанных файлов.
+        try:
+            with stage('marts'):
+                run_marts(engine, config)
+        except Exception as e:
+            logging.error(f"Ошибка при формировании витрин: {e}")
+    else:
+        logging.warning("Нет данных для загрузки в базу.")
+
 def extract_and_transform(y, local_path, hash_path, engine):
     """Управляет загрузкой и обработкой."""
     try:
@@ -31,56 +82,74 @@ def extract_and_transform(y, local_path, hash_path, engine):
             hash_data = {}
             new_data_downloaded = True
 
-        list_of_files = [i['path'] for i in y.listdir('AIF/all_files') if i['path'].endswith('.csv')]
+        with stage('list') as record:
+            list_of_files = [i['path'] for i in y.listdir('AIF/all_files') if i['path'].endswith('.csv')]
+            record['rows_out'] = len(list_of_files)
         logger.info("Список файлов на диске:")
         for file in list_of_files:
             logger.info(file)
 
         new_data_downloaded = False
-        for file in list_of_files:
-            file_name = os.path.basename(file)
-            file_path = os.path.join(local_path, file_name)
-            yadisk_file_hash = y.get_meta(file)['md5']
+        with stage('download', rows_in=len(list_of_files)) as record:
+            record['rows_out'] = record['bytes'] = 0
+            for file in list_of_files:
+                file_name = os.path.basename(file)
+                file_path = os.path.join(local_path, file_name)
+                yadisk_file_hash = y.get_meta(file)['md5']
 
-            if file_name not in hash_data or hash_data[file_name] != yadisk_file_hash:
-                logging.info(f"Файл {file_name} изменён или новый, скачиваем его.")
-                download_file(y, file, file_path)
-                hash_data[file_name] = yadisk_file_hash
-                new_data_downloaded = True
-            else:
-                logging.info(f"Файл {file_name} не изменён, пропускаем загрузку.")
+                if file_name not in hash_data or hash_data[file_name] != yadisk_file_hash:
+                    logging.info(f"Файл {file_name} изменён или новый, скачиваем его.")
+                    record['bytes'] += download_file(y, file, file_path)
+                    record['rows_out'] += 1
+                    hash_data[file_name] = yadisk_file_hash
+                    new_data_downloaded = True
+                else:
+                    logging.info(f"Файл {file_name} не изменён, пропускаем загрузку.")
 
         with open(hash_path, 'w') as f:
             json.dump(hash_data, f)
 
         if new_data_downloaded:
-            logging.info("Новые данные были скачаны. Формируем датафреймы.")
-            new_orders_data, new_events_data = create_datasets(local_path)
-
-            if new_orders_data is not None or new_events_data is not None:
-                logging.info("Загрузка данных в базу.")
-                load_to_database(engine, new_orders_data, new_events_data)
-                logging.info("Формируем витрины данных.")
-                rfm_analysis(engine)
-                cohort_analysis(engine)
-                calculate_cdr(engine)
-                transpon(engine)
-            else:
-                logging.warning("Нет данных для загрузки в базу.")
-
+            local_files = [
+                path for path in (os.path.join(local_path, os.path.basename(file)) for file in list_of_files)
+                if os.path.exists(path)
+            ]
+            process_files(engine, local_path, local_files)
             clean_local_files(list_of_files, local_path)
         else:
             logging.info("Новых файлов для загрузки нет.")
     except Exception as e:
         logging.error(f"Ошибка в процессе: {str(e)}")
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Загрузка данных AIF и расчёт витрин.")
+    parser.add_argument(
+        '--profile', 
+        choices=PROFILE_MODES, 
+        default=config['profile'],
+        help="профилировать этапы: cprofile (.prof) или sample (.folded для флейм-графов)"
+    )
+    parser.add_argument(
+        '--profile-dir', 
+        default=config['profile_dir'], 
+        help="каталог для файлов профилей"
+    )
+    return parser.parse_args()
+
 def main():
+    args = parse_args()
     
     local_path = config['local_path']
     hash_path = config['hash_path']
     
-    check_token()
-    extract_and_transform(yadisk_client, local_path, hash_path, engine)
+    start_tracing(config['memory_trace'])
+    run_id = start_run()
+    configure_profiling(args.profile, args.profile_dir, run_id, config['profile_interval_ms'])
+    try:
+        check_token()
+        extract_and_transform(yadisk_client, local_path, hash_path, engine)
+    finally:
+        finish_run(engine, config)
     shutdown()
 
 if __name__ == "__main__":
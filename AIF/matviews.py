@@ -0,0 +1,156 @@
+import time
+import hashlib
+import logging
+from database import execute_query
+from query import (
+    COHORT_HORIZON, _rfm_select, _rfm_thresholds_select, _cohort_metrics_select,
+    _pivot_select, cohort_pivot_spec, _cdr_select, _unpivot_select, transpon_spec
+)
+
+logger = logging.getLogger()
+
+# Широкие витрины: шаг планировщика -> (материализованное представление, mart для cohort_pivot_spec).
+PIVOT_MATVIEWS = {
+    'arppu': ('cohorts_revenue_arppu_data_mv', 'arppu'),
+    'arppu_cumulative': ('arppu_cumulative_mv', 'arppu_cumulative'),
+    'ltv_cohorts': ('ltv_cohorts_mv', 'ltv_cohorts'),
+    'cumulative_ltv': ('cumulative_ltv_mv', 'cumulative_ltv'),
+    'rr': ('rr_cohorts_mv', 'rr'),
+    'ac': ('ac_cohort_mv', 'ac'),
+}
+
+# Плоские витрины: шаг -> (представление, шаг-источник, mart для transpon_spec).
+TRANSPON_MATVIEWS = {
+    'transpon_ltv': ('ltv_t_mv', 'ltv_cohorts', 'ltv'),
+    'transpon_revenue': ('revenue_t_mv', 'ltv_cohorts', 'revenue'),
+    'transpon_cumulative_ltv': ('ltv_cum_t_mv', 'cumulative_ltv', 'cumulative_ltv'),
+    'transpon_arppu': ('arppu_t_mv', 'arppu', 'arppu'),
+    'transpon_cumulative_arppu': ('arppu_cum_t_mv', 'arppu_cumulative', 'cumulative_arppu'),
+    'transpon_rr': ('rr_t_mv', 'rr', 'rr'),
+    'transpon_ac': ('ac_t_mv', 'ac', 'ac'),
+}
+
+def matview_specs(config, horizon=COHORT_HORIZON):
+    """Возвращает описания материализованных представлений в порядке создания.
+
+    {шаг: {'name': представление, 'select': запрос или функция(engine),
+    'unique': столбцы уникального индекса}}. RFM на pandas и RR на битмапах
+    остаются таблицами.
+    """
+    specs = {}
+    if config['rfm_engine'] != 'pandas':
+        thresholds_cte = f"""
+    thresholds AS (
+        SELECT
+            {_rfm_thresholds_select(config['rfm_scoring'])}
+        FROM rfm_data
+    ),"""
+        rfm_ctes, rfm_select = _rfm_select('orders', thresholds_cte)
+        specs['rfm'] = {
+            'name': 'rfm_mv',
+            'select': rfm_ctes + rfm_select,
+            'unique': ('customer_id',),
+        }
+    specs['cohort_metrics'] = {
+        'name': 'cohort_metrics_mv',
+        'select': _cohort_metrics_select(horizon=horizon),
+        'unique': ('cohort_month', 'month'),
+    }
+    for step, (name, mart) in PIVOT_MATVIEWS.items():
+        if step == 'rr' and config['rr_engine'] == 'bitmap':
+            continue
+        spec = cohort_pivot_spec(mart, horizon)
+        specs[step] = {
+            'name': name,
+            'select': _pivot_select('cohort_metrics_mv', **spec),
+            'unique': (spec['key'][0][0],),
+        }
+    specs['cdr'] = {'name': 'cdr_mv', 'select': _cdr_select(), 'unique': ('month',)}
+    for step, (name, source, mart) in TRANSPON_MATVIEWS.items():
+        if source not in specs:
+            continue
+        spec = transpon_spec(mart)
+        specs[step] = {
+            'name': name,
+            # Столбцы источника известны только после его создания.
+            'select': lambda engine, source=specs[source]['name'], spec=spec:
+                _unpivot_select(engine, source, **spec),
+            'unique': ('cohort_month', 'month'),
+        }
+    return specs
+
+def _definition_hash(select):
+    return hashlib.md5(' '.join(select.split()).encode()).hexdigest()
+
+def _stored_hash(engine, name):
+    data, _ = execute_query(
+        engine,
+        f"SELECT obj_description(to_regclass('{name}'), 'pg_class');",
+        error_message=f"Ошибка при чтении описания представления {name}",
+        fetch_results=True
+    )
+    return data[0][0] if data else None
+
+def create_matviews(engine, config, horizon=COHORT_HORIZON):
+    """Создаёт материализованные представления витрин без данных.
+
+    Хеш запроса хранится в комментарии представления; если определение
+    изменилось (например, горизонт), представление пересоздаётся вместе
+    с зависимыми. Возвращает {шаг: (представление, хеш)}.
+    """
+    created = {}
+    for step, spec in matview_specs(config, horizon).items():
+        name = spec['name']
+        select = spec['select']
+        if callable(select):
+            select = select(engine)
+            if select is None:
+                logger.warning(f"Представление {name} не создано: нет помесячных столбцов.")
+                continue
+        definition = _definition_hash(select)
+        stored = _stored_hash(engine, name)
+        if stored == definition:
+            created[step] = (name, definition)
+            continue
+        if stored is not None:
+            logger.info(f"Определение представления {name} изменилось, пересоздаём.")
+        unique = ", ".join(spec['unique'])
+        create_query = f"""
+        DROP MATERIALIZED VIEW IF EXISTS {name} CASCADE;
+        CREATE MATERIALIZED VIEW {name} AS
+        {select}
+        WITH NO DATA;
+        CREATE UNIQUE INDEX {name}_key ON {name} ({unique});
+        COMMENT ON MATERIALIZED VIEW {name} IS '{definition}';
+        """
+        execute_query(
+            engine,
+            create_query,
+            f"Представление {name} успешно создано.",
+            f"Ошибка при создании представления {name}"
+        )
+        created[step] = (name, definition)
+    return created
+
+def refresh_matview(engine, name):
+    """Обновляет материализованное представление.
+
+    Заполненное представление обновляется CONCURRENTLY по уникальному
+    индексу и остаётся доступным для чтения; первое заполнение — обычным
+    REFRESH.
+    """
+    data, _ = execute_query(
+        engine,
+        f"SELECT ispopulated FROM pg_matviews WHERE matviewname = '{name}';",
+        error_message=f"Ошибка при чтении состояния представления {name}",
+        fetch_results=True
+    )
+    populated = bool(data and data[0][0])
+    concurrently = "CONCURRENTLY " if populated else ""
+    started = time.perf_counter()
+    execute_query(
+        engine,
+        f"REFRESH MATERIALIZED VIEW {concurrently}{name};",
+        error_message=f"Ошибка при обновлении представления {name}"
+    )
+    logger.info(f"Представление {name} обновлено за {time.perf_counter() - started:.1f} с.")
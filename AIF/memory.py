@@ -0,0 +1,136 @@
+import io
+import os
+import gc
+import logging
+import resource
+import itertools
+import tracemalloc
+import pandas as pd
+
+logger = logging.getLogger()
+
+MB = 1024 * 1024
+# Строк в пробной выборке для оценки размера датафрейма.
+SAMPLE_ROWS = 10000
+# Во сколько раз пиковая память при разборе и загрузке превышает размер
+# датафрейма: буферы парсера, копии при concat и строки для executemany.
+WORKING_FACTOR = 3
+MIN_CHUNK_ROWS = 1000
+MAX_CHUNK_ROWS = 1000000
+
+def current_rss_mb():
+    """Возвращает текущий RSS процесса в МБ."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / MB
+    except (OSError, ValueError, IndexError):
+        return peak_rss_mb()
+
+def peak_rss_mb():
+    """Возвращает максимальный RSS процесса с последнего reset_peak в МБ."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    # Вне Linux доступен только пик за всё время жизни процесса.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def reset_peak():
+    """Сбрасывает максимум RSS (Linux) и пик tracemalloc."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+
+def traced_peak_mb():
+    """Возвращает пик памяти, выделенной Python, если включён tracemalloc."""
+    if not tracemalloc.is_tracing():
+        return None
+    return tracemalloc.get_traced_memory()[1] / MB
+
+def start_tracing(enabled):
+    """Включает tracemalloc. Замедляет Python-код, поэтому только по MEMORY_TRACE=1."""
+    if enabled and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        logger.info("Отслеживание памяти tracemalloc включено.")
+
+def _sample_sizes(file_path):
+    """Оценивает по первым строкам файла размер строки на диске и в памяти."""
+    with open(file_path, 'rb') as f:
+        head = list(itertools.islice(f, SAMPLE_ROWS + 1))
+    if len(head) < 2:
+        return None, None
+    raw_row = sum(len(line) for line in head[1:]) / (len(head) - 1)
+    sample = pd.read_csv(
+        io.BytesIO(b''.join(head)), sep=';', low_memory=False, on_bad_lines='skip')
+    if sample.empty:
+        return None, None
+    memory_row = sample.memory_usage(deep=True, index=False).sum() / len(sample)
+    return raw_row, memory_row
+
+def estimate_frame_mb(file_path):
+    """Оценивает размер датафрейма из CSV-файла в МБ."""
+    raw_row, memory_row = _sample_sizes(file_path)
+    if raw_row is None:
+        return 0.0
+    return os.path.getsize(file_path) / raw_row * memory_row / MB
+
+def available_mb(budget_mb):
+    return budget_mb - current_rss_mb()
+
+def fits_in_budget(files, budget_mb):
+    """Проверяет, поместятся ли все файлы в память целиком с запасом WORKING_FACTOR."""
+    estimated = sum(estimate_frame_mb(file) for file in files)
+    available = available_mb(budget_mb)
+    fits = estimated * WORKING_FACTOR <= available
+    logger.info(
+        f"Оценка датафреймов: {estimated:.0f} МБ, доступно {available:.0f} МБ "
+        f"из бюджета {budget_mb} МБ — "
+        + ("загружаем целиком." if fits else "загружаем по частям.")
+    )
+    return fits
+
+def _chunk_rows(row_bytes, budget_mb):
+    available = available_mb(budget_mb)
+    if available <= 0:
+        logger.warning(f"RSS уже превышает бюджет памяти {budget_mb} МБ, "
+                       f"чанк уменьшен до {MIN_CHUNK_ROWS} строк.")
+        return MIN_CHUNK_ROWS
+    rows = int(available * MB / (row_bytes * WORKING_FACTOR))
+    return max(MIN_CHUNK_ROWS, min(MAX_CHUNK_ROWS, rows))
+
+def file_chunk_rows(file_path, budget_mb):
+    """Подбирает число строк в чанке чтения файла под бюджет памяти."""
+    _, memory_row = _sample_sizes(file_path)
+    if memory_row is None:
+        return MAX_CHUNK_ROWS
+    rows = _chunk_rows(memory_row, budget_mb)
+    logger.info(f"{os.path.basename(file_path)}: ~{memory_row:.0f} байт на строку в памяти, "
+                f"чанк {rows} строк.")
+    return rows
+
+def frame_chunk_rows(df, budget_mb):
+    """Подбирает chunksize для to_sql датафрейма под бюджет памяти."""
+    if df is None or df.empty:
+        return None
+    row_bytes = df.memory_usage(deep=True, index=False).sum() / len(df)
+    rows = _chunk_rows(row_bytes, budget_mb)
+    logger.info(f"Запись по {rows} строк (~{row_bytes:.0f} байт на строку).")
+    return rows
+
+def shrink_if_over_budget(rows, budget_mb):
+    """Вдвое уменьшает чанк, если после очередного чанка RSS вышел за бюджет."""
+    if current_rss_mb() <= budget_mb or rows <= MIN_CHUNK_ROWS:
+        return rows
+    gc.collect()
+    smaller = max(MIN_CHUNK_ROWS, rows // 2)
+    logger.warning(f"RSS {current_rss_mb():.0f} МБ превышает бюджет {budget_mb} МБ, "
+                   f"чанк уменьшен с {rows} до {smaller} строк.")
+    return smaller
@@ -0,0 +1,258 @@
+import os
+import json
+import time
+import logging
+import resource
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+from database import execute_query, count_rows
+from memory import reset_peak, peak_rss_mb, traced_peak_mb
+from profiling import profile_stage
+
+logger = logging.getLogger()
+
+# Метрики текущего запуска: этапы дописываются из потоков планировщика.
+# active — число выполняющихся этапов, пик памяти сбрасывается, только когда их нет.
+_lock = threading.Lock()
+_run = {'run_id': None, 'started_at': None, 'started': None, 'stages': [], 'active': 0}
+
+def start_run(run_id=None):
+    """Начинает новый запуск и возвращает его идентификатор."""
+    started_at = datetime.now()
+    with _lock:
+        _run['run_id'] = run_id or started_at.strftime('%Y%m%d%H%M%S')
+        _run['started_at'] = started_at
+        _run['started'] = time.perf_counter()
+        _run['stages'] = []
+    return _run['run_id']
+
+def current_run_id():
+    return _run['run_id']
+
+@contextmanager
+def stage(name, rows_in=None):
+    """Замеряет этап пайплайна.
+
+    Отдаёт словарь, в который вызывающий код может записать rows_in,
+    rows_out и bytes. Если rows_out не задан, берётся число строк,
+    изменённых запросами этапа. CPU — время потока этапа, без работы
+    сервера БД и потоков шардов. Пик RSS (и tracemalloc при MEMORY_TRACE=1)
+    общий для процесса: у параллельных шагов витрин он общий на все
+    одновременно идущие шаги. Если включено профилирование, этап
+    профилируется (см. profiling.configure).
+    """
+    record = {
+        'stage': name,
+        'started_at': datetime.now(),
+        'rows_in': rows_in,
+        'rows_out': None,
+        'bytes': None,
+        'status': 'ok',
+    }
+    with _lock:
+        if not _run['active']:
+            reset_peak()
+        _run['active'] += 1
+    wall = time.perf_counter()
+    cpu = time.thread_time()
+    try:
+        with count_rows() as counted, profile_stage(name):
+            yield record
+    except BaseException:
+        record['status'] = 'failed'
+        raise
+    finally:
+        record['wall_seconds'] = round(time.perf_counter() - wall, 3)
+        record['cpu_seconds'] = round(time.thread_time() - cpu, 3)
+        record['rss_peak_mb'] = round(peak_rss_mb(), 1)
+        traced = traced_peak_mb()
+        record['traced_peak_mb'] = round(traced, 1) if traced is not None else None
+        if record['rows_out'] is None and counted['rows']:
+            record['rows_out'] = counted['rows']
+        rows = record['rows_out'] or record['rows_in']
+        record['rows_per_sec'] = (
+            round(rows / record['wall_seconds'], 1) if rows and record['wall_seconds'] > 0 else None
+        )
+        with _lock:
+            _run['active'] -= 1
+            _run['stages'].append(record)
+        logger.info(
+            f"Этап {name}: {record['wall_seconds']:.1f} с, CPU {record['cpu_seconds']:.1f} с"
+            + (f", строк {rows}" if rows else "")
+            + (f", {record['rows_per_sec']:.0f} строк/с" if record['rows_per_sec'] else "")
+            + f", пик RSS {record['rss_peak_mb']:.0f} МБ"
+        )
+
+def create_pipeline_runs_table(engine):
+    """Создает журнал запусков пайплайна."""
+    create_table_query = """
+    CREATE TABLE IF NOT EXISTS pipeline_runs (
+        run_id TEXT,
+        stage TEXT,
+        started_at TIMESTAMP,
+        wall_seconds DOUBLE PRECISION,
+        cpu_seconds DOUBLE PRECISION,
+        rows_in BIGINT,
+        rows_out BIGINT,
+        bytes BIGINT,
+        rows_per_sec DOUBLE PRECISION,
+        status TEXT,
+        rss_peak_mb DOUBLE PRECISION,
+        traced_peak_mb DOUBLE PRECISION,
+        PRIMARY KEY (run_id, stage)
+    );
+    ALTER TABLE pipeline_runs ADD COLUMN IF NOT EXISTS rss_peak_mb DOUBLE PRECISION;
+    ALTER TABLE pipeline_runs ADD COLUMN IF NOT EXISTS traced_peak_mb DOUBLE PRECISION;
+    """
+    execute_query(
+        engine,
+        create_table_query,
+        "Таблица pipeline_runs успешно создана.",
+        "Ошибка при создании таблицы pipeline_runs"
+    )
+
+def _sql_value(value):
+    if value is None:
+        return "NULL"
+    if isinstance(value, datetime):
+        return f"TIMESTAMP '{value.isoformat(sep=' ')}'"
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    return repr(value)
+
+def _records(status):
+    """Возвращает этапы запуска и итоговую строку 'run'."""
+    with _lock:
+        stages = list(_run['stages'])
+    if status is None:
+        status = 'failed' if any(s['status'] == 'failed' for s in stages) else 'ok'
+    total = {
+        'stage': 'run',
+        'started_at': _run['started_at'],
+        'wall_seconds': round(time.perf_counter() - _run['started'], 3),
+        'cpu_seconds': round(time.process_time(), 3),
+        'rows_in': None,
+        'rows_out': None,
+        'bytes': sum(s['bytes'] or 0 for s in stages) or None,
+        'rows_per_sec': None,
+        'status': status,
+        # Пик за всё время жизни процесса, без сбросов между этапами.
+        'rss_peak_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'traced_peak_mb': None,
+    }
+    return stages + [total]
+
+def save_run(engine, records):
+    """Записывает метрики запуска в pipeline_runs."""
+    columns = (
+        'stage', 'started_at', 'wall_seconds', 'cpu_seconds', 'rows_in',
+        'rows_out', 'bytes', 'rows_per_sec', 'status', 'rss_peak_mb', 'traced_peak_mb'
+    )
+    values = ",\n        ".join(
+        f"({_sql_value(_run['run_id'])}, "
+        + ", ".join(_sql_value(r[c]) for c in columns) + ")"
+        for r in records
+    )
+    insert_query = f"""
+    INSERT INTO pipeline_runs (run_id, {', '.join(columns)})
+    VALUES
+        {values}
+    ON CONFLICT (run_id, stage) DO UPDATE SET
+        {', '.join(f'{c} = EXCLUDED.{c}' for c in columns[1:])};
+    """
+    execute_query(
+        engine,
+        insert_query,
+        f"Метрики запуска {_run['run_id']} записаны в pipeline_runs.",
+        "Ошибка при записи метрик запуска"
+    )
+
+def _write_atomic(path, content):
+    # node_exporter может прочитать файл в момент записи, поэтому через rename.
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+PROMETHEUS_METRICS = (
+    ('wall_seconds', 'aif_stage_wall_seconds', 'Wall time of the pipeline stage.'),
+    ('cpu_seconds', 'aif_stage_cpu_seconds', 'CPU time of the pipeline stage thread.'),
+    ('rows_in', 'aif_stage_rows_in', 'Rows read by the pipeline stage.'),
+    ('rows_out', 'aif_stage_rows_out', 'Rows written by the pipeline stage.'),
+    ('bytes', 'aif_stage_bytes', 'Bytes downloaded by the pipeline stage.'),
+    ('rows_per_sec', 'aif_stage_rows_per_second', 'Throughput of the pipeline stage.'),
+    ('rss_peak_mb', 'aif_stage_rss_peak_megabytes', 'Peak process RSS during the pipeline stage.'),
+    ('traced_peak_mb', 'aif_stage_traced_peak_megabytes', 
+     'Peak Python allocations during the pipeline stage (tracemalloc).'),
+)
+
+def write_prometheus(path, records):
+    """Пишет метрики запуска в textfile для node_exporter."""
+    stages = [r for r in records if r['stage'] != 'run']
+    total = records[-1]
+    lines = []
+    for key, metric, help_text in PROMETHEUS_METRICS:
+        lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} gauge"]
+        for r in stages:
+            if r[key] is not None:
+                lines.append(f'{metric}{{stage="{r["stage"]}"}} {r[key]}')
+    lines += [
+        "# HELP aif_stage_success Whether the pipeline stage succeeded.",
+        "# TYPE aif_stage_success gauge",
+    ]
+    lines += [
+        f'aif_stage_success{{stage="{r["stage"]}"}} {int(r["status"] == "ok")}' for r in stages
+    ]
+    lines += [
+        "# HELP aif_run_duration_seconds Wall time of the last pipeline run.",
+        "# TYPE aif_run_duration_seconds gauge",
+        f"aif_run_duration_seconds {total['wall_seconds']}",
+        "# HELP aif_run_rss_peak_megabytes Peak process RSS of the last pipeline run.",
+        "# TYPE aif_run_rss_peak_megabytes gauge",
+        f"aif_run_rss_peak_megabytes {total['rss_peak_mb']}",
+        "# HELP aif_run_success Whether the last pipeline run succeeded.",
+        "# TYPE aif_run_success gauge",
+        f"aif_run_success {int(total['status'] == 'ok')}",
+        "# HELP aif_run_last_timestamp_seconds Unix time the last pipeline run finished.",
+        "# TYPE aif_run_last_timestamp_seconds gauge",
+        f"aif_run_last_timestamp_seconds {time.time():.0f}",
+    ]
+    _write_atomic(path, "\n".join(lines) + "\n")
+    logger.info(f"Метрики запуска записаны в {path}.")
+
+def write_json(path, records):
+    """Пишет метрики запуска в JSON."""
+    report = {
+        'run_id': _run['run_id'],
+        'stages': [
+            {**r, 'started_at': r['started_at'].isoformat() if r['started_at'] else None}
+            for r in records
+        ],
+    }
+    _write_atomic(path, json.dumps(report, ensure_ascii=False, indent=2))
+    logger.info(f"Метрики запуска записаны в {path}.")
+
+def finish_run(engine, config, status=None):
+    """Завершает запуск: пишет pipeline_runs и файлы экспорта.
+
+    Статус по умолчанию — failed, если упал хотя бы один этап. Ошибки
+    записи метрик не прерывают пайплайн. Возвращает записи этапов.
+    """
+    if _run['run_id'] is None:
+        return
+    records = _records(status)
+    try:
+        create_pipeline_runs_table(engine)
+        save_run(engine, records)
+    except Exception as e:
+        logger.error(f"Не удалось записать метрики запуска в базу: {e}")
+    for path, writer in ((config['metrics_textfile'], write_prometheus),
+                         (config['metrics_json'], write_json)):
+        if not path:
+            continue
+        try:
+            writer(path, records)
+        except OSError as e:
+            logger.error(f"Не удалось записать метрики в {path}: {e}")
+    return records
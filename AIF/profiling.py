@@ -0,0 +1,103 @@
+import os
+import sys
+import logging
+import cProfile
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+logger = logging.getLogger()
+
+PROFILE_MODES = ('cprofile', 'sample')
+
+# Режим профилирования этапов: задаётся один раз при старте через configure.
+_profiler = {'mode': None, 'directory': None, 'prefix': '', 'interval': 0.01}
+
+def configure(mode, directory, prefix='', interval_ms=10):
+    """Включает профилирование этапов пайплайна.
+
+    mode — 'cprofile' (детерминированный, файлы .prof для snakeviz и
+    flameprof) или 'sample' (сэмплер стеков потока этапа, файлы .folded
+    для flamegraph.pl и speedscope); None выключает профилирование.
+    """
+    if mode is not None and mode not in PROFILE_MODES:
+        raise ValueError(f"Неизвестный режим профилирования: {mode}")
+    _profiler['mode'] = mode
+    _profiler['directory'] = directory
+    _profiler['prefix'] = prefix
+    _profiler['interval'] = interval_ms / 1000
+    if mode is not None:
+        os.makedirs(directory, exist_ok=True)
+        logger.info(f"Профилирование этапов ({mode}) включено, файлы в {directory}.")
+
+def _profile_path(name, extension):
+    file_name = "_".join(part for part in (_profiler['prefix'], name.replace(':', '_')) if part)
+    return os.path.join(_profiler['directory'], f"{file_name}.{extension}")
+
+def _frame_stack(frame):
+    """Возвращает стек кадра от корня в формате folded: 'f1;f2;f3'."""
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+@contextmanager
+def _deterministic(path):
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as e:
+        # Начиная с Python 3.12 в процессе активен только один профилировщик.
+        logger.warning(f"Профиль {path} не снят: {e}")
+        profiler = None
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(path)
+            logger.info(f"Профиль записан в {path}.")
+
+@contextmanager
+def _sampled(path, interval):
+    """Снимает стеки текущего потока с интервалом interval из отдельного потока.
+
+    Время ожидания ответа Postgres видно как стеки, заканчивающиеся
+    в драйвере БД, время pandas и SQLAlchemy — в их функциях.
+    """
+    thread_id = threading.get_ident()
+    counts = Counter()
+    stop = threading.Event()
+
+    def sample():
+        while not stop.wait(interval):
+            frame = sys._current_frames().get(thread_id)
+            if frame is not None:
+                counts[_frame_stack(frame)] += 1
+
+    sampler = threading.Thread(target=sample, name=f"sampler-{thread_id}", daemon=True)
+    sampler.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        sampler.join()
+        with open(path, 'w') as f:
+            for stack, count in counts.most_common():
+                f.write(f"{stack} {count}\n")
+        logger.info(f"Профиль записан в {path}: {sum(counts.values())} сэмплов.")
+
+@contextmanager
+def _noop():
+    yield
+
+def profile_stage(name):
+    """Профилирует этап name в выбранном режиме; без режима ничего не делает."""
+    mode = _profiler['mode']
+    if mode == 'cprofile':
+        return _deterministic(_profile_path(name, 'prof'))
+    if mode == 'sample':
+        return _sampled(_profile_path(name, 'folded'), _profiler['interval'])
+    return _noop()
@@ -1,17 +1,125 @@
+import re
 import logging
-from sqlalchemy import text
-from database import execute_query
+from datetime import date
+from database import (
+    execute_query, run_parallel, create_watermarks_table, get_watermark, 
+    set_watermark, get_max_batch, batch_watermark, batch_filter,
+    LOAD_BATCH_COLUMN
+)
 
 logger = logging.getLogger()
 
-def rfm_analysis(
-    engine, 
-    input_table='orders', 
-    output_table='rfm', 
-    date_format='DD.MM.YYYY HH24:MI'
-    ):
-    """Формирует таблицу RFM."""
+RFM_SEGMENTS = {
+    'VIP': (
+        '444', '443', '344'),
+    'Постоянные': (
+        '442', '441', '434', '433', '432', 
+        '331', '332', '343', '342', '334'),
+    'Новые': (
+        '431', '424', '423', '422', '421', 
+        '414', '413', '412', '411'),
+    'Высокий потенциал': (
+        '341', '333', '324', '323', '322', 
+        '243'),
+    'Малоактивные': (
+        '321', '314', '313', '312', '311', 
+        '241', '232', '222', '221', '214', 
+        '213', '212', '211', '142', '141'),
+    'Спящие': (
+        '234', '233', '242', '244', '144', 
+        '224', '223', '143'),
+    'Потерянные': (
+        '134', '133', '132', 
+        '131', '124', '123', 
+        '122', '121', '114', 
+        '113', '112', '111'),
+}
+
+RFM_SCORING = ('stddev', 'quantile')
+
+COHORT_HORIZON = 12
+
+def _as_of_date(as_of=None):
+    """Возвращает SQL-выражение даты расчёта: литерал DATE или CURRENT_DATE."""
+    if as_of is None:
+        return "CURRENT_DATE"
+    return f"DATE '{date.fromisoformat(str(as_of)[:10]).isoformat()}'"
+
+def _rfm_segments_case(column):
+    """Собирает CASE для сопоставления rfm_group с сегментом."""
+    branches = []
+    for name, groups in RFM_SEGMENTS.items():
+        rows = [
+            ", ".join(f"'{g}'" for g in groups[i:i + 5])
+            for i in range(0, len(groups), 5)
+        ]
+        values = ", \n                ".join(rows)
+        branches.append(
+            f"            WHEN {column} IN (\n"
+            f"                {values}) \n"
+            f"                    THEN '{name}'"
+        )
+    branches = "\n".join(branches)
+    return f"""CASE
+{branches}
+            ELSE NULL
+        END"""
+
+def _rfm_thresholds_select(scoring):
+    """Возвращает выражения порогов RFM для выбранного способа скоринга."""
+    if scoring == 'stddev':
+        def bounds(col):
+            return (
+                f"AVG({col}) - STDDEV({col})",
+                f"AVG({col})",
+                f"AVG({col}) + STDDEV({col})"
+            )
+    elif scoring == 'quantile':
+        def bounds(col):
+            return tuple(
+                f"PERCENTILE_CONT({q}) WITHIN GROUP (ORDER BY {col})"
+                for q in ('0.25', '0.5', '0.75')
+            )
+    else:
+        raise ValueError(
+            f"Неизвестный способ скоринга RFM: {scoring}. "
+            f"Допустимые значения: {', '.join(RFM_SCORING)}")
+
+    columns = []
+    for col in ('recency_days', 'frequency', 'monetary'):
+        low, mid, high = bounds(col)
+        metric = col.split('_')[0]
+        columns += [
+            f"{low} AS {metric}_low",
+            f"{mid} AS {metric}_mid",
+            f"{high} AS {metric}_high",
+        ]
+    return ",\n            ".join(columns)
+
+def _rfm_scores_select(data, thresholds):
+    """Собирает выражения recency/frequency/monetary_score по порогам."""
+    d, t = data, thresholds
+    return f"""CASE
+                WHEN {d}.recency_days <= {t}.recency_low THEN 4
+                WHEN {d}.recency_days <= {t}.recency_mid THEN 3
+                WHEN {d}.recency_days <= {t}.recency_high THEN 2
+                ELSE 1
+            END AS recency_score,
+            CASE
+                WHEN {d}.frequency >= {t}.frequency_high THEN 4
+                WHEN {d}.frequency >= {t}.frequency_mid THEN 3
+                WHEN {d}.frequency >= {t}.frequency_low THEN 2
+                ELSE 1
+            END AS frequency_score,
+            CASE
+                WHEN {d}.monetary >= {t}.monetary_high THEN 4
+                WHEN {d}.monetary >= {t}.monetary_mid THEN 3
+                WHEN {d}.monetary >= {t}.monetary_low THEN 2
+                ELSE 1
+            END AS monetary_score"""
 
+def create_rfm_tables(engine, output_table='rfm', thresholds_table='rfm_thresholds'):
+    """Создает таблицу RFM и таблицу порогов скоринга."""
     create_table_query = f"""
     CREATE TABLE IF NOT EXISTS {output_table} (
         customer_id BIGINT,
@@ -33,20 +141,50 @@ def rfm_analysis(
         f"Таблица {output_table} успешно создана.",
         "Ошибка при создании таблицы RFM"
     )
-    insert_rfm_query = f"""
-    INSERT INTO {output_table} (
-        customer_id, 
-        recency_days, 
-        frequency, 
-        monetary, 
-        recency_score, 
-        frequency_score, 
-        monetary_score, 
-        rfm_group, 
-        percent_rfm,
-        cats
+    create_thresholds_query = f"""
+    CREATE TABLE IF NOT EXISTS {thresholds_table} (
+        scoring TEXT,
+        reference_date DATE,
+        customers BIGINT,
+        recency_low NUMERIC,
+        recency_mid NUMERIC,
+        recency_high NUMERIC,
+        frequency_low NUMERIC,
+        frequency_mid NUMERIC,
+        frequency_high NUMERIC,
+        monetary_low NUMERIC,
+        monetary_mid NUMERIC,
+        monetary_high NUMERIC,
+        computed_at TIMESTAMP DEFAULT NOW(),
+        PRIMARY KEY (scoring)
+    );
+    """
+    execute_query(
+        engine, 
+        create_thresholds_query,
+        f"Таблица {thresholds_table} успешно создана.",
+        "Ошибка при создании таблицы порогов RFM"
     )
-    WITH rfm_data AS (
+
+def _rfm_data_select(input_table, 
+                     date_format='DD.MM.YYYY HH24:MI', 
+                     as_of=None, 
+                     where=""):
+    """Возвращает выборку recency/frequency/monetary по оплаченным заказам.
+
+    Давность считается от as_of, заказы после as_of не учитываются;
+    where — дополнительное условие на заказы (например, шард клиентов).
+    """
+    as_of_date = _as_of_date(as_of)
+    as_of_filter = ""
+    if as_of is not None:
+        as_of_filter = f"""
+            AND TO_TIMESTAMP(
+                "OrderFirstActionDateTimeUtc", '{date_format}') < {as_of_date} + 1"""
+    if where:
+        as_of_filter += f"""
+            AND {where}"""
+    return f"""
         SELECT
             "OrderCustomerIdsMindboxId" AS customer_id,
             MAX(TO_TIMESTAMP(
@@ -54,59 +192,46 @@ def rfm_analysis(
                 '{date_format}')) 
                     AS last_order_date,
             EXTRACT(DAY FROM (
-                CURRENT_DATE - MAX(TO_TIMESTAMP(
+                {as_of_date} - MAX(TO_TIMESTAMP(
                     "OrderFirstActionDateTimeUtc", '{date_format}')))) 
                         AS recency_days,
             COUNT(*) AS frequency,
-            SUM("OrderTotalPrice") AS monetary
+            SUM("OrderTotalPrice"::NUMERIC) AS monetary
         FROM 
             {input_table}
         WHERE 
-            "OrderLineStatusIdsExternalId" = 'Paid'
+            "OrderLineStatusIdsExternalId" = 'Paid'{as_of_filter}
         GROUP BY 
             "OrderCustomerIdsMindboxId"
-    ),
+    """
+
+def _rfm_select(input_table, 
+                thresholds_cte, 
+                date_format='DD.MM.YYYY HH24:MI', 
+                as_of=None, 
+                rfm_data=None):
+    """Возвращает CTE и итоговый SELECT расчёта RFM.
+
+    thresholds_cte должен определять CTE thresholds по rfm_data; он может
+    быть изменяющим данные, поэтому INSERT ставится между CTE и SELECT.
+    rfm_data заменяет выборку _rfm_data_select, например чтением из
+    заранее собранной таблицы.
+    """
+    if rfm_data is None:
+        rfm_data = _rfm_data_select(input_table, date_format, as_of)
+    ctes = f"""
+    WITH rfm_data AS MATERIALIZED ({rfm_data}),{thresholds_cte}
     rfm_scores AS (
         SELECT
-            customer_id,
-            recency_days,
-            frequency,
-            monetary,
-            CASE
-                WHEN recency_days <= (SELECT AVG(
-                    recency_days) FROM rfm_data) - (SELECT STDDEV(
-                        recency_days) FROM rfm_data) THEN 4
-                WHEN recency_days <= (SELECT AVG(
-                    recency_days) FROM rfm_data) THEN 3
-                WHEN recency_days <= (SELECT AVG(
-                    recency_days) FROM rfm_data) + (SELECT STDDEV(
-                        recency_days) FROM rfm_data) THEN 2
-                ELSE 1
-            END AS recency_score,
-            CASE
-                WHEN frequency >= (SELECT AVG(
-                    frequency) FROM rfm_data) + (SELECT STDDEV(
-                        frequency) FROM rfm_data) THEN 4
-                WHEN frequency >= (SELECT AVG(
-                    frequency) FROM rfm_data) THEN 3
-                WHEN frequency >= (SELECT AVG(
-                    frequency) FROM rfm_data) - (SELECT STDDEV(
-                        frequency) FROM rfm_data) THEN 2
-                ELSE 1
-            END AS frequency_score,
-            CASE
-                WHEN monetary >= (SELECT AVG(
-                    monetary) FROM rfm_data) + (SELECT STDDEV(
-                        monetary) FROM rfm_data) THEN 4
-                WHEN monetary >= (SELECT AVG(
-                    monetary) FROM rfm_data) THEN 3
-                WHEN monetary >= (SELECT AVG(
-                    monetary) FROM rfm_data) - (SELECT STDDEV(
-                        monetary) FROM rfm_data) THEN 2
-                ELSE 1
-            END AS monetary_score
+            d.customer_id,
+            d.recency_days,
+            d.frequency,
+            d.monetary,
+            {_rfm_scores_select('d', 't')}
         FROM
-            rfm_data
+            rfm_data d
+        CROSS JOIN
+            thresholds t
     ),
     rfm_grouped AS (
         SELECT
@@ -135,7 +260,8 @@ def rfm_analysis(
             rfm_grouped
         GROUP BY
             rfm_group
-    )
+    )"""
+    select = f"""
     SELECT
         rg.customer_id,
         rg.recency_days,
@@ -146,43 +272,133 @@ def rfm_analysis(
         rg.monetary_score,
         rg.rfm_group,
         rp.percent_rfm,
-        CASE
-            WHEN rg.rfm_group IN (
-                '444', '443', '344') 
-                    THEN 'VIP'
-            WHEN rg.rfm_group IN (
-                '442', '441', '434', '433', '432', 
-                '331', '332', '343', '342', '334') 
-                    THEN 'Постоянные'
-            WHEN rg.rfm_group IN (
-                '431', '424', '423', '422', '421', 
-                '414', '413', '412', '411') 
-                    THEN 'Новые'
-            WHEN rg.rfm_group IN (
-                '341', '333', '324', '323', '322', 
-                '243') 
-                    THEN 'Высокий потенциал'
-            WHEN rg.rfm_group IN (
-                '321', '314', '313', '312', '311', 
-                '241', '232', '222', '221', '214', 
-                '213', '212', '211', '142', '141') 
-                    THEN 'Малоактивные'
-            WHEN rg.rfm_group IN (
-                '234', '233', '242', '244', '144', 
-                '224', '223', '143') 
-                    THEN 'Спящие'
-            WHEN rg.rfm_group IN (
-                '134', '133', '132', 
-                '131', '124', '123', 
-                '122', '121', '114', 
-                '113', '112', '111') 
-                    THEN 'Потерянные'
-            ELSE NULL
-        END AS cats
+        {_rfm_segments_case('rg.rfm_group')} AS cats
     FROM
         rfm_grouped rg
     LEFT JOIN
-        rfm_percentages rp ON rg.rfm_group = rp.rfm_group
+        rfm_percentages rp ON rg.rfm_group = rp.rfm_group"""
+    return ctes, select
+
+def rfm_analysis(
+    engine, 
+    input_table='orders', 
+    output_table='rfm', 
+    thresholds_table='rfm_thresholds',
+    scoring='stddev',
+    refresh_thresholds=True,
+    incremental=False,
+    drift_tolerance=0.05,
+    max_reference_age_days=30,
+    date_format='DD.MM.YYYY HH24:MI',
+    as_of=None,
+    shards=1
+    ):
+    """Формирует таблицу RFM на дату as_of (по умолчанию — текущую).
+
+    Статистики распределения считаются один раз за запуск и сохраняются
+    в thresholds_table (по строке на способ скоринга): 'stddev' — среднее
+    ± стандартное отклонение, 'quantile' — квартили. С refresh_thresholds=False
+    используются ранее сохранённые пороги.
+
+    С incremental=True пересчитываются только клиенты с новыми оплаченными
+    заказами, а все клиенты переоцениваются лишь при дрейфе порогов больше
+    drift_tolerance или если пороги старше max_reference_age_days.
+    Инкрементальный режим учитывает все загруженные заказы, поэтому с явной
+    as_of витрина пересчитывается целиком.
+
+    С shards > 1 агрегаты по клиентам считаются shards параллельными
+    запросами по остатку от деления идентификатора клиента и собираются
+    в промежуточной таблице; пороги и скоринг считаются по ней одним запросом.
+    """
+    thresholds_select = _rfm_thresholds_select(scoring)
+    as_of_date = _as_of_date(as_of)
+
+    create_rfm_tables(engine, output_table, thresholds_table)
+
+    if incremental and as_of is not None:
+        logger.warning(f"{output_table}: инкрементальный режим не поддерживает as_of, "
+                       f"витрина пересчитывается целиком.")
+    elif incremental:
+        _rfm_incremental(
+            engine, input_table, output_table, thresholds_table, scoring,
+            drift_tolerance, max_reference_age_days, date_format
+        )
+        return
+
+    if refresh_thresholds:
+        # Пороги пересчитываются в том же запросе, что и скоринг:
+        # rfm_data материализуется один раз и читается обоими шагами.
+        thresholds_cte = f"""
+    thresholds AS (
+        INSERT INTO {thresholds_table} (
+            scoring, reference_date, customers,
+            recency_low, recency_mid, recency_high,
+            frequency_low, frequency_mid, frequency_high,
+            monetary_low, monetary_mid, monetary_high,
+            computed_at
+        )
+        SELECT
+            '{scoring}',
+            {as_of_date},
+            COUNT(*),
+            {thresholds_select},
+            NOW()
+        FROM rfm_data
+        ON CONFLICT (scoring) DO UPDATE SET
+            reference_date = EXCLUDED.reference_date,
+            customers = EXCLUDED.customers,
+            recency_low = EXCLUDED.recency_low,
+            recency_mid = EXCLUDED.recency_mid,
+            recency_high = EXCLUDED.recency_high,
+            frequency_low = EXCLUDED.frequency_low,
+            frequency_mid = EXCLUDED.frequency_mid,
+            frequency_high = EXCLUDED.frequency_high,
+            monetary_low = EXCLUDED.monetary_low,
+            monetary_mid = EXCLUDED.monetary_mid,
+            monetary_high = EXCLUDED.monetary_high,
+            computed_at = EXCLUDED.computed_at
+        RETURNING *
+    ),"""
+    else:
+        # Без сохранённых порогов CROSS JOIN thresholds молча дал бы пустую витрину.
+        data, _ = execute_query(
+            engine,
+            f"SELECT COUNT(*) FROM {thresholds_table} WHERE scoring = '{scoring}';",
+            error_message=f"Ошибка при чтении порогов из {thresholds_table}",
+            fetch_results=True
+        )
+        if not data or not data[0][0]:
+            raise ValueError(
+                f"В {thresholds_table} нет порогов для скоринга '{scoring}': "
+                f"запустите rfm_analysis с refresh_thresholds=True."
+            )
+        thresholds_cte = f"""
+    thresholds AS (
+        SELECT * FROM {thresholds_table} WHERE scoring = '{scoring}'
+    ),"""
+
+    rfm_data = None
+    stage_table = f"{output_table}_data_stage"
+    if shards > 1:
+        _rfm_data_sharded(engine, input_table, stage_table, shards, date_format, as_of)
+        rfm_data = f"\n        SELECT * FROM {stage_table}"
+
+    rfm_ctes, rfm_select = _rfm_select(
+        input_table, thresholds_cte, date_format, as_of, rfm_data)
+    insert_rfm_query = f"""{rfm_ctes}
+    INSERT INTO {output_table} (
+        customer_id, 
+        recency_days, 
+        frequency, 
+        monetary, 
+        recency_score, 
+        frequency_score, 
+        monetary_score, 
+        rfm_group, 
+        percent_rfm,
+        cats
+    )
+    {rfm_select}
     ON CONFLICT (customer_id) DO UPDATE SET
         recency_days = EXCLUDED.recency_days,
         frequency = EXCLUDED.frequency,
@@ -200,1781 +416,1532 @@ def rfm_analysis(
         f"Данные для таблицы {output_table} успешно добавлены.",
         "Ошибка при добавлении данных в таблицу RFM"
     )
+    if shards > 1:
+        execute_query(
+            engine,
+            f"DROP TABLE IF EXISTS {stage_table};",
+            error_message=f"Ошибка при удалении таблицы {stage_table}"
+        )
 
-    
-def calculate_cohorts_all(engine, 
-                           input_table='events', 
-                           output_table='cohorts_all', 
-                           date_format='DD.MM.YYYY HH24:MI'):
-    """Формирует таблицу с когортами пользователей по месяцу первого действия."""
-    
-    create_table_query = f"""
-    CREATE TABLE IF NOT EXISTS {output_table} (
-        user_id BIGINT,
-        cohort_month DATE,
-        PRIMARY KEY (user_id, cohort_month)
+def _rfm_data_sharded(engine, input_table, stage_table, shards, date_format, as_of):
+    """Собирает агрегаты RFM по клиентам в stage_table параллельно по шардам."""
+    execute_query(
+        engine,
+        f"""
+        DROP TABLE IF EXISTS {stage_table};
+        CREATE UNLOGGED TABLE {stage_table} (
+            customer_id BIGINT,
+            last_order_date TIMESTAMPTZ,
+            recency_days NUMERIC,
+            frequency BIGINT,
+            monetary NUMERIC
+        );
+        """,
+        error_message=f"Ошибка при создании таблицы {stage_table}"
+    )
+    # Клиент целиком попадает в один шард, поэтому агрегаты шардов не пересекаются.
+    run_parallel(
+        engine,
+        [
+            f"""
+            INSERT INTO {stage_table}
+            {_rfm_data_select(
+                input_table, date_format, as_of, 
+                f'MOD(ABS("OrderCustomerIdsMindboxId"::BIGINT), {int(shards)}) = {shard}')};
+            """
+            for shard in range(int(shards))
+        ],
+        max_workers=shards,
+        error_message=f"Ошибка при заполнении таблицы {stage_table}"
+    )
+    logger.info(f"Агрегаты RFM собраны в {stage_table} по {shards} шардам.")
+
+def _rfm_thresholds_drift(stored, current):
+    """Возвращает максимальное относительное отклонение порогов."""
+    drift = 0.0
+    for old, new in zip(stored, current):
+        if old is None or new is None:
+            if old is not new:
+                return float('inf')
+            continue
+        old, new = float(old), float(new)
+        drift = max(drift, abs(new - old) / max(abs(old), 1.0))
+    return drift
+
+def _rfm_metrics_source(metrics_table, reference, where=""):
+    """Собирает выборку recency/frequency/monetary из таблицы метрик RFM."""
+    return f"""
+        SELECT
+            customer_id,
+            EXTRACT(DAY FROM ({reference} - last_order_date)) AS recency_days,
+            frequency,
+            monetary
+        FROM {metrics_table}
+        {where}"""
+
+def _rfm_aged_thresholds(thresholds_table, scoring):
+    """Выбирает сохранённые пороги RFM, приведённые к текущей дате.
+
+    Давность от CURRENT_DATE больше давности от reference_date порогов
+    на их возраст, поэтому границы давности сдвигаются на него же.
+    """
+    age = "(CURRENT_DATE - reference_date)"
+    return f"""
+            SELECT
+                recency_low + {age} AS recency_low,
+                recency_mid + {age} AS recency_mid,
+                recency_high + {age} AS recency_high,
+                frequency_low, frequency_mid, frequency_high,
+                monetary_low, monetary_mid, monetary_high
+            FROM {thresholds_table}
+            WHERE scoring = '{scoring}'"""
+
+def _rfm_incremental(
+    engine, 
+    input_table, 
+    output_table, 
+    thresholds_table, 
+    scoring, 
+    drift_tolerance, 
+    max_reference_age_days, 
+    date_format,
+    metrics_table='rfm_metrics'
+    ):
+    """Инкрементально обновляет RFM по клиентам с новыми оплаченными заказами."""
+    threshold_columns = (
+        "recency_low, recency_mid, recency_high, "
+        "frequency_low, frequency_mid, frequency_high, "
+        "monetary_low, monetary_mid, monetary_high"
+    )
+    create_watermarks_table(engine)
+    create_metrics_query = f"""
+    CREATE TABLE IF NOT EXISTS {metrics_table} (
+        customer_id BIGINT,
+        last_order_date TIMESTAMP,
+        frequency INT,
+        monetary NUMERIC,
+        scored BOOLEAN DEFAULT FALSE,
+        PRIMARY KEY (customer_id)
     );
     """
     execute_query(
         engine, 
-        create_table_query,
-        f"Таблица {output_table} успешно создана.",
-        "Ошибка при создании таблицы cohorts_all"
+        create_metrics_query,
+        f"Таблица {metrics_table} успешно создана.",
+        "Ошибка при создании таблицы метрик RFM"
     )
-    insert_cohorts_query = f"""
-    INSERT INTO {output_table} (user_id, cohort_month)
-    WITH cohort AS (
-        SELECT 
-            "CustomerActionCustomerIdsMindboxId" AS user_id,
-            DATE_TRUNC(
-                'month', 
-                MIN(to_timestamp("CustomerActionDateTimeUtc", 
-                '{date_format}'))) AS cohort_month
-        FROM 
-            {input_table}
-        GROUP BY 
-            "CustomerActionCustomerIdsMindboxId"
+
+    # Верхняя граница фиксируется заранее, чтобы заказы, загруженные
+    # во время пересчёта, попали в следующий запуск.
+    watermark_name = batch_watermark(f"{output_table}_{scoring}")
+    last_batch = get_watermark(engine, watermark_name)
+    max_batch = get_max_batch(engine, input_table)
+    if max_batch is None:
+        logger.info(f"Нет заказов для инкрементального расчёта {output_table}.")
+        return
+    new_orders = batch_filter(last_batch, max_batch)
+
+    upsert_metrics_query = f"""
+    WITH changed AS (
+        SELECT DISTINCT "OrderCustomerIdsMindboxId" AS customer_id
+        FROM {input_table}
+        WHERE "OrderLineStatusIdsExternalId" = 'Paid'
+            AND {new_orders}
     )
-    SELECT 
-        user_id, 
-        cohort_month
-    FROM cohort
-    ON CONFLICT (user_id, cohort_month) DO NOTHING;  
+    INSERT INTO {metrics_table} (
+        customer_id, last_order_date, frequency, monetary, scored
+    )
+    SELECT
+        o."OrderCustomerIdsMindboxId",
+        MAX(TO_TIMESTAMP(o."OrderFirstActionDateTimeUtc", '{date_format}')),
+        COUNT(*),
+        SUM(o."OrderTotalPrice"::NUMERIC),
+        FALSE
+    FROM {input_table} o
+    JOIN changed c ON c.customer_id = o."OrderCustomerIdsMindboxId"
+    WHERE o."OrderLineStatusIdsExternalId" = 'Paid'
+    GROUP BY o."OrderCustomerIdsMindboxId"
+    ON CONFLICT (customer_id) DO UPDATE SET
+        last_order_date = EXCLUDED.last_order_date,
+        frequency = EXCLUDED.frequency,
+        monetary = EXCLUDED.monetary,
+        scored = FALSE
+    WHERE ({metrics_table}.last_order_date, 
+           {metrics_table}.frequency, 
+           {metrics_table}.monetary) 
+        IS DISTINCT FROM (EXCLUDED.last_order_date, 
+                          EXCLUDED.frequency, 
+                          EXCLUDED.monetary);
     """
     execute_query(
         engine,
-        insert_cohorts_query,
-        f"Данные для таблицы {output_table} успешно добавлены.",
-        "Ошибка при добавлении данных в таблицу cohorts_all"
-    )    
-    
-def calculate_cohorts_paid(engine, 
-                           input_table='orders', 
-                           output_table='cohorts_paid', 
-                           date_format='DD.MM.YYYY HH24:MI'):
-    """Формирует таблицу с когортами платящих пользователей по месяцу первого платежа."""
+        upsert_metrics_query,
+        f"Метрики изменившихся клиентов обновлены в таблице {metrics_table}.",
+        "Ошибка при обновлении метрик RFM"
+    )
+
+    stored, _ = execute_query(
+        engine,
+        f"""
+        SELECT reference_date, 
+               CURRENT_DATE - reference_date AS age_days,
+               {threshold_columns}
+        FROM {thresholds_table}
+        WHERE scoring = '{scoring}';
+        """,
+        error_message="Ошибка при чтении порогов RFM",
+        fetch_results=True
+    )
+    # Дрейф считается от той же даты отсчёта, что и сохранённые пороги;
+    # recency_days в витрину пишется от CURRENT_DATE.
+    if stored:
+        reference_date, age_days = stored[0][0], stored[0][1]
+        reference = f"DATE '{reference_date}'"
+    else:
+        reference_date, age_days, reference = None, None, "CURRENT_DATE"
+
+    current, _ = execute_query(
+        engine,
+        f"""
+        SELECT {_rfm_thresholds_select(scoring)}
+        FROM ({_rfm_metrics_source(metrics_table, reference)}) AS rfm_data;
+        """,
+        error_message="Ошибка при расчёте порогов RFM",
+        fetch_results=True
+    )
+    if not current:
+        return
+
+    if not stored:
+        rescore_all, reason = True, "пороги ещё не рассчитаны"
+    elif age_days > max_reference_age_days:
+        rescore_all, reason = True, f"пороги устарели ({age_days} дн.)"
+    else:
+        drift = _rfm_thresholds_drift(stored[0][2:], current[0])
+        rescore_all = drift > drift_tolerance
+        reason = f"дрейф порогов {drift:.2%} (допуск {drift_tolerance:.2%})"
+    logger.info(
+        f"RFM: {'полная переоценка' if rescore_all else 'переоценка изменившихся клиентов'}"
+        f" — {reason}."
+    )
+
+    if rescore_all:
+        # Новая точка отсчёта давности: пороги пересчитываются от текущей даты.
+        reference = "CURRENT_DATE"
+        execute_query(
+            engine,
+            f"""
+            INSERT INTO {thresholds_table} (
+                scoring, reference_date, customers, {threshold_columns}, 
+                computed_at
+            )
+            SELECT 
+                '{scoring}', 
+                CURRENT_DATE, 
+                COUNT(*), 
+                {_rfm_thresholds_select(scoring)}, 
+                NOW()
+            FROM ({_rfm_metrics_source(metrics_table, reference)}) AS rfm_data
+            ON CONFLICT (scoring) DO UPDATE SET
+                reference_date = EXCLUDED.reference_date,
+                customers = EXCLUDED.customers,
+                recency_low = EXCLUDED.recency_low,
+                recency_mid = EXCLUDED.recency_mid,
+                recency_high = EXCLUDED.recency_high,
+                frequency_low = EXCLUDED.frequency_low,
+                frequency_mid = EXCLUDED.frequency_mid,
+                frequency_high = EXCLUDED.frequency_high,
+                monetary_low = EXCLUDED.monetary_low,
+                monetary_mid = EXCLUDED.monetary_mid,
+                monetary_high = EXCLUDED.monetary_high,
+                computed_at = EXCLUDED.computed_at;
+            """,
+            f"Пороги RFM ({scoring}) пересчитаны.",
+            "Ошибка при сохранении порогов RFM"
+        )
+
+    target_filter = "" if rescore_all else "WHERE NOT scored"
+    upsert_scores_query = f"""
+    WITH rfm_scores AS (
+        SELECT
+            d.customer_id,
+            d.recency_days,
+            d.frequency,
+            d.monetary,
+            {_rfm_scores_select('d', 't')}
+        FROM ({_rfm_metrics_source(metrics_table, "CURRENT_DATE", target_filter)}
+        ) AS d
+        CROSS JOIN ({_rfm_aged_thresholds(thresholds_table, scoring)}
+        ) AS t
+    ),
+    rfm_grouped AS (
+        SELECT
+            s.*,
+            CONCAT(
+                s.recency_score, 
+                s.frequency_score, 
+                s.monetary_score
+    ) AS rfm_group
+        FROM rfm_scores s
+    )
+    INSERT INTO {output_table} (
+        customer_id, recency_days, frequency, monetary,
+        recency_score, frequency_score, monetary_score,
+        rfm_group, cats
+    )
+    SELECT
+        rg.customer_id,
+        rg.recency_days,
+        rg.frequency,
+        rg.monetary,
+        rg.recency_score,
+        rg.frequency_score,
+        rg.monetary_score,
+        rg.rfm_group,
+        {_rfm_segments_case('rg.rfm_group')}
+    FROM rfm_grouped rg
+    ON CONFLICT (customer_id) DO UPDATE SET
+        recency_days = EXCLUDED.recency_days,
+        frequency = EXCLUDED.frequency,
+        monetary = EXCLUDED.monetary,
+        recency_score = EXCLUDED.recency_score,
+        frequency_score = EXCLUDED.frequency_score,
+        monetary_score = EXCLUDED.monetary_score,
+        rfm_group = EXCLUDED.rfm_group,
+        cats = EXCLUDED.cats
+    WHERE ({output_table}.recency_days, {output_table}.frequency, 
+           {output_table}.monetary, {output_table}.rfm_group, 
+           {output_table}.cats)
+        IS DISTINCT FROM (EXCLUDED.recency_days, EXCLUDED.frequency, 
+                          EXCLUDED.monetary, EXCLUDED.rfm_group, 
+                          EXCLUDED.cats);
+    """
+    execute_query(
+        engine,
+        upsert_scores_query,
+        f"Изменившиеся строки таблицы {output_table} обновлены.",
+        "Ошибка при обновлении данных в таблице RFM"
+    )
+
+    update_percent_query = f"""
+    WITH rfm_percentages AS (
+        SELECT
+            rfm_group,
+            ROUND(COUNT(*) * 100.0 / SUM(COUNT(*)) OVER (), 2) 
+                AS percent_rfm
+        FROM {output_table}
+        GROUP BY rfm_group
+    )
+    UPDATE {output_table} r
+    SET percent_rfm = p.percent_rfm
+    FROM rfm_percentages p
+    WHERE r.rfm_group = p.rfm_group
+        AND r.percent_rfm IS DISTINCT FROM p.percent_rfm;
+    """
+    execute_query(
+        engine,
+        update_percent_query,
+        f"Доли RFM-групп в таблице {output_table} обновлены.",
+        "Ошибка при обновлении долей RFM-групп"
+    )
+    execute_query(
+        engine,
+        f"UPDATE {metrics_table} SET scored = TRUE WHERE NOT scored;",
+        error_message="Ошибка при обновлении статуса метрик RFM"
+    )
+    set_watermark(engine, watermark_name, max_batch)
     
+def create_cohort_changes_table(engine, changes_table='cohort_changes'):
+    """Создает таблицу с набором когорт, изменившихся после загрузки."""
     create_table_query = f"""
-    CREATE TABLE IF NOT EXISTS {output_table} (
-        user_id BIGINT,
+    CREATE TABLE IF NOT EXISTS {changes_table} (
+        id BIGSERIAL PRIMARY KEY,
+        source TEXT,
         cohort_month DATE,
-        PRIMARY KEY (user_id, cohort_month)
+        changed_at TIMESTAMP DEFAULT NOW()
     );
     """
     execute_query(
-        engine, 
+        engine,
         create_table_query,
-        f"Таблица {output_table} успешно создана.",
-        "Ошибка при создании таблицы cohorts_paid"
+        error_message=f"Ошибка при создании таблицы {changes_table}"
     )
-    insert_cohorts_query = f"""
-    INSERT INTO {output_table} (user_id, cohort_month)
-    WITH cohort AS (
-        SELECT 
-            "OrderCustomerIdsMindboxId" AS user_id,
-            DATE_TRUNC(
-                'month', 
-                MIN(to_timestamp("OrderFirstActionDateTimeUtc", 
-                '{date_format}'))) AS cohort_month
-        FROM 
-            {input_table}
-        WHERE 
-            "OrderLineStatusIdsExternalId" = 'Paid'
-        GROUP BY 
-            "OrderCustomerIdsMindboxId"
+
+def _primary_key(engine, table):
+    """Возвращает имя первичного ключа таблицы и число его столбцов."""
+    data, _ = execute_query(
+        engine,
+        f"""
+        SELECT tc.constraint_name, COUNT(*)
+        FROM information_schema.table_constraints tc
+        JOIN information_schema.key_column_usage kcu 
+            ON kcu.constraint_name = tc.constraint_name 
+            AND kcu.table_schema = tc.table_schema
+        WHERE tc.table_schema = current_schema()
+            AND tc.table_name = '{table}'
+            AND tc.constraint_type = 'PRIMARY KEY'
+        GROUP BY tc.constraint_name;
+        """,
+        error_message=f"Ошибка при чтении ключа таблицы {table}",
+        fetch_results=True
     )
-    SELECT 
-        user_id, 
-        cohort_month
-    FROM cohort
-    ON CONFLICT (user_id, cohort_month) DO NOTHING; 
+    return (data[0][0], data[0][1]) if data else (None, 0)
+
+def _migrate_cohorts_key(engine, table):
+    """Переводит таблицу когорт со старого ключа (user_id, cohort_month) на user_id.
+
+    Из дублей остаётся самая ранняя когорта пользователя.
     """
+    constraint_name, key_columns = _primary_key(engine, table)
+    if key_columns < 2:
+        return
     execute_query(
         engine,
-        insert_cohorts_query,
-        f"Данные для таблицы {output_table} успешно добавлены.",
-        "Ошибка при добавлении данных в таблицу cohorts_paid"
-    )   
-     
-def calculate_arppu(engine, 
-                     output_table='cohorts_revenue_arppu_data', 
-                     date_format='DD.MM.YYYY HH24:MI'):
-    """Формирует таблицу с данными по выручке и ARPPU."""    
+        f"""
+        DELETE FROM {table} a
+        USING {table} b
+        WHERE a.user_id = b.user_id 
+            AND a.cohort_month > b.cohort_month;
+        ALTER TABLE {table} 
+            DROP CONSTRAINT {constraint_name},
+            ADD PRIMARY KEY (user_id);
+        """,
+        f"Таблица {table} переведена на ключ user_id.",
+        f"Ошибка при миграции таблицы {table}"
+    )
+
+def _update_cohorts(engine, 
+                    input_table, 
+                    output_table, 
+                    user_column, 
+                    date_column, 
+                    where, 
+                    changes_table, 
+                    date_format):
+    """Дополняет таблицу когорт пользователями из новых пачек загрузки.
+
+    Когорта — месяц первого действия; для известных пользователей берётся
+    LEAST(сохранённая, из пачки). Месяцы когорт пачки и прежние когорты
+    перенесённых пользователей записываются в changes_table.
+    """
     create_table_query = f"""
     CREATE TABLE IF NOT EXISTS {output_table} (
-        cohort_month DATE,
-        total_users BIGINT,
-        revenue_month_12 NUMERIC,
-        revenue_month_11 NUMERIC,
-        revenue_month_10 NUMERIC,
-        revenue_month_9 NUMERIC,
-        revenue_month_8 NUMERIC,
-        revenue_month_7 NUMERIC,
-        revenue_month_6 NUMERIC,
-        revenue_month_5 NUMERIC,
-        revenue_month_4 NUMERIC,
-        revenue_month_3 NUMERIC,
-        revenue_month_2 NUMERIC,
-        revenue_month_1 NUMERIC,
-        arppu_month_12 NUMERIC,
-        arppu_month_11 NUMERIC,
-        arppu_month_10 NUMERIC,
-        arppu_month_9 NUMERIC,
-        arppu_month_8 NUMERIC,
-        arppu_month_7 NUMERIC,
-        arppu_month_6 NUMERIC,
-        arppu_month_5 NUMERIC,
-        arppu_month_4 NUMERIC,
-        arppu_month_3 NUMERIC,
-        arppu_month_2 NUMERIC,
-        arppu_month_1 NUMERIC,
-        PRIMARY KEY (cohort_month)
+        user_id BIGINT PRIMARY KEY,
+        cohort_month DATE
     );
     """
     execute_query(
         engine, 
         create_table_query,
         f"Таблица {output_table} успешно создана.",
-        "Ошибка при создании таблицы cohorts_revenue_arppu_data"
+        f"Ошибка при создании таблицы {output_table}"
     )
-    insert_cohorts_query = f"""
-    INSERT INTO {output_table} (
-        cohort_month, total_users, 
-        revenue_month_12, revenue_month_11, 
-        revenue_month_10, revenue_month_9, 
-        revenue_month_8, revenue_month_7, 
-        revenue_month_6, revenue_month_5, 
-        revenue_month_4, revenue_month_3, 
-        revenue_month_2, revenue_month_1, 
-        arppu_month_12, arppu_month_11, 
-        arppu_month_10, arppu_month_9, 
-        arppu_month_8, arppu_month_7, 
-        arppu_month_6, arppu_month_5, 
-        arppu_month_4, arppu_month_3, 
-        arppu_month_2, arppu_month_1)
-    WITH cohort AS (
+    _migrate_cohorts_key(engine, output_table)
+    create_cohort_changes_table(engine, changes_table)
+    create_watermarks_table(engine)
+
+    watermark_name = batch_watermark(output_table)
+    last_batch = get_watermark(engine, watermark_name)
+    max_batch = get_max_batch(engine, input_table)
+    if max_batch is None or (last_batch is not None and last_batch >= max_batch):
+        logger.info(f"Новых строк в {input_table} нет, {output_table} не обновляется.")
+        return
+    new_rows = batch_filter(last_batch, max_batch)
+
+    update_cohorts_query = f"""
+    WITH batch AS MATERIALIZED (
         SELECT 
-            "OrderCustomerIdsMindboxId" AS user_id,
+            "{user_column}"::BIGINT AS user_id,
             DATE_TRUNC(
                 'month', 
-                MIN(to_timestamp(
-                    "OrderFirstActionDateTimeUtc", 
-                    '{date_format}'))) AS cohort_month
-        FROM 
-            orders
-        WHERE 
-            "OrderLineStatusIdsExternalId" = 'Paid'
-        GROUP BY 
-            "OrderCustomerIdsMindboxId"
+                MIN(to_timestamp("{date_column}", 
+                '{date_format}')))::DATE AS cohort_month
+        FROM {input_table}
+        WHERE {" AND ".join(filter(None, [where, new_rows]))}
+        GROUP BY "{user_column}"
     ),
-    user_counts AS (
+    previous AS (
         SELECT 
-            cohort_month,
-            COUNT(user_id) AS total_users
-        FROM cohort
-        GROUP BY cohort_month
+            b.user_id,
+            c.cohort_month AS old_month,
+            LEAST(c.cohort_month, b.cohort_month) AS cohort_month
+        FROM batch b
+        LEFT JOIN {output_table} c ON c.user_id = b.user_id
     ),
-    monthly_revenue AS (
-        SELECT 
-            c.cohort_month,
-            DATE_TRUNC(
-                'month', to_timestamp(
-                    o."OrderFirstActionDateTimeUtc", 
-                    '{date_format}')) AS month,
-            SUM(o."OrderTotalPrice") AS total_revenue
-        FROM cohort c
-        JOIN orders o ON c.user_id = o."OrderCustomerIdsMindboxId"
-        WHERE o."OrderLineStatusIdsExternalId"::text = 'Paid'
-        GROUP BY c.cohort_month, month
+    upserted AS (
+        INSERT INTO {output_table} (user_id, cohort_month)
+        SELECT user_id, cohort_month 
+        FROM batch
+        ON CONFLICT (user_id) DO UPDATE SET 
+            cohort_month = EXCLUDED.cohort_month
+        WHERE EXCLUDED.cohort_month < {output_table}.cohort_month
     )
-    SELECT 
-        u.cohort_month,
-        u.total_users,
-        SUM(CASE WHEN m.month = DATE_TRUNC(
-            'month', CURRENT_DATE) - INTERVAL '11 months' THEN 
-                m.total_revenue ELSE 0 END) AS revenue_month_12,
-        SUM(CASE WHEN m.month = DATE_TRUNC(
-            'month', CURRENT_DATE) - INTERVAL '10 months' THEN 
-                m.total_revenue ELSE 0 END) AS revenue_month_11,
-        SUM(CASE WHEN m.month = DATE_TRUNC(
-            'month', CURRENT_DATE) - INTERVAL '9 months' THEN 
-                m.total_revenue ELSE 0 END) AS revenue_month_10,
-        SUM(CASE WHEN m.month = DATE_TRUNC(
-            'month', CURRENT_DATE) - INTERVAL '8 months' THEN 
-                m.total_revenue ELSE 0 END) AS revenue_month_9,
-        SUM(CASE WHEN m.month = DATE_TRUNC(
-            'month', CURRENT_DATE) - INTERVAL '7 months' THEN 
-                m.total_revenue ELSE 0 END) AS revenue_month_8,
-        SUM(CASE WHEN m.month = DATE_TRUNC(
-            'month', CURRENT_DATE) - INTERVAL '6 months' THEN 
-                m.total_revenue ELSE 0 END) AS revenue_month_7,
-        SUM(CASE WHEN m.month = DATE_TRUNC(
-            'month', CURRENT_DATE) - INTERVAL '5 months' THEN 
-                m.total_revenue ELSE 0 END) AS revenue_month_6,
-        SUM(CASE WHEN m.month = DATE_TRUNC(
-            'month', CURRENT_DATE) - INTERVAL '4 months' THEN 
-                m.total_revenue ELSE 0 END) AS revenue_month_5,
-        SUM(CASE WHEN m.month = DATE_TRUNC(
-            'month', CURRENT_DATE) - INTERVAL '3 months' THEN 
-                m.total_revenue ELSE 0 END) AS revenue_month_4,
-        SUM(CASE WHEN m.month = DATE_TRUNC(
-            'month', CURRENT_DATE) - INTERVAL '2 months' THEN 
-                m.total_revenue ELSE 0 END) AS revenue_month_3,
-        SUM(CASE WHEN m.month = DATE_TRUNC(
-            'month', CURRENT_DATE) - INTERVAL '1 month' THEN 
-                m.total_revenue ELSE 0 END) AS revenue_month_2,
-        SUM(CASE WHEN m.month = DATE_TRUNC(
-            'month', CURRENT_DATE) - INTERVAL '0 month' THEN 
-                m.total_revenue ELSE 0 END) AS revenue_month_1,
-        SUM(CASE WHEN m.month = DATE_TRUNC(
-            'month', CURRENT_DATE) - INTERVAL '11 months' THEN 
-                m.total_revenue ELSE 0 END) / COALESCE(NULLIF(
-                    u.total_users, 0), 1) AS arppu_month_12,
-        SUM(CASE WHEN m.month = DATE_TRUNC(
-            'month', CURRENT_DATE) - INTERVAL '10 months' THEN 
-                m.total_revenue ELSE 0 END) / COALESCE(NULLIF(
-                    u.total_users, 0), 1) AS arppu_month_11,
-        SUM(CASE WHEN m.month = DATE_TRUNC(
-            'month', CURRENT_DATE) - INTERVAL '9 months' THEN 
-                m.total_revenue ELSE 0 END) / COALESCE(NULLIF(
-                    u.total_users, 0), 1) AS arppu_month_10,
-        SUM(CASE WHEN m.month = DATE_TRUNC(
-            'month', CURRENT_DATE) - INTERVAL '8 months' THEN 
-                m.total_revenue ELSE 0 END) / COALESCE(NULLIF(
-                    u.total_users, 0), 1) AS arppu_month_9,
-        SUM(CASE WHEN m.month = DATE_TRUNC(
-            'month', CURRENT_DATE) - INTERVAL '7 months' THEN 
-                m.total_revenue ELSE 0 END) / COALESCE(NULLIF(
-                    u.total_users, 0), 1) AS arppu_month_8,
-        SUM(CASE WHEN m.month = DATE_TRUNC(
-            'month', CURRENT_DATE) - INTERVAL '6 months' THEN 
-                m.total_revenue ELSE 0 END) / COALESCE(NULLIF(
-                    u.total_users, 0), 1) AS arppu_month_7,
-        SUM(CASE WHEN m.month = DATE_TRUNC(
-            'month', CURRENT_DATE) - INTERVAL '5 months' THEN 
-                m.total_revenue ELSE 0 END) / COALESCE(NULLIF(
-                    u.total_users, 0), 1) AS arppu_month_6,
-        SUM(CASE WHEN m.month = DATE_TRUNC(
-            'month', CURRENT_DATE) - INTERVAL '4 months' THEN 
-                m.total_revenue ELSE 0 END) / COALESCE(NULLIF(
-                    u.total_users, 0), 1) AS arppu_month_5,
-        SUM(CASE WHEN m.month = DATE_TRUNC(
-            'month', CURRENT_DATE) - INTERVAL '3 months' THEN 
-                m.total_revenue ELSE 0 END) / COALESCE(NULLIF(
-                    u.total_users, 0), 1) AS arppu_month_4,
-        SUM(CASE WHEN m.month = DATE_TRUNC(
-            'month', CURRENT_DATE) - INTERVAL '2 months' THEN 
-                m.total_revenue ELSE 0 END) / COALESCE(NULLIF(
-                    u.total_users, 0), 1) AS arppu_month_3,
-        SUM(CASE WHEN m.month = DATE_TRUNC(
-            'month', CURRENT_DATE) - INTERVAL '1 month' THEN 
-                m.total_revenue ELSE 0 END) / COALESCE(NULLIF(
-                    u.total_users, 0), 1) AS arppu_month_2,
-        SUM(CASE WHEN m.month = DATE_TRUNC(
-            'month', CURRENT_DATE) - INTERVAL '0 month' THEN 
-                m.total_revenue ELSE 0 END) / COALESCE(NULLIF(
-                    u.total_users, 0), 1) AS arppu_month_1
-    FROM user_counts u
-    LEFT JOIN monthly_revenue m ON u.cohort_month = m.cohort_month
-    GROUP BY u.cohort_month, u.total_users
-    ORDER BY u.cohort_month
-    ON CONFLICT (cohort_month) DO NOTHING; 
+    INSERT INTO {changes_table} (source, cohort_month)
+    SELECT '{output_table}', cohort_month 
+    FROM previous
+    UNION
+    SELECT '{output_table}', old_month 
+    FROM previous
+    WHERE old_month > cohort_month;
     """
     execute_query(
         engine,
-        insert_cohorts_query,
-        f"Данные по выручке и ARPPU успешно сохранены в таблице {output_table}.",
-        "Ошибка при сохранении данных по выручке и ARPPU в таблицу"
+        update_cohorts_query,
+        f"Данные для таблицы {output_table} успешно добавлены.",
+        f"Ошибка при добавлении данных в таблицу {output_table}"
     )
+    set_watermark(engine, watermark_name, max_batch)
 
-def calculate_arppu_cumulative(engine, 
-                             input_table='cohorts_revenue_arppu_data', 
-                             output_table='arppu_cumulative'):
-    """Формирует таблицу с кумулятивным ARPPU."""
+def calculate_cohorts_all(engine, 
+                           input_table='events', 
+                           output_table='cohorts_all', 
+                           changes_table='cohort_changes', 
+                           date_format='DD.MM.YYYY HH24:MI'):
+    """Формирует таблицу с когортами пользователей по месяцу первого действия."""
+    _update_cohorts(
+        engine, input_table, output_table,
+        user_column="CustomerActionCustomerIdsMindboxId",
+        date_column="CustomerActionDateTimeUtc",
+        where=None,
+        changes_table=changes_table,
+        date_format=date_format
+    )
     
-    create_table_query = f"""
-    CREATE TABLE IF NOT EXISTS {output_table} (
-        cohort_month DATE,
-        total_users BIGINT,
-        cumulative_arppu_12 NUMERIC,
-        cumulative_arppu_11 NUMERIC,
-        cumulative_arppu_10 NUMERIC,
-        cumulative_arppu_9 NUMERIC,
-        cumulative_arppu_8 NUMERIC,
-        cumulative_arppu_7 NUMERIC,
-        cumulative_arppu_6 NUMERIC,
-        cumulative_arppu_5 NUMERIC,
-        cumulative_arppu_4 NUMERIC,
-        cumulative_arppu_3 NUMERIC,
-        cumulative_arppu_2 NUMERIC,
-        cumulative_arppu_1 NUMERIC,
-        PRIMARY KEY (cohort_month)
-    );
-    """
-    execute_query(
-        engine, 
-        create_table_query,
-        f"Таблица {output_table} успешно создана.",
-        "Ошибка при создании таблицы arppu_cumulative"
-    )
-    insert_arppu_query = f"""
-    INSERT INTO {output_table} (
-        cohort_month, total_users, 
-        cumulative_arppu_12, cumulative_arppu_11, 
-        cumulative_arppu_10, cumulative_arppu_9, 
-        cumulative_arppu_8, cumulative_arppu_7, 
-        cumulative_arppu_6, cumulative_arppu_5, 
-        cumulative_arppu_4, cumulative_arppu_3, 
-        cumulative_arppu_2, cumulative_arppu_1
-    )
-    WITH cumulative_arppu AS (
-        SELECT 
-            cohort_month,
-            ROUND("arppu_month_12", 2) AS "ARPPU Month 12",
-            ROUND("arppu_month_11" + "arppu_month_12", 2) 
-                AS cumulative_arppu_11,
-            ROUND("arppu_month_10" + "arppu_month_11" + 
-                "arppu_month_12", 2) AS cumulative_arppu_10,
-            ROUND("arppu_month_9" + "arppu_month_10" + 
-                "arppu_month_11" + "arppu_month_12", 2) 
-                    AS cumulative_arppu_9,
-            ROUND("arppu_month_8" + "arppu_month_9" + 
-                "arppu_month_10" + "arppu_month_11" + 
-                        "arppu_month_12", 2) 
-                        AS cumulative_arppu_8,
-            ROUND("arppu_month_7" + "arppu_month_8" + 
-                "arppu_month_9" + "arppu_month_10" + 
-                    "arppu_month_11" + "arppu_month_12", 2) 
-                        AS cumulative_arppu_7,
-            ROUND("arppu_month_6" + "arppu_month_7" + 
-                "arppu_month_8" + "arppu_month_9" + 
-                    "arppu_month_10" + "arppu_month_11" + 
-                        "arppu_month_12", 2) 
-                            AS cumulative_arppu_6,
-            ROUND("arppu_month_5" + "arppu_month_6" + 
-                "arppu_month_7" + "arppu_month_8" + 
-                    "arppu_month_9" + "arppu_month_10" + 
-                        "arppu_month_11" + "arppu_month_12", 2) 
-                            AS cumulative_arppu_5,
-            ROUND("arppu_month_4" + "arppu_month_5" + 
-                "arppu_month_6" + "arppu_month_7" + "arppu_month_8" + 
-                    "arppu_month_9" + "arppu_month_10" + 
-                        "arppu_month_11" + "arppu_month_12", 2) 
-                            AS cumulative_arppu_4,
-            ROUND("arppu_month_3" + "arppu_month_4" + "arppu_month_5" + 
-                "arppu_month_6" + "arppu_month_7" + "arppu_month_8" + 
-                    "arppu_month_9" + "arppu_month_10" + 
-                        "arppu_month_11" + "arppu_month_12", 2) 
-                            AS cumulative_arppu_3,
-            ROUND("arppu_month_2" + "arppu_month_3" + "arppu_month_4" + 
-                "arppu_month_5" + "arppu_month_6" + "arppu_month_7" + 
-                    "arppu_month_8" + "arppu_month_9" + 
-                        "arppu_month_10" + "arppu_month_11" + 
-                            "arppu_month_12", 2) AS cumulative_arppu_2,
-            ROUND("arppu_month_1" + "arppu_month_2" + "arppu_month_3" + 
-                "arppu_month_4" + "arppu_month_5" + "arppu_month_6" + 
-                    "arppu_month_7" + "arppu_month_8" + 
-                        "arppu_month_9" + "arppu_month_10" + 
-                            "arppu_month_11" + "arppu_month_12", 2) 
-                                AS cumulative_arppu_1,
-            total_users
-        FROM {input_table}
+def calculate_cohorts_paid(engine, 
+                           input_table='orders', 
+                           output_table='cohorts_paid', 
+                           changes_table='cohort_changes', 
+                           date_format='DD.MM.YYYY HH24:MI'):
+    """Формирует таблицу с когортами платящих пользователей по месяцу первого платежа."""
+    _update_cohorts(
+        engine, input_table, output_table,
+        user_column="OrderCustomerIdsMindboxId",
+        date_column="OrderFirstActionDateTimeUtc",
+        where="\"OrderLineStatusIdsExternalId\" = 'Paid'",
+        changes_table=changes_table,
+        date_format=date_format
     )
-    SELECT 
-        cohort_month,
-        total_users,
-        ROUND("ARPPU Month 12", 2) AS cumulative_arppu_12,
-        ROUND(cumulative_arppu_11, 2) AS cumulative_arppu_11,
-        ROUND(cumulative_arppu_10, 2) AS cumulative_arppu_10,
-        ROUND(cumulative_arppu_9, 2) AS cumulative_arppu_9,
-        ROUND(cumulative_arppu_8, 2) AS cumulative_arppu_8,
-        ROUND(cumulative_arppu_7, 2) AS cumulative_arppu_7,
-        ROUND(cumulative_arppu_6, 2) AS cumulative_arppu_6,
-        ROUND(cumulative_arppu_5, 2) AS cumulative_arppu_5,
-        ROUND(cumulative_arppu_4, 2) AS cumulative_arppu_4,
-        ROUND(cumulative_arppu_3, 2) AS cumulative_arppu_3,
-        ROUND(cumulative_arppu_2, 2) AS cumulative_arppu_2,
-        ROUND(cumulative_arppu_1, 2) AS cumulative_arppu_1
-    FROM cumulative_arppu;
-    """
-    execute_query(
-        engine,
-        insert_arppu_query,
-        f"Данные для таблицы {output_table} успешно добавлены.",
-        "Ошибка при добавлении данных в таблицу arppu_cumulative"
-    )  
+     
+def _events_hll_batch(input_table, cohorts_table, new_events, date_format):
+    """Возвращает CTE с пачкой событий и когортами её пользователей.
 
-def calculate_ltv_cohorts(engine, 
-                          input_table_1='cohorts_all', 
-                          input_table_2='cohorts_revenue_arppu_data', 
-                          output_table='ltv_cohorts'):
-    """Формирует таблицу с выручкой и LTV."""
-    
-    create_table_query = f"""
-    CREATE TABLE IF NOT EXISTS {output_table} (
-        cohort_month DATE,
-        total_users INTEGER,
-        revenue_month_12 NUMERIC(10, 2),
-        revenue_month_11 NUMERIC(10, 2),
-        revenue_month_10 NUMERIC(10, 2),
-        revenue_month_9 NUMERIC(10, 2),
-        revenue_month_8 NUMERIC(10, 2),
-        revenue_month_7 NUMERIC(10, 2),
-        revenue_month_6 NUMERIC(10, 2),
-        revenue_month_5 NUMERIC(10, 2),
-        revenue_month_4 NUMERIC(10, 2),
-        revenue_month_3 NUMERIC(10, 2),
-        revenue_month_2 NUMERIC(10, 2),
-        revenue_month_1 NUMERIC(10, 2),
-        ltv_month_12 NUMERIC(10, 2),
-        ltv_month_11 NUMERIC(10, 2),
-        ltv_month_10 NUMERIC(10, 2),
-        ltv_month_9 NUMERIC(10, 2),
-        ltv_month_8 NUMERIC(10, 2),
-        ltv_month_7 NUMERIC(10, 2),
-        ltv_month_6 NUMERIC(10, 2),
-        ltv_month_5 NUMERIC(10, 2),
-        ltv_month_4 NUMERIC(10, 2),
-        ltv_month_3 NUMERIC(10, 2),
-        ltv_month_2 NUMERIC(10, 2),
-        ltv_month_1 NUMERIC(10, 2),
-        PRIMARY KEY (cohort_month)
-    );
+    Без cohorts_table пачка считается полной историей, и когорта берётся
+    по первому действию в ней.
     """
-    execute_query(
-        engine, 
-        create_table_query,
-        f"Таблица {output_table} успешно создана.",
-        "Ошибка при создании таблицы ltv_cohorts"
-    )
-    insert_ltv_query = f"""
-    INSERT INTO {output_table} (
-        cohort_month, total_users, revenue_month_12, 
-        revenue_month_11, revenue_month_10,
-        revenue_month_9, revenue_month_8, revenue_month_7, 
-        revenue_month_6, revenue_month_5,
-        revenue_month_4, revenue_month_3, revenue_month_2, 
-        revenue_month_1, ltv_month_12, ltv_month_11, 
-        ltv_month_10, ltv_month_9, ltv_month_8, ltv_month_7,
-        ltv_month_6, ltv_month_5, ltv_month_4, ltv_month_3, 
-        ltv_month_2, ltv_month_1
-    )
-    SELECT 
-        a.cohort_month, 
-        COUNT(a.user_id) AS total_users,
-        COALESCE(b.revenue_month_12, 0) AS revenue_month_12,
-        COALESCE(b.revenue_month_11, 0) AS revenue_month_11,
-        COALESCE(b.revenue_month_10, 0) AS revenue_month_10,
-        COALESCE(b.revenue_month_9, 0) AS revenue_month_9,
-        COALESCE(b.revenue_month_8, 0) AS revenue_month_8,
-        COALESCE(b.revenue_month_7, 0) AS revenue_month_7,
-        COALESCE(b.revenue_month_6, 0) AS revenue_month_6,
-        COALESCE(b.revenue_month_5, 0) AS revenue_month_5,
-        COALESCE(b.revenue_month_4, 0) AS revenue_month_4,
-        COALESCE(b.revenue_month_3, 0) AS revenue_month_3,
-        COALESCE(b.revenue_month_2, 0) AS revenue_month_2,
-        COALESCE(b.revenue_month_1, 0) AS revenue_month_1,
-        ROUND(COALESCE(b.revenue_month_12, 0) / 
-            NULLIF(COUNT(a.user_id), 0), 2) AS ltv_month_12,
-        ROUND(COALESCE(b.revenue_month_11, 0) / 
-            NULLIF(COUNT(a.user_id), 0), 2) AS ltv_month_11,
-        ROUND(COALESCE(b.revenue_month_10, 0) / 
-            NULLIF(COUNT(a.user_id), 0), 2) AS ltv_month_10,
-        ROUND(COALESCE(b.revenue_month_9, 0) / 
-            NULLIF(COUNT(a.user_id), 0), 2) AS ltv_month_9,
-        ROUND(COALESCE(b.revenue_month_8, 0) / 
-            NULLIF(COUNT(a.user_id), 0), 2) AS ltv_month_8,
-        ROUND(COALESCE(b.revenue_month_7, 0) / 
-            NULLIF(COUNT(a.user_id), 0), 2) AS ltv_month_7,
-        ROUND(COALESCE(b.revenue_month_6, 0) / 
-            NULLIF(COUNT(a.user_id), 0), 2) AS ltv_month_6,
-        ROUND(COALESCE(b.revenue_month_5, 0) / 
-            NULLIF(COUNT(a.user_id), 0), 2) AS ltv_month_5,
-        ROUND(COALESCE(b.revenue_month_4, 0) / 
-            NULLIF(COUNT(a.user_id), 0), 2) AS ltv_month_4,
-        ROUND(COALESCE(b.revenue_month_3, 0) / 
-            NULLIF(COUNT(a.user_id), 0), 2) AS ltv_month_3,
-        ROUND(COALESCE(b.revenue_month_2, 0) / 
-            NULLIF(COUNT(a.user_id), 0), 2) AS ltv_month_2,
-        ROUND(COALESCE(b.revenue_month_1, 0) / 
-            NULLIF(COUNT(a.user_id), 0), 2) AS ltv_month_1
-    FROM 
-        {input_table_1} a
-    LEFT JOIN 
-        {input_table_2} b 
-        ON a.cohort_month = b.cohort_month
-    GROUP BY 
-        a.cohort_month, 
-        b.revenue_month_12, 
-        b.revenue_month_11, 
-        b.revenue_month_10, 
-        b.revenue_month_9, 
-        b.revenue_month_8, 
-        b.revenue_month_7, 
-        b.revenue_month_6, 
-        b.revenue_month_5, 
-        b.revenue_month_4, 
-        b.revenue_month_3, 
-        b.revenue_month_2, 
-        b.revenue_month_1
-    ORDER BY 
-        a.cohort_month
-    ON CONFLICT (cohort_month) DO NOTHING;
-    """ 
-    execute_query(
-        engine, 
-        insert_ltv_query,
-        f"Данные для таблицы {output_table} успешно добавлены.",
-        "Ошибка при добавлении данных в таблицу ltv_cohorts"
-    )
-
-def calculate_cumulative_ltv(engine, 
-                             input_table='ltv_cohorts', 
-                             output_table='cumulative_ltv', 
-                             date_format='DD.MM.YYYY HH24:MI'):
-    """Считает кумулятивную сумму LTV."""
-    
-    create_table_query = f"""
-    CREATE TABLE IF NOT EXISTS {output_table} (
-        cohort_month DATE,
-        total_users BIGINT,
-        ltv_cumulative_12 NUMERIC(10, 2),
-        ltv_cumulative_11 NUMERIC(10, 2),
-        ltv_cumulative_10 NUMERIC(10, 2),
-        ltv_cumulative_9 NUMERIC(10, 2),
-        ltv_cumulative_8 NUMERIC(10, 2),
-        ltv_cumulative_7 NUMERIC(10, 2),
-        ltv_cumulative_6 NUMERIC(10, 2),
-        ltv_cumulative_5 NUMERIC(10, 2),
-        ltv_cumulative_4 NUMERIC(10, 2),
-        ltv_cumulative_3 NUMERIC(10, 2),
-        ltv_cumulative_2 NUMERIC(10, 2),
-        ltv_cumulative_1 NUMERIC(10, 2),
-        PRIMARY KEY (cohort_month)
-    );
-    """
-    execute_query(
-        engine, 
-        create_table_query,
-        f"Таблица {output_table} успешно создана.",
-        "Ошибка при создании таблицы cumulative_ltv"
-    )
-    insert_ltv_query = f"""
-    INSERT INTO {output_table} (
-        cohort_month, total_users, ltv_cumulative_12, 
-        ltv_cumulative_11, ltv_cumulative_10, 
-        ltv_cumulative_9, ltv_cumulative_8, 
-        ltv_cumulative_7, ltv_cumulative_6, 
-        ltv_cumulative_5, ltv_cumulative_4, 
-        ltv_cumulative_3, ltv_cumulative_2, 
-        ltv_cumulative_1
-    )
-    SELECT 
-        cohort_month,
-        total_users,
-        ltv_month_12 AS ltv_cumulative_12,
-        (ltv_month_12 + ltv_month_11) AS ltv_cumulative_11,
-        (ltv_month_12 + ltv_month_11 + ltv_month_10) 
-            AS ltv_cumulative_10,
-        (ltv_month_12 + ltv_month_11 + ltv_month_10 + 
-            ltv_month_9) AS ltv_cumulative_9,
-        (ltv_month_12 + ltv_month_11 + ltv_month_10 + 
-            ltv_month_9 + ltv_month_8) AS ltv_cumulative_8,
-        (ltv_month_12 + ltv_month_11 + ltv_month_10 + 
-            ltv_month_9 + ltv_month_8 + ltv_month_7) 
-                AS ltv_cumulative_7,
-        (ltv_month_12 + ltv_month_11 + ltv_month_10 + 
-            ltv_month_9 + ltv_month_8 + ltv_month_7 + 
-                ltv_month_6) AS ltv_cumulative_6,
-        (ltv_month_12 + ltv_month_11 + ltv_month_10 + 
-            ltv_month_9 + ltv_month_8 + ltv_month_7 + 
-                ltv_month_6 + ltv_month_5) 
-                    AS ltv_cumulative_5,
-        (ltv_month_12 + ltv_month_11 + ltv_month_10 + 
-            ltv_month_9 + ltv_month_8 + ltv_month_7 + 
-                ltv_month_6 + ltv_month_5 + ltv_month_4) 
-                    AS ltv_cumulative_4,
-        (ltv_month_12 + ltv_month_11 + ltv_month_10 + 
-            ltv_month_9 + ltv_month_8 + ltv_month_7 + 
-                ltv_month_6 + ltv_month_5 + ltv_month_4 + 
-                    ltv_month_3) AS ltv_cumulative_3,
-        (ltv_month_12 + ltv_month_11 + ltv_month_10 + 
-            ltv_month_9 + ltv_month_8 + ltv_month_7 + 
-                ltv_month_6 + ltv_month_5 + ltv_month_4 + 
-                    ltv_month_3 + ltv_month_2) 
-                        AS ltv_cumulative_2,
-        (ltv_month_12 + ltv_month_11 + ltv_month_10 + 
-            ltv_month_9 + ltv_month_8 + ltv_month_7 + 
-                ltv_month_6 + ltv_month_5 + ltv_month_4 + 
-                    ltv_month_3 + ltv_month_2 + ltv_month_1) 
-                        AS ltv_cumulative_1
-    FROM {input_table}
-    ORDER BY cohort_month;
-    """
-    execute_query(
-        engine,
-        insert_ltv_query,
-        f"Данные для таблицы {output_table} успешно добавлены.",
-        "Ошибка при добавлении данных в таблицу cumulative_ltv"
-    )
-    
-def calculate_rr(engine, 
-                  input_table='orders', 
-                  output_table='rr_cohorts', 
-                  date_format='DD.MM.YYYY HH24:MI:SS'):
-    """Считает RR для когорт."""
-    
-    create_table_query = f"""
-    CREATE TABLE IF NOT EXISTS {output_table} (
-        cohort TEXT,
-        total_users BIGINT,
-        "RR Month 12" NUMERIC(5, 2),
-        "RR Month 11" NUMERIC(5, 2),
-        "RR Month 10" NUMERIC(5, 2),
-        "RR Month 9" NUMERIC(5, 2),
-        "RR Month 8" NUMERIC(5, 2),
-        "RR Month 7" NUMERIC(5, 2),
-        "RR Month 6" NUMERIC(5, 2),
-        "RR Month 5" NUMERIC(5, 2),
-        "RR Month 4" NUMERIC(5, 2),
-        "RR Month 3" NUMERIC(5, 2),
-        "RR Month 2" NUMERIC(5, 2),
-        "RR Month 1" NUMERIC(5, 2),
-        PRIMARY KEY (cohort)
-    );
-    """
-    execute_query(
-        engine, 
-        create_table_query,
-        f"Таблица {output_table} успешно создана.",
-        "Ошибка при создании таблицы rr_cohorts"
-    )
-    insert_retention_rate_query = f"""
-    WITH cohort AS (
+    known_month, known_source = "NULL::DATE", ""
+    if cohorts_table:
+        known_month = "MIN(cohort_month)"
+        known_source = f"FROM {cohorts_table} WHERE user_id = b.user_id"
+    return f"""
+    WITH batch AS MATERIALIZED (
         SELECT 
-            "OrderCustomerIdsMindboxId" AS user_id,
-            DATE_TRUNC('month', MIN(to_timestamp(
-                "OrderFirstActionDateTimeUtc", 
-                '{date_format}'))) AS cohort_month
+            "CustomerActionCustomerIdsMindboxId"::BIGINT AS user_id,
+            DATE_TRUNC('month', to_timestamp(
+                "CustomerActionDateTimeUtc", 
+                '{date_format}'))::DATE AS activity_month
         FROM {input_table}
-        WHERE "OrderLineStatusIdsExternalId" = 'Paid'
-        GROUP BY user_id
+        WHERE {new_events}
     ),
-    active_users AS (
+    batch_first AS (
         SELECT 
-            "OrderCustomerIdsMindboxId",
-            DATE_TRUNC('month', to_timestamp(
-                "OrderFirstActionDateTimeUtc", 
-                '{date_format}')) AS active_month
-        FROM {input_table}
-        WHERE "OrderLineStatusIdsExternalId" = 'Paid'
+            user_id, 
+            MIN(activity_month) AS first_month
+        FROM batch
+        GROUP BY user_id
     ),
-    user_counts AS (
+    batch_cohorts AS (
         SELECT 
-            cohort_month,
-            COUNT(user_id) AS total_users
-        FROM cohort
-        GROUP BY cohort_month
-    )
-    INSERT INTO {output_table} (
-        cohort, total_users, "RR Month 12", "RR Month 11", 
-        "RR Month 10", "RR Month 9", "RR Month 8", 
-        "RR Month 7", "RR Month 6", "RR Month 5", 
-        "RR Month 4", "RR Month 3", "RR Month 2", 
-        "RR Month 1"
-    )
-    SELECT 
-        TO_CHAR(c.cohort_month, 'YYYY-MM') AS cohort,
-        u.total_users,
-        ROUND(COUNT(DISTINCT CASE WHEN a.active_month = DATE_TRUNC(
-            'month', CURRENT_DATE) - INTERVAL '11 months' THEN 
-                a."OrderCustomerIdsMindboxId" END) * 100.0 / 
-                    NULLIF(u.total_users, 0), 2) AS "RR Month 12",
-        ROUND(COUNT(DISTINCT CASE WHEN a.active_month = DATE_TRUNC(
-            'month', CURRENT_DATE) - INTERVAL '10 months' THEN 
-                a."OrderCustomerIdsMindboxId" END) * 100.0 / 
-                    NULLIF(u.total_users, 0), 2) AS "RR Month 11",
-        ROUND(COUNT(DISTINCT CASE WHEN a.active_month = DATE_TRUNC(
-            'month', CURRENT_DATE) - INTERVAL '9 months' THEN 
-                a."OrderCustomerIdsMindboxId" END) * 100.0 / 
-                    NULLIF(u.total_users, 0), 2) AS "RR Month 10",
-        ROUND(COUNT(DISTINCT CASE WHEN a.active_month = DATE_TRUNC(
-            'month', CURRENT_DATE) - INTERVAL '8 months' THEN 
-                a."OrderCustomerIdsMindboxId" END) * 100.0 / 
-                    NULLIF(u.total_users, 0), 2) AS "RR Month 9",
-        ROUND(COUNT(DISTINCT CASE WHEN a.active_month = DATE_TRUNC(
-            'month', CURRENT_DATE) - INTERVAL '7 months' THEN 
-                a."OrderCustomerIdsMindboxId" END) * 100.0 / 
-                    NULLIF(u.total_users, 0), 2) AS "RR Month 8",
-        ROUND(COUNT(DISTINCT CASE WHEN a.active_month = DATE_TRUNC(
-            'month', CURRENT_DATE) - INTERVAL '6 months' THEN 
-                a."OrderCustomerIdsMindboxId" END) * 100.0 / 
-                    NULLIF(u.total_users, 0), 2) AS "RR Month 7",
-        ROUND(COUNT(DISTINCT CASE WHEN a.active_month = DATE_TRUNC(
-            'month', CURRENT_DATE) - INTERVAL '5 months' THEN 
-                a."OrderCustomerIdsMindboxId" END) * 100.0 / 
-                    NULLIF(u.total_users, 0), 2) AS "RR Month 6",
-        ROUND(COUNT(DISTINCT CASE WHEN a.active_month = DATE_TRUNC(
-            'month', CURRENT_DATE) - INTERVAL '4 months' THEN 
-                a."OrderCustomerIdsMindboxId" END) * 100.0 / 
-                    NULLIF(u.total_users, 0), 2) AS "RR Month 5",
-        ROUND(COUNT(DISTINCT CASE WHEN a.active_month = DATE_TRUNC(
-            'month', CURRENT_DATE) - INTERVAL '3 months' THEN 
-                a."OrderCustomerIdsMindboxId" END) * 100.0 / 
-                    NULLIF(u.total_users, 0), 2) AS "RR Month 4",
-        ROUND(COUNT(DISTINCT CASE WHEN a.active_month = DATE_TRUNC(
-            'month', CURRENT_DATE) - INTERVAL '2 months' THEN 
-                a."OrderCustomerIdsMindboxId" END) * 100.0 / 
-                    NULLIF(u.total_users, 0), 2) AS "RR Month 3",
-        ROUND(COUNT(DISTINCT CASE WHEN a.active_month = DATE_TRUNC(
-            'month', CURRENT_DATE) - INTERVAL '1 month' THEN 
-                a."OrderCustomerIdsMindboxId" END) * 100.0 / 
-                    NULLIF(u.total_users, 0), 2) AS "RR Month 2",
-        ROUND(COUNT(DISTINCT CASE WHEN a.active_month = DATE_TRUNC(
-            'month', CURRENT_DATE) - INTERVAL '0 month' THEN 
-                a."OrderCustomerIdsMindboxId" END) * 100.0 / 
-                    NULLIF(u.total_users, 0), 2) AS "RR Month 1"
-    FROM cohort c
-    LEFT JOIN active_users a ON c.user_id = a."OrderCustomerIdsMindboxId"
-    JOIN user_counts u ON c.cohort_month = u.cohort_month
-    GROUP BY c.cohort_month, u.total_users
-    ORDER BY c.cohort_month;
+            b.user_id,
+            b.first_month,
+            c.cohort_month AS known_month,
+            LEAST(b.first_month, c.cohort_month) AS cohort_month
+        FROM batch_first b
+        LEFT JOIN LATERAL (
+            SELECT {known_month} AS cohort_month
+            {known_source}
+        ) c ON TRUE
+    )"""
+
+def calculate_events_hll(engine, 
+                         input_table='events', 
+                         cohorts_table='cohorts_all', 
+                         output_table='events_hll', 
+                         log2m=14, 
+                         regwidth=5, 
+                         rebuild=False, 
+                         date_format='DD.MM.YYYY HH24:MI'):
+    """Дополняет HLL-скетчи активных пользователей по парам (когорта, месяц).
+
+    Скетчи строятся только по событиям из пачек загрузки после прошлого запуска,
+    и объединяются с сохранёнными через hll_union. Погрешность оценки около
+    1.04 / sqrt(2^log2m). Если в пачке у известного пользователя нашлось
+    действие раньше его когорты, скетчи пересобираются целиком: удалить
+    пользователя из HLL нельзя.
     """
     execute_query(
         engine,
-        insert_retention_rate_query,
-        f"Данные для таблицы {output_table} успешно добавлены.",
-        "Ошибка при добавлении данных в таблицу rr_cohorts"
-    )
-    
-def calculate_ac(engine, 
-                 input_table='orders', 
-                 output_table='ac_cohort', 
-                 date_format='DD.MM.YYYY HH24:MI:SS'):
-    """Формирует таблицу со средним чеком."""
-    
-    create_table_query = f"""
-    CREATE TABLE IF NOT EXISTS {output_table} (
-        cohort VARCHAR(7),
-        unique_users BIGINT,
-        average_check_current_month NUMERIC,
-        average_check_month_1 NUMERIC,
-        average_check_month_2 NUMERIC,
-        average_check_month_3 NUMERIC,
-        average_check_month_4 NUMERIC,
-        average_check_month_5 NUMERIC,
-        average_check_month_6 NUMERIC,
-        average_check_month_7 NUMERIC,
-        average_check_month_8 NUMERIC,
-        average_check_month_9 NUMERIC,
-        average_check_month_10 NUMERIC,
-        average_check_month_11 NUMERIC,
-        PRIMARY KEY (cohort)
-    );
-    """
-    execute_query(
-        engine, 
-        create_table_query,
+        f"""
+        CREATE EXTENSION IF NOT EXISTS hll;
+        CREATE TABLE IF NOT EXISTS {output_table} (
+            cohort_month DATE,
+            activity_month DATE,
+            users hll,
+            PRIMARY KEY (cohort_month, activity_month)
+        );
+        """,
         f"Таблица {output_table} успешно создана.",
-        "Ошибка при создании таблицы ac_cohort"
+        f"Ошибка при создании таблицы {output_table}"
     )
-    insert_revenue_query = f"""
-    INSERT INTO {output_table} (
-        cohort, unique_users, 
-        average_check_current_month, 
-        average_check_month_1, average_check_month_2, 
-        average_check_month_3, average_check_month_4, 
-        average_check_month_5, average_check_month_6, 
-        average_check_month_7, average_check_month_8, 
-        average_check_month_9, average_check_month_10, 
-        average_check_month_11
-    )
-    WITH cohort AS (
+    create_watermarks_table(engine)
+    watermark_name = batch_watermark(output_table)
+    max_batch = get_max_batch(engine, input_table)
+    last_batch = None if rebuild else get_watermark(engine, watermark_name)
+    if max_batch is None:
+        logger.info(f"Нет событий для построения {output_table}.")
+        return
+    if last_batch is not None and last_batch >= max_batch:
+        logger.info(f"Новых событий нет, скетчи {output_table} актуальны.")
+        return
+
+    new_events = batch_filter(last_batch, max_batch)
+    if last_batch is not None:
+        data, _ = execute_query(
+            engine,
+            _events_hll_batch(input_table, cohorts_table, new_events, date_format) + """
+            SELECT COUNT(*) FROM batch_cohorts WHERE first_month < known_month;
+            """,
+            error_message=f"Ошибка при проверке когорт для {output_table}",
+            fetch_results=True
+        )
+        if data and data[0][0]:
+            logger.info(f"У {data[0][0]} пользователей найдены действия раньше их когорты, "
+                        f"скетчи {output_table} пересобираются целиком.")
+            return calculate_events_hll(
+                engine, input_table, cohorts_table, output_table, 
+                log2m, regwidth, True, date_format)
+    else:
+        execute_query(
+            engine,
+            f"TRUNCATE {output_table};",
+            error_message=f"Ошибка при очистке таблицы {output_table}"
+        )
+
+    insert_hll_query = _events_hll_batch(
+        input_table, cohorts_table if last_batch is not None else None, 
+        new_events, date_format) + f"""
+    INSERT INTO {output_table} (cohort_month, activity_month, users)
     SELECT 
-            "OrderCustomerIdsMindboxId" AS user_id,
-            DATE_TRUNC('month', 
-            MIN(to_timestamp("OrderFirstActionDateTimeUtc", 
-            '{date_format}'))) AS cohort_month
-        FROM {input_table}
-        WHERE "OrderLineStatusIdsExternalId" = 'Paid'
-        GROUP BY user_id
+        c.cohort_month,
+        b.activity_month,
+        hll_add_agg(hll_hash_bigint(b.user_id), {int(log2m)}, {int(regwidth)})
+    FROM batch b
+    JOIN batch_cohorts c ON c.user_id = b.user_id
+    GROUP BY c.cohort_month, b.activity_month
+    ON CONFLICT (cohort_month, activity_month) DO UPDATE SET
+        users = hll_union({output_table}.users, EXCLUDED.users);
+    """
+    execute_query(
+        engine,
+        insert_hll_query,
+        f"Скетчи {output_table} обновлены.",
+        f"Ошибка при обновлении скетчей {output_table}"
     )
+    set_watermark(engine, watermark_name, max_batch)
+
+def create_events_hll_views(engine, input_table='events_hll'):
+    """Создает представления для дашборда поверх HLL-скетчей событий."""
+    create_views_query = f"""
+    CREATE OR REPLACE VIEW {input_table}_active_users AS
     SELECT 
-        TO_CHAR(cohort_month, 'YYYY-MM') AS cohort,
-        COUNT(DISTINCT user_id) AS unique_users,
-        ROUND(SUM(CASE WHEN DATE_TRUNC(
-            'month', 
-            to_timestamp("OrderFirstActionDateTimeUtc", 
-            '{date_format}')) = date_trunc(
-                'month', CURRENT_DATE) THEN 
-                "OrderTotalPrice" ELSE 0 END) / NULLIF(COUNT(
-                    CASE WHEN DATE_TRUNC('month', to_timestamp(
-                    "OrderFirstActionDateTimeUtc", 
-                    '{date_format}')) = date_trunc(
-                        'month', CURRENT_DATE) 
-                        THEN 1 END), 0), 2) 
-                            AS average_check_current_month,
-        ROUND(SUM(CASE WHEN DATE_TRUNC(
-            'month', 
-            to_timestamp("OrderFirstActionDateTimeUtc", 
-            '{date_format}')) = date_trunc(
-                'month', CURRENT_DATE - INTERVAL '1 month') THEN 
-                "OrderTotalPrice" ELSE 0 END) / NULLIF(COUNT(
-                    CASE WHEN DATE_TRUNC('month', to_timestamp(
-                    "OrderFirstActionDateTimeUtc", 
-                    '{date_format}')) = date_trunc(
-                        'month', CURRENT_DATE - INTERVAL '1 month') 
-                        THEN 1 END), 0), 2) 
-                            AS average_check_month_1,
-        ROUND(SUM(CASE WHEN DATE_TRUNC(
-            'month', 
-            to_timestamp("OrderFirstActionDateTimeUtc", 
-            '{date_format}')) = date_trunc(
-                'month', CURRENT_DATE - INTERVAL '2 months') THEN 
-                "OrderTotalPrice" ELSE 0 END) / NULLIF(COUNT(
-                    CASE WHEN DATE_TRUNC('month', to_timestamp(
-                    "OrderFirstActionDateTimeUtc", 
-                    '{date_format}')) = date_trunc(
-                        'month', CURRENT_DATE - INTERVAL '2 months') 
-                        THEN 1 END), 0), 2) 
-                            AS average_check_month_2,
-        ROUND(SUM(CASE WHEN DATE_TRUNC(
-            'month', 
-            to_timestamp("OrderFirstActionDateTimeUtc", 
-            '{date_format}')) = date_trunc(
-                'month', CURRENT_DATE - INTERVAL '3 months') 
-                THEN "OrderTotalPrice" ELSE 0 END) / NULLIF(COUNT(
-                    CASE WHEN DATE_TRUNC('month', to_timestamp(
-                    "OrderFirstActionDateTimeUtc", 
-                    '{date_format}')) = date_trunc(
-                        'month', CURRENT_DATE - INTERVAL '3 months') 
-                        THEN 1 END), 0), 2) 
-                            AS average_check_month_3,
-        ROUND(SUM(CASE WHEN DATE_TRUNC(
-            'month', 
-            to_timestamp("OrderFirstActionDateTimeUtc", 
-            '{date_format}')) = date_trunc(
-                'month', CURRENT_DATE - INTERVAL '4 months') 
-                THEN "OrderTotalPrice" ELSE 0 END) / NULLIF(COUNT(
-                    CASE WHEN DATE_TRUNC('month', to_timestamp(
-                    "OrderFirstActionDateTimeUtc", 
-                    '{date_format}')) = date_trunc(
-                        'month', CURRENT_DATE - INTERVAL '4 months') 
-                        THEN 1 END), 0), 2) 
-                            AS average_check_month_4,
-        ROUND(SUM(CASE WHEN DATE_TRUNC(
-            'month', 
-            to_timestamp("OrderFirstActionDateTimeUtc", 
-            '{date_format}')) = date_trunc(
-                'month', CURRENT_DATE - INTERVAL '5 months') 
-                THEN "OrderTotalPrice" ELSE 0 END) / NULLIF(COUNT(
-                    CASE WHEN DATE_TRUNC('month', to_timestamp(
-                    "OrderFirstActionDateTimeUtc", 
-                    '{date_format}')) = date_trunc(
-                        'month', CURRENT_DATE - INTERVAL '5 months') 
-                        THEN 1 END), 0), 2) 
-                            AS average_check_month_5,
-        ROUND(SUM(CASE WHEN DATE_TRUNC(
-            'month', 
-            to_timestamp("OrderFirstActionDateTimeUtc", 
-            '{date_format}')) = date_trunc(
-                'month', CURRENT_DATE - INTERVAL '6 months') 
-                THEN "OrderTotalPrice" ELSE 0 END) / NULLIF(COUNT(
-                    CASE WHEN DATE_TRUNC('month', to_timestamp(
-                    "OrderFirstActionDateTimeUtc", 
-                    '{date_format}')) = date_trunc(
-                        'month', CURRENT_DATE - INTERVAL '6 months') 
-                        THEN 1 END), 0), 2) 
-                            AS average_check_month_6,
-        ROUND(SUM(CASE WHEN DATE_TRUNC(
-            'month', 
-            to_timestamp("OrderFirstActionDateTimeUtc", 
-            '{date_format}')) = date_trunc(
-                'month', CURRENT_DATE - INTERVAL '7 months') 
-                THEN "OrderTotalPrice" ELSE 0 END) / NULLIF(COUNT(
-                    CASE WHEN DATE_TRUNC('month', to_timestamp(
-                    "OrderFirstActionDateTimeUtc", 
-                    '{date_format}')) = date_trunc(
-                        'month', CURRENT_DATE - INTERVAL '7 months') 
-                        THEN 1 END), 0), 2) 
-                            AS average_check_month_7,
-        ROUND(SUM(CASE WHEN DATE_TRUNC(
-            'month', 
-            to_timestamp("OrderFirstActionDateTimeUtc", 
-            '{date_format}')) = date_trunc(
-                'month', CURRENT_DATE - INTERVAL '8 months') 
-                THEN "OrderTotalPrice" ELSE 0 END) / NULLIF(COUNT(
-                    CASE WHEN DATE_TRUNC('month', to_timestamp(
-                    "OrderFirstActionDateTimeUtc", 
-                    '{date_format}')) = date_trunc(
-                        'month', CURRENT_DATE - INTERVAL '8 months') 
-                        THEN 1 END), 0), 2) AS average_check_month_8,
-        ROUND(SUM(CASE WHEN DATE_TRUNC(
-            'month', 
-            to_timestamp("OrderFirstActionDateTimeUtc", 
-            '{date_format}')) = date_trunc(
-                'month', CURRENT_DATE - INTERVAL '9 months') 
-                THEN "OrderTotalPrice" ELSE 0 END) / NULLIF(COUNT(
-                    CASE WHEN DATE_TRUNC('month', to_timestamp(
-                    "OrderFirstActionDateTimeUtc", 
-                    '{date_format}')) = date_trunc(
-                        'month', CURRENT_DATE - INTERVAL '9 months') 
-                        THEN 1 END), 0), 2) 
-                            AS average_check_month_9,
-        ROUND(SUM(CASE WHEN DATE_TRUNC(
-            'month', 
-            to_timestamp("OrderFirstActionDateTimeUtc", 
-            '{date_format}')) = date_trunc(
-                'month', CURRENT_DATE - INTERVAL '10 months') 
-                THEN "OrderTotalPrice" ELSE 0 END) / NULLIF(COUNT(
-                    CASE WHEN DATE_TRUNC('month', to_timestamp(
-                    "OrderFirstActionDateTimeUtc", 
-                    '{date_format}')) = date_trunc(
-                        'month', CURRENT_DATE - INTERVAL '10 months') 
-                        THEN 1 END), 0), 2) 
-                            AS average_check_month_10,
-        ROUND(SUM(CASE WHEN DATE_TRUNC(
-            'month', 
-            to_timestamp("OrderFirstActionDateTimeUtc", 
-            '{date_format}')) = date_trunc(
-                'month', CURRENT_DATE - INTERVAL '11 months') 
-                THEN "OrderTotalPrice" ELSE 0 END) / NULLIF(COUNT(
-                    CASE WHEN DATE_TRUNC('month', to_timestamp(
-                    "OrderFirstActionDateTimeUtc", 
-                    '{date_format}')) = date_trunc(
-                        'month', CURRENT_DATE - INTERVAL '11 months') 
-                        THEN 1 END), 0), 2) 
-                            AS average_check_month_11
+        activity_month,
+        ROUND(hll_cardinality(hll_union_agg(users)))::BIGINT AS active_users
     FROM {input_table}
-    JOIN cohort ON {input_table}."OrderCustomerIdsMindboxId" = cohort.user_id
-    WHERE "OrderLineStatusIdsExternalId" = 'Paid'
-    GROUP BY cohort_month
-    ORDER BY cohort_month ASC;
+    GROUP BY activity_month;
+
+    CREATE OR REPLACE VIEW {input_table}_retention AS
+    SELECT 
+        h.cohort_month,
+        h.activity_month,
+        ((EXTRACT(YEAR FROM AGE(h.activity_month, h.cohort_month)) * 12 + 
+            EXTRACT(MONTH FROM AGE(h.activity_month, h.cohort_month))))::INT 
+                AS month_offset,
+        ROUND(hll_cardinality(s.users))::BIGINT AS cohort_users,
+        ROUND(hll_cardinality(h.users))::BIGINT AS active_users,
+        ROUND((hll_cardinality(h.users) * 100.0 / 
+            NULLIF(hll_cardinality(s.users), 0))::NUMERIC, 2) AS retention_rate
+    FROM {input_table} h
+    JOIN {input_table} s 
+        ON s.cohort_month = h.cohort_month 
+        AND s.activity_month = h.cohort_month;
     """
     execute_query(
-        engine, 
-        insert_revenue_query,
-        "Данные успешно вставлены в таблицу."
+        engine,
+        create_views_query,
+        f"Представления для {input_table} успешно созданы.",
+        f"Ошибка при создании представлений для {input_table}"
     )
-    
-def calculate_cdr(engine):
-    query = """
-    WITH donor_activity AS (
+
+def _cohort_metrics_is_current(engine, output_table, as_of=None):
+    """Проверяет, что витрина рассчитана в том же месяце, что и as_of, и не позже неё."""
+    as_of_date = _as_of_date(as_of)
+    data, _ = execute_query(
+        engine,
+        f"""
+        SELECT COUNT(*) FROM {output_table}
+        WHERE DATE_TRUNC('month', as_of) = DATE_TRUNC('month', {as_of_date})
+            AND as_of <= {as_of_date};
+        """,
+        error_message=f"Ошибка при проверке актуальности {output_table}",
+        fetch_results=True
+    )
+    return bool(data and data[0][0])
+
+def _cohort_metrics_select(input_table='orders', 
+                           cohorts_table='cohorts_all', 
+                           paid_cohorts_table='cohorts_paid', 
+                           horizon=COHORT_HORIZON, 
+                           date_format='DD.MM.YYYY HH24:MI', 
+                           cohort_filter="", 
+                           as_of=None):
+    """Возвращает запрос, считающий сетку когортных метрик (когорта, месяц).
+
+    month — номер месяца от начала когорты (1 — месяц начала); в сетку
+    попадают месяцы не позже as_of, заказы учитываются по дату as_of.
+    cohort_filter — дополнительное условие на cohort_month.
+    """
+    as_of_date = _as_of_date(as_of)
+    as_of_month = f"DATE_TRUNC('month', {as_of_date})::DATE"
+    cohort_where = f"\n        WHERE cohort_month <= {as_of_month}"
+    if cohort_filter:
+        cohort_where += f"\n            AND {cohort_filter}"
+    # paid читается один раз и встраивается в activity, поэтому при шардировании
+    # планировщик соединяет заказы только с пользователями своего диапазона.
+    return f"""
+    WITH paid AS (
         SELECT 
-            "OrderCustomerIdsMindboxId" AS donor_id,
+            "OrderCustomerIdsMindboxId" AS user_id,
             DATE_TRUNC('month', to_timestamp(
                 "OrderFirstActionDateTimeUtc", 
-                'DD.MM.YYYY HH24:MI')) AS month,
-            COUNT(*) AS donation_count
-        FROM orders
+                '{date_format}'))::DATE AS activity_month,
+            "OrderTotalPrice" AS price
+        FROM {input_table}
         WHERE "OrderLineStatusIdsExternalId" = 'Paid'
-        GROUP BY "OrderCustomerIdsMindboxId", month
-    ),
-    donor_status AS (
-        SELECT 
-            da1.month,
-            COUNT(DISTINCT da1.donor_id) AS total_donors,
-            COUNT(DISTINCT da2.donor_id) AS retained_donors
-        FROM donor_activity da1
-        LEFT JOIN donor_activity da2 
-            ON da1.donor_id = da2.donor_id 
-            AND da2.month > da1.month 
-            AND da2.month <= da1.month + interval '3 months'
-        GROUP BY da1.month
-    ),
-    churn_rate AS (
-        SELECT 
-            month,
-            CASE
-                WHEN total_donors > 0 THEN
-                    ROUND((
-                        total_donors - retained_donors) * 100.0 / 
-                        total_donors, 2)
-                ELSE NULL
-            END AS churn_rate
-        FROM donor_status
-    ),
-    new_donors AS (
-        SELECT 
-            "OrderCustomerIdsMindboxId" AS donor_id,
-            DATE_TRUNC('month', to_timestamp(
+            AND to_timestamp(
                 "OrderFirstActionDateTimeUtc", 
-                'DD.MM.YYYY HH24:MI')) AS month
-        FROM orders
-        WHERE "OrderLineStatusIdsExternalId" = 'Paid'
-        GROUP BY donor_id, month
+                '{date_format}') < {as_of_date} + 1
     ),
-    first_donors AS (
+    paid_cohorts AS (
         SELECT 
-            donor_id,
-            MIN(month) AS first_month
-        FROM new_donors
-        GROUP BY donor_id
+            user_id, 
+            cohort_month
+        FROM {paid_cohorts_table}{cohort_where}
     ),
-    monthly_new_donors AS (
+    paid_sizes AS (
         SELECT 
-            DATE_TRUNC('month', first_month) AS month,
-            COUNT(*) AS new_donors_count
-        FROM first_donors
-        GROUP BY month
+            cohort_month, 
+            COUNT(*) AS total_users
+        FROM paid_cohorts
+        GROUP BY cohort_month
     ),
-    total_donors AS (
+    all_sizes AS (
         SELECT 
-            DATE_TRUNC('month', to_timestamp(
-                "OrderFirstActionDateTimeUtc", 
-                'DD.MM.YYYY HH24:MI')) AS month,
-            COUNT(DISTINCT "OrderCustomerIdsMindboxId") AS total_donors_count
-        FROM orders
-        WHERE "OrderLineStatusIdsExternalId" = 'Paid'
-        GROUP BY month
+            cohort_month, 
+            COUNT(user_id) AS all_users
+        FROM {cohorts_table}{cohort_where}
+        GROUP BY cohort_month
     ),
-    new_donors_ratio AS (
-        SELECT 
-            mnd.month,
-            ROUND(
-                COALESCE(
-                    mnd.new_donors_count, 0) * 100.0 / 
-                    NULLIF(td.total_donors_count, 0), 2) AS new_donors_ratio
-        FROM total_donors td
-        LEFT JOIN monthly_new_donors mnd ON td.month = mnd.month
+    months AS (
+        SELECT m AS month
+        FROM generate_series(1, {horizon}) AS m
     ),
-    monthly_donors AS (
+    activity AS (
         SELECT 
-            DATE_TRUNC('month', to_timestamp(
-                "OrderFirstActionDateTimeUtc", 
-                'DD.MM.YYYY HH24:MI')) AS month,
-            "OrderCustomerIdsMindboxId",
-            COUNT(*) AS donation_count,
-            MIN(to_timestamp(
-                "OrderFirstActionDateTimeUtc", 
-                'DD.MM.YYYY HH24:MI')) AS first_donation_date,
-            MAX(to_timestamp(
-                "OrderFirstActionDateTimeUtc", 
-                'DD.MM.YYYY HH24:MI')) AS last_donation_date
-        FROM orders
-        WHERE "OrderLineStatusIdsExternalId" = 'Paid'
-        GROUP BY month, "OrderCustomerIdsMindboxId"
-        HAVING COUNT(*) > 1
+            c.cohort_month,
+            p.activity_month,
+            COUNT(DISTINCT p.user_id) AS active_users,
+            COUNT(*) AS orders,
+            SUM(p.price) AS revenue
+        FROM paid p
+        JOIN paid_cohorts c ON c.user_id = p.user_id
+        WHERE p.activity_month < c.cohort_month + INTERVAL '{horizon} months'
+        GROUP BY c.cohort_month, p.activity_month
     ),
-    avg_days_between_donations AS (
-        SELECT 
-            md.month,
-            ROUND(AVG(EXTRACT(
-                EPOCH FROM (md.last_donation_date - md.first_donation_date)) / 
-                    86400), 2) AS avg_days_between_donations
-        FROM monthly_donors md
-        GROUP BY md.month
+    cohorts AS (
+        SELECT cohort_month FROM paid_sizes
+        UNION
+        SELECT cohort_month FROM all_sizes
     ),
-    next_three_months AS (
+    grid AS (
         SELECT 
-            current_month.month,
-            ROUND(AVG(
-                next_months.avg_days_between_donations), 2) AS avg_days_between_donations
-        FROM avg_days_between_donations current_month
-        LEFT JOIN avg_days_between_donations next_months
-            ON next_months.month > current_month.month
-            AND next_months.month <= (current_month.month + INTERVAL '3 months')
-        GROUP BY current_month.month
+            c.cohort_month,
+            m.month,
+            am.activity_month,
+            ps.total_users,
+            als.all_users,
+            COALESCE(a.active_users, 0) AS active_users,
+            COALESCE(a.orders, 0) AS orders,
+            COALESCE(a.revenue, 0) AS revenue,
+            COALESCE(a.revenue, 0) / COALESCE(NULLIF(
+                ps.total_users, 0), 1) AS arppu,
+            ROUND(COALESCE(a.revenue, 0) / 
+                NULLIF(als.all_users, 0), 2) AS ltv
+        FROM cohorts c
+        CROSS JOIN months m
+        CROSS JOIN LATERAL (
+            SELECT (c.cohort_month + 
+                (m.month - 1) * INTERVAL '1 month')::DATE AS activity_month
+        ) am
+        LEFT JOIN paid_sizes ps ON ps.cohort_month = c.cohort_month
+        LEFT JOIN all_sizes als ON als.cohort_month = c.cohort_month
+        LEFT JOIN activity a 
+            ON a.cohort_month = c.cohort_month 
+            AND a.activity_month = am.activity_month
+        WHERE am.activity_month <= {as_of_month}
     )
     SELECT 
-        cr.month,
-        cr.churn_rate,
-        COALESCE(ndr.new_donors_ratio, 0) AS new_donors_ratio,
-        COALESCE(n3m.avg_days_between_donations, 0) AS avg_days_between_donations
-    FROM churn_rate cr
-    LEFT JOIN new_donors_ratio ndr ON cr.month = ndr.month
-    LEFT JOIN next_three_months n3m ON cr.month = n3m.month
-    ORDER BY cr.month;
-    """
-    metrics_data, columns = execute_query(
-        engine, query, 
-        "Метрики CDR успешно рассчитаны.", 
-        "Ошибка при расчете метрик!", fetch_results=True)
-
-    if metrics_data is not None:
-        create_table_query = """
-        CREATE TABLE IF NOT EXISTS cdr (
-            month DATE PRIMARY KEY,
-            churn_rate NUMERIC,
-            new_donors_ratio NUMERIC,
-            avg_days_between_donations NUMERIC
-        );
-        """
-        execute_query(
-            engine, 
-            create_table_query, 
-            "Таблица CDR создана.", 
-            "Ошибка при создании таблицы CDR!")
-
-        for row in metrics_data:
-            insert_query = text("""
-            INSERT INTO cdr (month, churn_rate, new_donors_ratio, avg_days_between_donations)
-            VALUES (:month, :churn_rate, :new_donors_ratio, :avg_days_between_donations)
-            ON CONFLICT (month) DO NOTHING;
-            """)
-            insert_data = {
-                'month': row[0],
-                'churn_rate': row[1],
-                'new_donors_ratio': row[2],
-                'avg_days_between_donations': row[3]
-            }
-            with engine.begin() as conn:
-                conn.execute(insert_query, insert_data)
-           
-def transpon_ltv(
-    engine, 
-    input_table='ltv_cohorts', 
-    output_table='ltv_t'
-    ):
-    """Преобразует таблицу ltv_cohorts в плоский формат."""
+        {as_of_date} AS as_of,
+        cohort_month,
+        month,
+        activity_month,
+        total_users,
+        all_users,
+        active_users,
+        orders,
+        revenue,
+        arppu,
+        -- Накопление идёт от месяца начала когорты (month = 1).
+        ROUND(SUM(arppu) OVER w, 2) AS cumulative_arppu,
+        ltv,
+        SUM(ltv) OVER w AS cumulative_ltv,
+        ROUND(active_users * 100.0 / NULLIF(total_users, 0), 2) AS rr,
+        ROUND(revenue / NULLIF(orders, 0), 2) AS average_check
+    FROM grid
+    WINDOW w AS (PARTITION BY cohort_month ORDER BY month)"""
 
-    create_table_query = f"""
-    CREATE TABLE IF NOT EXISTS {output_table} (
-        cohort_month DATE,
-        month INT,
-        ltv NUMERIC,
-        PRIMARY KEY (cohort_month, month)
-    );
-    """
-    execute_query(
-        engine, 
-        create_table_query,
-        f"Таблица {output_table} успешно создана.",
-        "Ошибка при создании таблицы ltv_t"
-    )
-    insert_ltv_query = f"""
-    INSERT INTO {output_table} (cohort_month, month, ltv)
-    WITH flattened_ltv AS (
-        SELECT
-            cohort_month,
-            1 AS month,
-            ltv_month_1 AS ltv
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            2 AS month,
-            ltv_month_2 AS ltv
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            3 AS month,
-            ltv_month_3 AS ltv
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            4 AS month,
-            ltv_month_4 AS ltv
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            5 AS month,
-            ltv_month_5 AS ltv
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            6 AS month,
-            ltv_month_6 AS ltv
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            7 AS month,
-            ltv_month_7 AS ltv
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            8 AS month,
-            ltv_month_8 AS ltv
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            9 AS month,
-            ltv_month_9 AS ltv
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            10 AS month,
-            ltv_month_10 AS ltv
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            11 AS month,
-            ltv_month_11 AS ltv
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            12 AS month,
-            ltv_month_12 AS ltv
-        FROM {input_table}
-    )
-    SELECT cohort_month, month, ltv
-    FROM flattened_ltv
-    ON CONFLICT (cohort_month, month) DO NOTHING;
+def _cohort_ranges(engine, cohorts_table, shards):
+    """Делит когорты на shards диапазонов cohort_month с близким числом пользователей.
+
+    Возвращает условия на cohort_month; крайние диапазоны открыты, поэтому
+    когорты, которых нет в cohorts_table, тоже попадают в какой-то шард.
     """
-    execute_query(
+    data, _ = execute_query(
         engine,
-        insert_ltv_query,
-        f"Данные для таблицы {output_table} успешно добавлены.",
-        "Ошибка при добавлении данных в таблицу ltv_t"
+        f"""
+        SELECT cohort_month, COUNT(*) 
+        FROM {cohorts_table} 
+        GROUP BY cohort_month 
+        ORDER BY cohort_month;
+        """,
+        error_message=f"Ошибка при чтении размеров когорт из {cohorts_table}",
+        fetch_results=True
     )
-    
-def transpon_revenue(
-    engine, 
-    input_table='ltv_cohorts', 
-    output_table='revenue_t'
-    ):
-    """Преобразует таблицу ltv_cohorts в плоский формат."""
-    
+    sizes = data or []
+    total = sum(count for _, count in sizes)
+    bounds = []
+    seen = 0
+    for cohort_month, count in sizes:
+        # Граница ставится перед когортой, середина которой уже за целевой долей.
+        target = total * (len(bounds) + 1) / shards
+        if seen and len(bounds) < shards - 1 and seen + count / 2 > target:
+            bounds.append(cohort_month)
+        seen += count
+    edges = [None] + bounds + [None]
+    ranges = []
+    for start, end in zip(edges, edges[1:]):
+        conditions = []
+        if start is not None:
+            conditions.append(f"cohort_month >= DATE '{start}'")
+        if end is not None:
+            conditions.append(f"cohort_month < DATE '{end}'")
+        ranges.append(" AND ".join(conditions) or "TRUE")
+    return ranges
+
+def create_cohort_metrics_table(engine, 
+                                output_table='cohort_metrics', 
+                                keep_snapshots=False):
+    """Создаёт таблицу cohort_metrics.
+
+    С keep_snapshots=True в ключ входит as_of, и таблица хранит расчёты
+    на несколько дат.
+    """
+    key = "as_of, cohort_month, month" if keep_snapshots else "cohort_month, month"
     create_table_query = f"""
     CREATE TABLE IF NOT EXISTS {output_table} (
+        as_of DATE,
         cohort_month DATE,
         month INT,
+        activity_month DATE,
+        total_users BIGINT,
+        all_users BIGINT,
+        active_users BIGINT,
+        orders BIGINT,
         revenue NUMERIC,
-        PRIMARY KEY (cohort_month, month)
+        arppu NUMERIC,
+        cumulative_arppu NUMERIC,
+        ltv NUMERIC,
+        cumulative_ltv NUMERIC,
+        rr NUMERIC,
+        average_check NUMERIC,
+        PRIMARY KEY ({key})
     );
+    -- Строки без as_of посчитаны по календарным месяцам и будут пересчитаны.
+    -- ALTER берёт эксклюзивную блокировку, поэтому выполняется только при нужде.
+    DO $$
+    BEGIN
+        IF NOT EXISTS (
+            SELECT 1 FROM pg_attribute 
+            WHERE attrelid = to_regclass('{output_table}') 
+                AND attname = 'as_of' 
+                AND NOT attisdropped
+        ) THEN
+            ALTER TABLE {output_table} ADD COLUMN as_of DATE;
+        END IF;
+    END $$;
     """
     execute_query(
         engine, 
         create_table_query,
         f"Таблица {output_table} успешно создана.",
-        "Ошибка при создании таблицы revenue_t"
+        "Ошибка при создании таблицы cohort_metrics"
     )
-    insert_revenue_query = f"""
-    INSERT INTO {output_table} (cohort_month, month, revenue)
-    WITH flattened_revenue AS (
-        SELECT
-            cohort_month,
-            1 AS month,
-            revenue_month_1 AS revenue
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            2 AS month,
-            revenue_month_2 AS revenue
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            3 AS month,
-            revenue_month_3 AS revenue
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            4 AS month,
-            revenue_month_4 AS revenue
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            5 AS month,
-            revenue_month_5 AS revenue
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            6 AS month,
-            revenue_month_6 AS revenue
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            7 AS month,
-            revenue_month_7 AS revenue
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            8 AS month,
-            revenue_month_8 AS revenue
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            9 AS month,
-            revenue_month_9 AS revenue
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            10 AS month,
-            revenue_month_10 AS revenue
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            11 AS month,
-            revenue_month_11 AS revenue
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            12 AS month,
-            revenue_month_12 AS revenue
-        FROM {input_table}
-    )
-    SELECT cohort_month, month, revenue
-    FROM flattened_revenue
-    ON CONFLICT (cohort_month, month) DO NOTHING;
+    return key
+
+def calculate_cohort_metrics(engine, 
+                             input_table='orders', 
+                             cohorts_table='cohorts_all', 
+                             paid_cohorts_table='cohorts_paid', 
+                             output_table='cohort_metrics', 
+                             changes_table='cohort_changes', 
+                             horizon=COHORT_HORIZON, 
+                             incremental=False, 
+                             date_format='DD.MM.YYYY HH24:MI', 
+                             as_of=None, 
+                             keep_snapshots=False, 
+                             shards=1):
+    """Считает когортные метрики в длинном формате за один проход.
+
+    Одна строка на пару (когорта, месяц), где month — номер месяца от
+    начала когорты: month = 1 — месяц начала, month = horizon — последний
+    в горизонте. Расчёт ведётся на дату as_of (по умолчанию — текущую),
+    поэтому повторный запуск с той же as_of даёт тот же результат.
+    Выручка, число активных пользователей и заказов агрегируются одним
+    GROUP BY, производные метрики (ARPPU, LTV, RR, средний чек и их
+    кумулятивные варианты) считаются по этой сетке.
+
+    С incremental=True пересчитываются только когорты из changes_table;
+    в новом месяце as_of витрина пересчитывается целиком. С keep_snapshots=True
+    строки прочих дат as_of не затрагиваются (см. backfill_cohort_metrics).
+
+    С shards > 1 полный пересчёт делится на диапазоны когорт с близким
+    числом платящих пользователей, которые считаются параллельными
+    запросами в нежурналируемую промежуточную таблицу; витрина
+    заменяется её содержимым одной транзакцией.
     """
-    execute_query(
-        engine,
-        insert_revenue_query,
-        f"Данные для таблицы {output_table} успешно добавлены.",
-        "Ошибка при добавлении данных в таблицу revenue_t"
-    )
-    
-def transpon_cumulative_ltv(
-    engine, 
-    input_table='cumulative_ltv', 
-    output_table='ltv_cum_t'
-    ):
-    """Преобразует таблицу cumulative_ltv в плоский формат."""
-    
-    create_table_query = f"""
-    CREATE TABLE IF NOT EXISTS {output_table} (
-        cohort_month DATE,
-        month INT,
-        ltv_cumulative NUMERIC,
-        PRIMARY KEY (cohort_month, month)
-    );
+    key = create_cohort_metrics_table(engine, output_table, keep_snapshots)
+    as_of_date = _as_of_date(as_of)
+    if keep_snapshots:
+        incremental = False
+        delete_query = f"""
+    DELETE FROM {output_table} WHERE as_of = {as_of_date};
     """
-    execute_query(
-        engine, 
-        create_table_query,
-        f"Таблица {output_table} успешно создана.",
-        "Ошибка при создании таблицы ltv_cum_t"
-    )
-    insert_ltv_cumulative_query = f"""
-    INSERT INTO {output_table} (cohort_month, month, ltv_cumulative)
-    WITH flattened_ltv AS (
-        SELECT
-            cohort_month,
-            1 AS month,
-            ltv_cumulative_1 AS ltv_cumulative
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            2 AS month,
-            ltv_cumulative_2 AS ltv_cumulative
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            3 AS month,
-            ltv_cumulative_3 AS ltv_cumulative
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            4 AS month,
-            ltv_cumulative_4 AS ltv_cumulative
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            5 AS month,
-            ltv_cumulative_5 AS ltv_cumulative
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            6 AS month,
-            ltv_cumulative_6 AS ltv_cumulative
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            7 AS month,
-            ltv_cumulative_7 AS ltv_cumulative
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            8 AS month,
-            ltv_cumulative_8 AS ltv_cumulative
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            9 AS month,
-            ltv_cumulative_9 AS ltv_cumulative
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            10 AS month,
-            ltv_cumulative_10 AS ltv_cumulative
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            11 AS month,
-            ltv_cumulative_11 AS ltv_cumulative
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            12 AS month,
-            ltv_cumulative_12 AS ltv_cumulative
-        FROM {input_table}
-    )
-    SELECT cohort_month, month, ltv_cumulative
-    FROM flattened_ltv
-    ON CONFLICT (cohort_month, month) DO NOTHING;
+    else:
+        # Сетка зависит от as_of, поэтому полный пересчёт заменяет все строки.
+        delete_query = f"""
+    DELETE FROM {output_table};
     """
-    execute_query(
-        engine,
-        insert_ltv_cumulative_query,
-        f"Данные для таблицы {output_table} успешно добавлены.",
-        "Ошибка при добавлении данных в таблицу ltv_cum_t"
-    )
-    
-def transpon_arppu(
-    engine, 
-    input_table='cohorts_revenue_arppu_data', 
-    output_table='arppu_t'
-    ):
-    """Преобразует таблицу cohorts_revenue_arppu_data в плоский формат."""
-    
-    create_table_query = f"""
-    CREATE TABLE IF NOT EXISTS {output_table} (
-        cohort_month DATE,
-        month INT,
-        arppu NUMERIC,
-        PRIMARY KEY (cohort_month, month)
-    );
+
+    max_change = None
+    if not keep_snapshots:
+        create_cohort_changes_table(engine, changes_table)
+        data, _ = execute_query(
+            engine,
+            f"SELECT MAX(id) FROM {changes_table};",
+            error_message=f"Ошибка при чтении таблицы {changes_table}",
+            fetch_results=True
+        )
+        max_change = data[0][0] if data else None
+
+    cohort_filter = ""
+    update_as_of_query = ""
+    if incremental and _cohort_metrics_is_current(engine, output_table, as_of):
+        if max_change is None:
+            logger.info(f"Изменённых когорт нет, {output_table} не пересчитывается.")
+            return
+        changed = f"""(
+            SELECT cohort_month FROM {changes_table} 
+            WHERE id <= {int(max_change)})"""
+        cohort_filter = f"cohort_month IN {changed}"
+        # Когорта могла опустеть после переноса пользователей в более раннюю.
+        delete_query = f"""
+    DELETE FROM {output_table} WHERE cohort_month IN {changed};
     """
-    execute_query(
-        engine, 
-        create_table_query,
-        f"Таблица {output_table} успешно создана.",
-        "Ошибка при создании таблицы arppu_t"
+        update_as_of_query = f"""
+    UPDATE {output_table} SET as_of = {as_of_date} 
+    WHERE as_of IS DISTINCT FROM {as_of_date};
+    """
+        logger.info(f"{output_table}: пересчитываются только изменённые когорты.")
+
+    def insert_query(cohort_filter, target=output_table):
+        return f"""
+    INSERT INTO {target} (
+        as_of, cohort_month, month, activity_month, 
+        total_users, all_users, active_users, orders, revenue, 
+        arppu, cumulative_arppu, ltv, cumulative_ltv, 
+        rr, average_check
     )
-    insert_arppu_query = f"""
-    INSERT INTO {output_table} (cohort_month, month, arppu)
-    WITH flattened_arppu AS (
-        SELECT
-            cohort_month,
-            1 AS month,
-            arppu_month_1 AS arppu
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            2 AS month,
-            arppu_month_2 AS arppu
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            3 AS month,
-            arppu_month_3 AS arppu
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            4 AS month,
-            arppu_month_4 AS arppu
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            5 AS month,
-            arppu_month_5 AS arppu
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            6 AS month,
-            arppu_month_6 AS arppu
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            7 AS month,
-            arppu_month_7 AS arppu
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            8 AS month,
-            arppu_month_8 AS arppu
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            9 AS month,
-            arppu_month_9 AS arppu
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            10 AS month,
-            arppu_month_10 AS arppu
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            11 AS month,
-            arppu_month_11 AS arppu
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            12 AS month,
-            arppu_month_12 AS arppu
-        FROM {input_table}
+    {_cohort_metrics_select(input_table, cohorts_table, paid_cohorts_table, 
+                            horizon, date_format, cohort_filter, as_of)}
+    ON CONFLICT ({key}) DO UPDATE SET
+        as_of = EXCLUDED.as_of,
+        activity_month = EXCLUDED.activity_month,
+        total_users = EXCLUDED.total_users,
+        all_users = EXCLUDED.all_users,
+        active_users = EXCLUDED.active_users,
+        orders = EXCLUDED.orders,
+        revenue = EXCLUDED.revenue,
+        arppu = EXCLUDED.arppu,
+        cumulative_arppu = EXCLUDED.cumulative_arppu,
+        ltv = EXCLUDED.ltv,
+        cumulative_ltv = EXCLUDED.cumulative_ltv,
+        rr = EXCLUDED.rr,
+        average_check = EXCLUDED.average_check;
+    """
+
+    if shards > 1 and not cohort_filter:
+        ranges = _cohort_ranges(engine, paid_cohorts_table, shards)
+        # Шарды фиксируются каждый в своём соединении, поэтому пишут
+        # в промежуточную таблицу, а витрина заменяется одной транзакцией.
+        stage_table = f"{output_table}_stage"
+        execute_query(
+            engine,
+            f"""
+            DROP TABLE IF EXISTS {stage_table};
+            CREATE UNLOGGED TABLE {stage_table} (LIKE {output_table} INCLUDING ALL);
+            """,
+            error_message=f"Ошибка при создании таблицы {stage_table}"
+        )
+        try:
+            run_parallel(
+                engine,
+                [insert_query(cohort_range, stage_table) for cohort_range in ranges],
+                max_workers=shards,
+                error_message=f"Ошибка при заполнении таблицы {stage_table}"
+            )
+            execute_query(
+                engine,
+                delete_query + f"""
+    INSERT INTO {output_table} SELECT * FROM {stage_table};
+    """,
+                f"Данные для таблицы {output_table} добавлены по {len(ranges)} шардам.",
+                "Ошибка при добавлении данных в таблицу cohort_metrics"
+            )
+        finally:
+            execute_query(
+                engine,
+                f"DROP TABLE IF EXISTS {stage_table};",
+                error_message=f"Ошибка при удалении таблицы {stage_table}",
+                raise_errors=False
+            )
+    else:
+        execute_query(
+            engine,
+            delete_query + insert_query(cohort_filter) + update_as_of_query,
+            f"Данные для таблицы {output_table} успешно добавлены.",
+            "Ошибка при добавлении данных в таблицу cohort_metrics"
+        )
+    if max_change is not None:
+        execute_query(
+            engine,
+            f"DELETE FROM {changes_table} WHERE id <= {int(max_change)};",
+            error_message=f"Ошибка при очистке таблицы {changes_table}"
+        )
+
+def _pivot_select(input_table, 
+                  key, 
+                  size, 
+                  columns, 
+                  column_type='NUMERIC', 
+                  where='total_users IS NOT NULL'):
+    """Возвращает запрос, разворачивающий длинную таблицу по месяцам."""
+    (key_column, _), key_expr = key
+    (size_column, size_type), size_expr = size
+    pivot_columns = ",\n        ".join(
+        f"MAX({metric}) FILTER (WHERE month = {month})::{column_type} AS {name}"
+        for name, metric, month in columns
     )
-    SELECT cohort_month, month, arppu
-    FROM flattened_arppu
-    ON CONFLICT (cohort_month, month) DO NOTHING;
+    return f"""
+    SELECT 
+        {key_expr} AS {key_column},
+        MAX({size_expr})::{size_type} AS {size_column},
+        {pivot_columns}
+    FROM {input_table}
+    WHERE {where}
+    GROUP BY cohort_month"""
+
+def cohort_pivot_spec(mart, horizon=COHORT_HORIZON):
+    """Возвращает описание широкой витрины для _pivot_cohort_metrics.
+
+    mart — 'arppu', 'arppu_cumulative', 'ltv_cohorts', 'cumulative_ltv',
+    'rr' или 'ac'.
     """
-    execute_query(
-        engine,
-        insert_arppu_query,
-        f"Данные для таблицы {output_table} успешно добавлены.",
-        "Ошибка при добавлении данных в таблицу arppu_t"
+    months = range(horizon, 0, -1)
+    cohort_month = (('cohort_month', 'DATE'), 'cohort_month')
+    specs = {
+        'arppu': dict(
+            key=cohort_month,
+            size=(('total_users', 'BIGINT'), 'total_users'),
+            columns=(
+                [(f"revenue_month_{m}", 'revenue', m) for m in months] + 
+                [(f"arppu_month_{m}", 'arppu', m) for m in months]
+            )
+        ),
+        'arppu_cumulative': dict(
+            key=cohort_month,
+            size=(('total_users', 'BIGINT'), 'total_users'),
+            columns=[
+                (f"cumulative_arppu_{m}", 'cumulative_arppu', m) for m in months
+            ]
+        ),
+        'ltv_cohorts': dict(
+            key=cohort_month,
+            size=(('total_users', 'INTEGER'), 'all_users'),
+            columns=(
+                [(f"revenue_month_{m}", 'revenue', m) for m in months] + 
+                [(f"ltv_month_{m}", 'ltv', m) for m in months]
+            ),
+            column_type='NUMERIC(10, 2)',
+            where='all_users IS NOT NULL'
+        ),
+        'cumulative_ltv': dict(
+            key=cohort_month,
+            size=(('total_users', 'BIGINT'), 'all_users'),
+            columns=[
+                (f"ltv_cumulative_{m}", 'cumulative_ltv', m) for m in months
+            ],
+            column_type='NUMERIC(10, 2)',
+            where='all_users IS NOT NULL'
+        ),
+        'rr': dict(
+            key=(('cohort', 'TEXT'), "TO_CHAR(cohort_month, 'YYYY-MM')"),
+            size=(('total_users', 'BIGINT'), 'total_users'),
+            columns=[(f'"RR Month {m}"', 'rr', m) for m in months],
+            column_type='NUMERIC(5, 2)'
+        ),
+        # В ac_cohort счёт месяцев идёт от нуля: current_month — месяц начала
+        # когорты (month = 1).
+        'ac': dict(
+            key=(('cohort', 'VARCHAR(7)'), "TO_CHAR(cohort_month, 'YYYY-MM')"),
+            size=(('unique_users', 'BIGINT'), 'total_users'),
+            columns=(
+                [('average_check_current_month', 'average_check', 1)] + 
+                [(f"average_check_month_{m}", 'average_check', m + 1) 
+                    for m in range(1, horizon)]
+            )
+        ),
+    }
+    return specs[mart]
+
+def _pivot_cohort_metrics(engine, 
+                          input_table, 
+                          output_table, 
+                          key, 
+                          size, 
+                          columns, 
+                          column_type='NUMERIC', 
+                          where='total_users IS NOT NULL'):
+    """Разворачивает длинную таблицу cohort_metrics в широкую витрину.
+
+    key и size — пары (имя столбца и тип, выражение), columns — список
+    (имя столбца, метрика, month). Витрина обновляется через upsert,
+    когорты, которых больше нет в cohort_metrics, удаляются тем же запросом.
+    """
+    (key_column, key_type), key_expr = key
+    (size_column, size_type), size_expr = size
+    names = [key_column, size_column] + [name for name, _, _ in columns]
+
+    column_definitions = ",\n        ".join(
+        [f"{key_column} {key_type}", f"{size_column} {size_type}"] + 
+        [f"{name} {column_type}" for name, _, _ in columns]
     )
-    
-def transpon_cumulative_arppu(
-    engine, 
-    input_table='arppu_cumulative', 
-    output_table='arppu_cum_t'):
-    """Преобразует таблицу arppu_cumulative в плоский формат."""
-    
     create_table_query = f"""
     CREATE TABLE IF NOT EXISTS {output_table} (
-        cohort_month DATE,
-        month INT,
-        cumulative_arppu NUMERIC,
-        PRIMARY KEY (cohort_month, month)
+        {column_definitions},
+        PRIMARY KEY ({key_column})
     );
     """
     execute_query(
         engine, 
         create_table_query,
         f"Таблица {output_table} успешно создана.",
-        "Ошибка при создании таблицы arppu_cum_t"
+        f"Ошибка при создании таблицы {output_table}"
     )
-    
-    insert_cumulative_arppu_query = f"""
-    INSERT INTO {output_table} (cohort_month, month, cumulative_arppu)
-    WITH flattened_cumulative_arppu AS (
-        SELECT
-            cohort_month,
-            1 AS month,
-            cumulative_arppu_1 AS cumulative_arppu
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            2 AS month,
-            cumulative_arppu_2 AS cumulative_arppu
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            3 AS month,
-            cumulative_arppu_3 AS cumulative_arppu
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            4 AS month,
-            cumulative_arppu_4 AS cumulative_arppu
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            5 AS month,
-            cumulative_arppu_5 AS cumulative_arppu
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            6 AS month,
-            cumulative_arppu_6 AS cumulative_arppu
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            7 AS month,
-            cumulative_arppu_7 AS cumulative_arppu
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            8 AS month,
-            cumulative_arppu_8 AS cumulative_arppu
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            9 AS month,
-            cumulative_arppu_9 AS cumulative_arppu
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            10 AS month,
-            cumulative_arppu_10 AS cumulative_arppu
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            11 AS month,
-            cumulative_arppu_11 AS cumulative_arppu
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            cohort_month,
-            12 AS month,
-            cumulative_arppu_12 AS cumulative_arppu
-        FROM {input_table}
+
+    updates = ",\n        ".join(
+        f"{name} = EXCLUDED.{name}" for name in names[1:]
     )
-    SELECT cohort_month, month, cumulative_arppu
-    FROM flattened_cumulative_arppu
-    ON CONFLICT (cohort_month, month) DO NOTHING;
+    # Удаление и вставка видят один снимок и не пересекаются по ключам.
+    insert_query = f"""
+    WITH fresh AS ({_pivot_select(input_table, key, size, columns, column_type, where)}
+    ),
+    stale AS (
+        DELETE FROM {output_table} t
+        WHERE NOT EXISTS (
+            SELECT 1 FROM fresh f WHERE f.{key_column} = t.{key_column})
+    )
+    INSERT INTO {output_table} ({", ".join(names)})
+    SELECT {", ".join(names)} FROM fresh
+    ORDER BY {key_column}
+    ON CONFLICT ({key_column}) DO UPDATE SET
+        {updates};
     """
     execute_query(
         engine,
-        insert_cumulative_arppu_query,
+        insert_query,
         f"Данные для таблицы {output_table} успешно добавлены.",
-        "Ошибка при добавлении данных в таблицу arppu_cum_t"
+        f"Ошибка при добавлении данных в таблицу {output_table}"
     )
+
+def calculate_arppu(engine, 
+                    input_table='cohort_metrics', 
+                    output_table='cohorts_revenue_arppu_data', 
+                    horizon=COHORT_HORIZON):
+    """Формирует таблицу с данными по выручке и ARPPU."""    
+    _pivot_cohort_metrics(
+        engine, input_table, output_table, **cohort_pivot_spec('arppu', horizon))
+
+def calculate_arppu_cumulative(engine, 
+                               input_table='cohort_metrics', 
+                               output_table='arppu_cumulative', 
+                               horizon=COHORT_HORIZON):
+    """Формирует таблицу с кумулятивным ARPPU."""
+    _pivot_cohort_metrics(
+        engine, input_table, output_table, 
+        **cohort_pivot_spec('arppu_cumulative', horizon))
+
+def calculate_ltv_cohorts(engine, 
+                          input_table='cohort_metrics', 
+                          output_table='ltv_cohorts', 
+                          horizon=COHORT_HORIZON):
+    """Формирует таблицу с выручкой и LTV."""
+    _pivot_cohort_metrics(
+        engine, input_table, output_table, **cohort_pivot_spec('ltv_cohorts', horizon))
+
+def calculate_cumulative_ltv(engine, 
+                             input_table='cohort_metrics', 
+                             output_table='cumulative_ltv', 
+                             horizon=COHORT_HORIZON):
+    """Считает кумулятивную сумму LTV."""
+    _pivot_cohort_metrics(
+        engine, input_table, output_table, 
+        **cohort_pivot_spec('cumulative_ltv', horizon))
     
-def transpon_rr(
-    engine, 
-    input_table='rr_cohorts', 
-    output_table='rr_t'
-):
-    """Преобразует таблицу rr_cohorts в плоский формат."""
+def calculate_rr(engine, 
+                 input_table='cohort_metrics', 
+                 output_table='rr_cohorts', 
+                 horizon=COHORT_HORIZON):
+    """Считает RR для когорт."""
+    _pivot_cohort_metrics(
+        engine, input_table, output_table, **cohort_pivot_spec('rr', horizon))
+    
+def calculate_ac(engine, 
+                 input_table='cohort_metrics', 
+                 output_table='ac_cohort', 
+                 horizon=COHORT_HORIZON):
+    """Формирует таблицу со средним чеком."""
+    _pivot_cohort_metrics(
+        engine, input_table, output_table, **cohort_pivot_spec('ac', horizon))
     
+def _paid_orders(input_table='orders', date_format='DD.MM.YYYY HH24:MI', as_of=None):
+    """Возвращает выборку оплаченных заказов (order_id, user_id, order_date, order_price, load_batch).
+
+    С as_of заказы позже этой даты отбрасываются.
+    """
+    as_of_filter = ""
+    if as_of is not None:
+        as_of_filter = f"""
+            AND to_timestamp(
+                "OrderFirstActionDateTimeUtc", 
+                '{date_format}') < {_as_of_date(as_of)} + 1"""
+    return f"""
+        SELECT 
+            "OrderIdsMindboxId" AS order_id,
+            "OrderCustomerIdsMindboxId" AS user_id,
+            to_timestamp(
+                "OrderFirstActionDateTimeUtc", 
+                '{date_format}') AS order_date,
+            "OrderTotalPrice" AS order_price,
+            {LOAD_BATCH_COLUMN}
+        FROM {input_table}
+        WHERE "OrderLineStatusIdsExternalId" = 'Paid'{as_of_filter}"""
+
+def _new_orders_start_month(engine, input_table, last_batch, max_batch, date_format):
+    """Возвращает самый ранний месяц среди заказов из пачек после last_batch."""
+    data, _ = execute_query(
+        engine,
+        f"""
+        SELECT MIN(DATE_TRUNC('month', to_timestamp(
+            "OrderFirstActionDateTimeUtc", '{date_format}')))::DATE
+        FROM {input_table}
+        WHERE "OrderLineStatusIdsExternalId" = 'Paid'
+            AND {batch_filter(last_batch, max_batch)};
+        """,
+        error_message=f"Ошибка при поиске новых заказов в {input_table}",
+        fetch_results=True
+    )
+    return data[0][0] if data else None
+
+def _cdr_select(input_table='orders', 
+                lookahead_months=3, 
+                date_format='DD.MM.YYYY HH24:MI', 
+                window_filter="", 
+                first_month="MIN(dm.month) OVER (PARTITION BY dm.donor_id)", 
+                first_month_join="", 
+                as_of=None):
+    """Возвращает запрос, считающий метрики CDR по месяцам."""
+    return f"""
+    WITH donor_months AS (
+        SELECT 
+            user_id AS donor_id,
+            DATE_TRUNC('month', order_date) AS month,
+            COUNT(*) AS donation_count,
+            MIN(order_date) AS first_donation_date,
+            MAX(order_date) AS last_donation_date
+        FROM ({_paid_orders(input_table, date_format, as_of)}
+        ) AS paid{window_filter}
+        GROUP BY user_id, DATE_TRUNC('month', order_date)
+    ),
+    donor_activity AS (
+        SELECT 
+            dm.donor_id,
+            dm.month,
+            dm.donation_count,
+            dm.first_donation_date,
+            dm.last_donation_date,
+            LEAD(dm.month) OVER (
+                PARTITION BY dm.donor_id ORDER BY dm.month) AS next_month,
+            {first_month} AS first_month
+        FROM donor_months dm{first_month_join}
+    ),
+    monthly AS (
+        SELECT 
+            month,
+            COUNT(*) AS total_donors,
+            COUNT(*) FILTER (
+                WHERE next_month <= month + 
+                    INTERVAL '{int(lookahead_months)} months') AS retained_donors,
+            COUNT(*) FILTER (WHERE month = first_month) AS new_donors,
+            ROUND(AVG(EXTRACT(
+                EPOCH FROM (last_donation_date - first_donation_date)) / 
+                    86400) FILTER (WHERE donation_count > 1), 2) 
+                        AS avg_days_between_donations
+        FROM donor_activity
+        GROUP BY month
+    ),
+    cdr_metrics AS (
+        SELECT 
+            month,
+            CASE
+                WHEN total_donors > 0 THEN
+                    ROUND((
+                        total_donors - retained_donors) * 100.0 / 
+                        total_donors, 2)
+                ELSE NULL
+            END AS churn_rate,
+            ROUND(
+                new_donors * 100.0 / 
+                NULLIF(total_donors, 0), 2) AS new_donors_ratio,
+            -- Среднее по следующим lookahead_months месяцам, где были 
+            -- повторные пожертвования; для остальных месяцев — 0.
+            CASE
+                WHEN avg_days_between_donations IS NOT NULL THEN
+                    ROUND(AVG(avg_days_between_donations) OVER (
+                        ORDER BY month
+                        RANGE BETWEEN INTERVAL '1 day' FOLLOWING 
+                            AND INTERVAL '{int(lookahead_months)} months' FOLLOWING
+                    ), 2)
+            END AS avg_days_between_donations
+        FROM monthly
+    )
+    SELECT 
+        month::DATE,
+        churn_rate,
+        COALESCE(new_donors_ratio, 0) AS new_donors_ratio,
+        COALESCE(avg_days_between_donations, 0) AS avg_days_between_donations
+    FROM cdr_metrics"""
+
+def calculate_cdr(engine, 
+                  input_table='orders', 
+                  output_table='cdr', 
+                  cohorts_table='cohorts_paid', 
+                  lookahead_months=3, 
+                  incremental=False, 
+                  date_format='DD.MM.YYYY HH24:MI', 
+                  as_of=None):
+    """Считает метрики CDR и записывает их в базу одним запросом.
+
+    Донор считается удержанным, если следующий месяц его активности
+    (LEAD по месяцам донора) наступает не позже чем через lookahead_months.
+    Все метрики считаются оконными функциями за один проход по заказам.
+
+    С incremental=True пересчитываются только месяцы, чьё окно
+    lookahead_months задевает заказы, загруженные после прошлого запуска;
+    месяц первого пожертвования берётся из cohorts_table. С явной as_of
+    заказы позже неё не учитываются, и витрина пересчитывается целиком.
+    """
     create_table_query = f"""
     CREATE TABLE IF NOT EXISTS {output_table} (
-        cohort_month DATE,
-        month INT,
-        rr NUMERIC,
-        PRIMARY KEY (cohort_month, month)
+        month DATE PRIMARY KEY,
+        churn_rate NUMERIC,
+        new_donors_ratio NUMERIC,
+        avg_days_between_donations NUMERIC
     );
     """
     execute_query(
         engine, 
-        create_table_query,
-        f"Таблица {output_table} успешно создана.",
-        "Ошибка при создании таблицы rr_t"
+        create_table_query, 
+        f"Таблица {output_table} успешно создана.", 
+        "Ошибка при создании таблицы CDR!"
     )
 
-    insert_rr_query = f"""
-    INSERT INTO {output_table} (cohort_month, month, rr)
-    WITH flattened_rr AS (
-        SELECT
-            TO_DATE(cohort, 'YYYY-MM-DD') AS cohort_month,  -- Преобразование текста в дату
-            1 AS month,
-            "RR Month 1" AS rr
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            TO_DATE(cohort, 'YYYY-MM-DD') AS cohort_month,
-            2 AS month,
-            "RR Month 2" AS rr
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            TO_DATE(cohort, 'YYYY-MM-DD') AS cohort_month,
-            3 AS month,
-            "RR Month 3" AS rr
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            TO_DATE(cohort, 'YYYY-MM-DD') AS cohort_month,
-            4 AS month,
-            "RR Month 4" AS rr
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            TO_DATE(cohort, 'YYYY-MM-DD') AS cohort_month,
-            5 AS month,
-            "RR Month 5" AS rr
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            TO_DATE(cohort, 'YYYY-MM-DD') AS cohort_month,
-            6 AS month,
-            "RR Month 6" AS rr
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            TO_DATE(cohort, 'YYYY-MM-DD') AS cohort_month,
-            7 AS month,
-            "RR Month 7" AS rr
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            TO_DATE(cohort, 'YYYY-MM-DD') AS cohort_month,
-            8 AS month,
-            "RR Month 8" AS rr
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            TO_DATE(cohort, 'YYYY-MM-DD') AS cohort_month,
-            9 AS month,
-            "RR Month 9" AS rr
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            TO_DATE(cohort, 'YYYY-MM-DD') AS cohort_month,
-            10 AS month,
-            "RR Month 10" AS rr
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            TO_DATE(cohort, 'YYYY-MM-DD') AS cohort_month,
-            11 AS month,
-            "RR Month 11" AS rr
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            TO_DATE(cohort, 'YYYY-MM-DD') AS cohort_month,
-            12 AS month,
-            "RR Month 12" AS rr
-        FROM {input_table}
+    window_filter = ""
+    first_month = "MIN(dm.month) OVER (PARTITION BY dm.donor_id)"
+    first_month_join = ""
+    if incremental and as_of is not None:
+        logger.warning(f"{output_table}: инкрементальный режим не поддерживает as_of, "
+                       f"витрина пересчитывается целиком.")
+        incremental = False
+    if incremental:
+        create_watermarks_table(engine)
+        watermark_name = batch_watermark(output_table)
+        last_batch = get_watermark(engine, watermark_name)
+        max_batch = get_max_batch(engine, input_table)
+        if max_batch is None:
+            logger.info(f"Нет заказов для расчёта {output_table}.")
+            return
+        if last_batch is not None:
+            start_month = _new_orders_start_month(
+                engine, input_table, last_batch, max_batch, date_format)
+            if start_month is None:
+                logger.info(f"Новых оплаченных заказов нет, {output_table} не пересчитывается.")
+                set_watermark(engine, watermark_name, max_batch)
+                return
+            # Месяц m меняется, если в его окне (m, m + lookahead] есть новые
+            # заказы, поэтому пересчёт начинается за lookahead месяцев до них.
+            window_filter = f"""
+        WHERE order_date >= DATE '{start_month}' - 
+            INTERVAL '{int(lookahead_months)} months'"""
+            first_month = "LEAST(c.cohort_month, MIN(dm.month) OVER (PARTITION BY dm.donor_id))"
+            first_month_join = f"""
+        LEFT JOIN {cohorts_table} c ON c.user_id = dm.donor_id"""
+            logger.info(f"CDR: пересчитываются месяцы начиная с "
+                        f"{start_month} минус {lookahead_months} мес.")
+
+    # Месяцы после as_of остались бы от прошлых расчётов на более позднюю дату.
+    delete_query = ""
+    if as_of is not None:
+        delete_query = f"""
+    DELETE FROM {output_table} 
+    WHERE month > DATE_TRUNC('month', {_as_of_date(as_of)});
+    """
+    insert_cdr_query = delete_query + f"""
+    INSERT INTO {output_table} (
+        month, churn_rate, new_donors_ratio, avg_days_between_donations
     )
-    SELECT cohort_month, month, rr
-    FROM flattened_rr
-    ON CONFLICT (cohort_month, month) DO NOTHING;
+    {_cdr_select(input_table, lookahead_months, date_format, 
+                 window_filter, first_month, first_month_join, as_of)}
+    ORDER BY month
+    ON CONFLICT (month) DO UPDATE SET
+        churn_rate = EXCLUDED.churn_rate,
+        new_donors_ratio = EXCLUDED.new_donors_ratio,
+        avg_days_between_donations = EXCLUDED.avg_days_between_donations
+    WHERE ({output_table}.churn_rate, 
+           {output_table}.new_donors_ratio, 
+           {output_table}.avg_days_between_donations) 
+        IS DISTINCT FROM (EXCLUDED.churn_rate, 
+                          EXCLUDED.new_donors_ratio, 
+                          EXCLUDED.avg_days_between_donations);
     """
     execute_query(
+        engine, 
+        insert_cdr_query, 
+        f"Метрики CDR успешно рассчитаны и сохранены в таблице {output_table}.", 
+        "Ошибка при расчете метрик!"
+    )
+    if incremental:
+        set_watermark(engine, watermark_name, max_batch)
+           
+def _discover_month_columns(engine, table, pattern):
+    """Находит помесячные столбцы таблицы по схеме и возвращает пары (месяц, столбец).
+
+    pattern — регулярное выражение с группой для номера месяца; если группа
+    не сработала (например, current_month), месяц считается нулевым.
+    Схема читается из pg_attribute, поэтому подходят и материализованные
+    представления.
+    """
+    data, _ = execute_query(
         engine,
-        insert_rr_query,
-        f"Данные для таблицы {output_table} успешно добавлены.",
-        "Ошибка при добавлении данных в таблицу rr_t"
+        f"""
+        SELECT attname 
+        FROM pg_attribute 
+        WHERE attrelid = to_regclass('{table}') 
+            AND attnum > 0 
+            AND NOT attisdropped
+        ORDER BY attnum;
+        """,
+        error_message=f"Ошибка при чтении структуры таблицы {table}",
+        fetch_results=True
     )
-    
-def transpon_ac(
-    engine, 
-    input_table='ac_cohort', 
-    output_table='ac_t'):
-    """Преобразует таблицу ac_cohort в плоский формат."""
-    
+    columns = []
+    for (column_name,) in data or []:
+        match = re.fullmatch(pattern, column_name)
+        if match:
+            month = int(match.group(1)) if match.group(1) else 0
+            columns.append((month, column_name))
+    return sorted(columns)
+
+def _unpivot_select(engine, 
+                    input_table, 
+                    value_column, 
+                    pattern, 
+                    cohort_expr='cohort_month'):
+    """Возвращает запрос (cohort_month, month, value_column) по помесячным столбцам.
+
+    Если помесячных столбцов нет, возвращает None.
+    """
+    columns = _discover_month_columns(engine, input_table, pattern)
+    if not columns:
+        logger.warning(f"В таблице {input_table} не найдено помесячных столбцов.")
+        return None
+    values = ",\n            ".join(
+        f'({month}, t."{column}")' for month, column in columns
+    )
+    return f"""
+    SELECT 
+        {cohort_expr} AS cohort_month,
+        v.month,
+        v.value AS {value_column}
+    FROM {input_table} t
+    CROSS JOIN LATERAL (
+        VALUES
+            {values}
+    ) AS v(month, value)"""
+
+def unpivot_table(engine, 
+                  input_table, 
+                  output_table, 
+                  value_column, 
+                  pattern, 
+                  cohort_expr='cohort_month'):
+    """Преобразует широкую таблицу в плоский формат за одно чтение.
+
+    Помесячные столбцы определяются по схеме input_table, поэтому
+    горизонт может быть любым; строки раскладываются через LATERAL VALUES.
+    """
     create_table_query = f"""
     CREATE TABLE IF NOT EXISTS {output_table} (
         cohort_month DATE,
         month INT,
-        average_check NUMERIC,
+        {value_column} NUMERIC,
         PRIMARY KEY (cohort_month, month)
     );
     """
@@ -1982,96 +1949,117 @@ def transpon_ac(
         engine, 
         create_table_query,
         f"Таблица {output_table} успешно создана.",
-        "Ошибка при создании таблицы ac_t"
+        f"Ошибка при создании таблицы {output_table}"
     )
-    
-    insert_ac_query = f"""
-    INSERT INTO {output_table} (cohort_month, month, average_check)
-    WITH flattened_ac AS (
-        SELECT
-            -- Преобразуем строку в дату, добавляя '-01', если необходимо
-            CAST(CONCAT(cohort, '-01') AS DATE) AS cohort_month,
-            0 AS month,
-            average_check_current_month AS average_check
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            CAST(CONCAT(cohort, '-01') AS DATE) AS cohort_month,
-            1 AS month,
-            average_check_month_1 AS average_check
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            CAST(CONCAT(cohort, '-01') AS DATE) AS cohort_month,
-            2 AS month,
-            average_check_month_2 AS average_check
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            CAST(CONCAT(cohort, '-01') AS DATE) AS cohort_month,
-            3 AS month,
-            average_check_month_3 AS average_check
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            CAST(CONCAT(cohort, '-01') AS DATE) AS cohort_month,
-            4 AS month,
-            average_check_month_4 AS average_check
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            CAST(CONCAT(cohort, '-01') AS DATE) AS cohort_month,
-            5 AS month,
-            average_check_month_5 AS average_check
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            CAST(CONCAT(cohort, '-01') AS DATE) AS cohort_month,
-            6 AS month,
-            average_check_month_6 AS average_check
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            CAST(CONCAT(cohort, '-01') AS DATE) AS cohort_month,
-            7 AS month,
-            average_check_month_7 AS average_check
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            CAST(CONCAT(cohort, '-01') AS DATE) AS cohort_month,
-            8 AS month,
-            average_check_month_8 AS average_check
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            CAST(CONCAT(cohort, '-01') AS DATE) AS cohort_month,
-            9 AS month,
-            average_check_month_9 AS average_check
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            CAST(CONCAT(cohort, '-01') AS DATE) AS cohort_month,
-            10 AS month,
-            average_check_month_10 AS average_check
-        FROM {input_table}
-        UNION ALL
-        SELECT
-            CAST(CONCAT(cohort, '-01') AS DATE) AS cohort_month,
-            11 AS month,
-            average_check_month_11 AS average_check
-        FROM {input_table}
+    select = _unpivot_select(
+        engine, input_table, value_column, pattern, cohort_expr)
+    if select is None:
+        return
+    # Пары (когорта, месяц), пропавшие из широкой таблицы, удаляются тем же запросом.
+    insert_query = f"""
+    WITH fresh AS ({select}
+    ),
+    stale AS (
+        DELETE FROM {output_table} t
+        WHERE NOT EXISTS (
+            SELECT 1 FROM fresh f 
+            WHERE f.cohort_month = t.cohort_month AND f.month = t.month)
     )
-    SELECT cohort_month, month, average_check
-    FROM flattened_ac
-    ON CONFLICT (cohort_month, month) DO NOTHING;
+    INSERT INTO {output_table} (cohort_month, month, {value_column})
+    SELECT cohort_month, month, {value_column} FROM fresh
+    ON CONFLICT (cohort_month, month) DO UPDATE SET
+        {value_column} = EXCLUDED.{value_column};
     """
-    
     execute_query(
         engine,
-        insert_ac_query,
+        insert_query,
         f"Данные для таблицы {output_table} успешно добавлены.",
-        "Ошибка при добавлении данных в таблицу ac_t"
+        f"Ошибка при добавлении данных в таблицу {output_table}"
     )
+
+def transpon_spec(mart):
+    """Возвращает описание плоской витрины для unpivot_table.
+
+    mart — 'ltv', 'revenue', 'cumulative_ltv', 'arppu', 'cumulative_arppu',
+    'rr' или 'ac'.
+    """
+    specs = {
+        'ltv': dict(value_column='ltv', pattern=r'ltv_month_(\d+)'),
+        'revenue': dict(value_column='revenue', pattern=r'revenue_month_(\d+)'),
+        'cumulative_ltv': dict(
+            value_column='ltv_cumulative', pattern=r'ltv_cumulative_(\d+)'),
+        'arppu': dict(value_column='arppu', pattern=r'arppu_month_(\d+)'),
+        'cumulative_arppu': dict(
+            value_column='cumulative_arppu', pattern=r'cumulative_arppu_(\d+)'),
+        'rr': dict(
+            value_column='rr', 
+            pattern=r'RR Month (\d+)',
+            cohort_expr="TO_DATE(cohort, 'YYYY-MM-DD')"
+        ),
+        # average_check_current_month становится месяцем 0.
+        'ac': dict(
+            value_column='average_check', 
+            pattern=r'average_check_(?:current_month|month_(\d+))',
+            cohort_expr="CAST(CONCAT(cohort, '-01') AS DATE)"
+        ),
+    }
+    return specs[mart]
+
+def transpon_ltv(
+    engine, 
+    input_table='ltv_cohorts', 
+    output_table='ltv_t'
+    ):
+    """Преобразует таблицу ltv_cohorts в плоский формат."""
+    unpivot_table(engine, input_table, output_table, **transpon_spec('ltv'))
+    
+def transpon_revenue(
+    engine, 
+    input_table='ltv_cohorts', 
+    output_table='revenue_t'
+    ):
+    """Преобразует таблицу ltv_cohorts в плоский формат."""
+    unpivot_table(engine, input_table, output_table, **transpon_spec('revenue'))
+    
+def transpon_cumulative_ltv(
+    engine, 
+    input_table='cumulative_ltv', 
+    output_table='ltv_cum_t'
+    ):
+    """Преобразует таблицу cumulative_ltv в плоский формат."""
+    unpivot_table(
+        engine, input_table, output_table, **transpon_spec('cumulative_ltv'))
+
+def transpon_arppu(
+    engine, 
+    input_table='cohorts_revenue_arppu_data', 
+    output_table='arppu_t'
+    ):
+    """Преобразует таблицу cohorts_revenue_arppu_data в плоский формат."""
+    unpivot_table(engine, input_table, output_table, **transpon_spec('arppu'))
+
+def transpon_cumulative_arppu(
+    engine, 
+    input_table='arppu_cumulative', 
+    output_table='arppu_cum_t'):
+    """Преобразует таблицу arppu_cumulative в плоский формат."""
+    unpivot_table(
+        engine, input_table, output_table, **transpon_spec('cumulative_arppu'))
+
+def transpon_rr(
+    engine, 
+    input_table='rr_cohorts', 
+    output_table='rr_t'
+):
+    """Преобразует таблицу rr_cohorts в плоский формат."""
+    unpivot_table(engine, input_table, output_table, **transpon_spec('rr'))
+    
+def transpon_ac(
+    engine, 
+    input_table='ac_cohort', 
+    output_table='ac_t'):
+    """Преобразует таблицу ac_cohort в плоский формат."""
+    unpivot_table(engine, input_table, output_table, **transpon_spec('ac'))
     
 def paid_only(
     engine, 
@@ -2079,12 +2067,12 @@ def paid_only(
     output_table='paid_only', 
     date_format='DD.MM.YYYY HH24:MI:SS'
     ):
-    """Создает таблицу paid_only."""
+    """Создает таблицу paid_only и дополняет её новыми оплаченными заказами."""
     
     create_table_query = f"""
     CREATE TABLE IF NOT EXISTS {output_table} (
         user_id BIGINT,
-        order_id BIGINT,
+        order_id BIGINT PRIMARY KEY,
         order_date TIMESTAMP,
         order_price NUMERIC
     );
@@ -2095,9 +2083,44 @@ def paid_only(
         f"Таблица {output_table} успешно создана.",
         "Ошибка при создании таблицы paid_only"
     )
+    _, key_columns = _primary_key(engine, output_table)
+    if not key_columns:
+        # Раньше таблица заполнялась заново при каждом запуске и копила дубли.
+        execute_query(
+            engine,
+            f"""
+            DELETE FROM {output_table} a
+            USING {output_table} b
+            WHERE a.order_id = b.order_id 
+                AND a.ctid > b.ctid;
+            DELETE FROM {output_table} WHERE order_id IS NULL;
+            ALTER TABLE {output_table} ADD PRIMARY KEY (order_id);
+            """,
+            f"Дубли в таблице {output_table} удалены, добавлен ключ order_id.",
+            f"Ошибка при миграции таблицы {output_table}"
+        )
+    execute_query(
+        engine,
+        f"""
+        CREATE INDEX IF NOT EXISTS idx_{output_table}_order_date 
+        ON {output_table} (order_date) INCLUDE (user_id, order_price);
+        CREATE INDEX IF NOT EXISTS idx_{output_table}_user_id 
+        ON {output_table} (user_id);
+        """,
+        error_message=f"Ошибка при создании индексов {output_table}"
+    )
+
+    create_watermarks_table(engine)
+    watermark_name = batch_watermark(output_table)
+    last_batch = get_watermark(engine, watermark_name)
+    max_batch = get_max_batch(engine, input_table)
+    if max_batch is None or (last_batch is not None and last_batch >= max_batch):
+        logger.info(f"Новых заказов нет, {output_table} не обновляется.")
+        return
+
     insert_paid_only_query = f"""
     INSERT INTO {output_table} (user_id, order_id, order_date, order_price)
-    SELECT
+    SELECT DISTINCT ON ("OrderFirstActionIdsMindboxId")
         "OrderCustomerIdsMindboxId" AS user_id,
         "OrderFirstActionIdsMindboxId" AS order_id,
         TO_TIMESTAMP("OrderFirstActionDateTimeUtc", '{date_format}') AS order_date,
@@ -2105,7 +2128,16 @@ def paid_only(
     FROM
         {input_table}
     WHERE
-        "OrderLineStatusIdsExternalId" = 'Paid';
+        "OrderLineStatusIdsExternalId" = 'Paid'
+        AND "OrderFirstActionIdsMindboxId" IS NOT NULL
+        AND {batch_filter(last_batch, max_batch)}
+    ORDER BY "OrderFirstActionIdsMindboxId", "OrderIdsMindboxId" DESC
+    ON CONFLICT (order_id) DO UPDATE SET
+        user_id = EXCLUDED.user_id,
+        order_date = EXCLUDED.order_date,
+        order_price = EXCLUDED.order_price
+    WHERE ({output_table}.user_id, {output_table}.order_date, {output_table}.order_price)
+        IS DISTINCT FROM (EXCLUDED.user_id, EXCLUDED.order_date, EXCLUDED.order_price);
     """
     execute_query(
         engine,
@@ -2113,24 +2145,4 @@ def paid_only(
         f"Данные для таблицы {output_table} успешно добавлены.",
         "Ошибка при добавлении данных в таблицу paid_only"
     )
-
-
-def cohort_analysis(engine):
-    calculate_cohorts_all(engine)
-    calculate_cohorts_paid(engine)
-    calculate_arppu(engine)
-    calculate_arppu_cumulative(engine)
-    calculate_ltv_cohorts(engine)
-    calculate_cumulative_ltv(engine)
-    calculate_rr(engine)
-    calculate_ac(engine)
-    paid_only(engine)
-
-def transpon(engine):
-    transpon_ltv(engine)
-    transpon_revenue(engine)
-    transpon_cumulative_ltv(engine)
-    transpon_arppu(engine)
-    transpon_cumulative_arppu(engine)
-    transpon_rr(engine)
-    transpon_ac(engine)
\ No newline at end of file
+    set_watermark(engine, watermark_name, max_batch)
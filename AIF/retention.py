@@ -0,0 +1,435 @@
+import logging
+from datetime import date
+from decimal import Decimal, ROUND_HALF_UP
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+from database import (
+    execute_query, create_watermarks_table, get_watermark, set_watermark,
+    get_max_batch, batch_watermark, batch_filter
+)
+from query import COHORT_HORIZON, _paid_orders
+
+# pyroaring необязателен: без него множества хранятся отсортированными
+# массивами int64 numpy, они больше и медленнее, но результат тот же.
+try:
+    from pyroaring import BitMap64 as RoaringBitmap
+except ImportError:
+    RoaringBitmap = None
+
+logger = logging.getLogger()
+
+GRANULARITIES = ('day', 'week', 'month')
+RETENTION_MODES = ('classic', 'rolling', 'full')
+ENCODING = 'roaring' if RoaringBitmap is not None else 'int64'
+
+def _bitmap(user_ids):
+    """Строит множество пользователей: roaring-битмап или отсортированный массив."""
+    if RoaringBitmap is not None:
+        return RoaringBitmap(int(u) for u in user_ids)
+    return np.unique(np.asarray(user_ids, dtype=np.int64))
+
+def _union(a, b):
+    if RoaringBitmap is not None:
+        return a | b
+    return np.union1d(a, b)
+
+def _intersection(a, b):
+    if RoaringBitmap is not None:
+        return a & b
+    return np.intersect1d(a, b, assume_unique=True)
+
+def _difference(a, b):
+    if RoaringBitmap is not None:
+        return a - b
+    return np.setdiff1d(a, b, assume_unique=True)
+
+def _serialize(bitmap):
+    if RoaringBitmap is not None:
+        return bitmap.serialize()
+    return bitmap.astype('<i8').tobytes()
+
+def _deserialize(encoding, payload):
+    """Восстанавливает множество из BYTEA с учётом того, как оно было записано."""
+    payload = bytes(payload)
+    if encoding == 'roaring':
+        if RoaringBitmap is None:
+            raise RuntimeError(
+                "Битмапы retention записаны в формате roaring, установите pyroaring "
+                "или пересоберите их с rebuild=True.")
+        return RoaringBitmap.deserialize(payload)
+    array = np.frombuffer(payload, dtype='<i8').astype(np.int64)
+    return _bitmap(array) if RoaringBitmap is not None else array
+
+def _shift(period, granularity, offset):
+    """Сдвигает начало периода на offset периодов вперёд."""
+    period = pd.Timestamp(period)
+    if granularity == 'month':
+        return (period + pd.DateOffset(months=offset)).date()
+    if granularity == 'week':
+        return (period + pd.Timedelta(weeks=offset)).date()
+    return (period + pd.Timedelta(days=offset)).date()
+
+def _rate(count, total):
+    """Округляет долю до двух знаков так же, как ROUND(numeric, 2) в Postgres."""
+    if not total:
+        return None
+    return (Decimal(count) * 100 / Decimal(total)).quantize(
+        Decimal('0.01'), rounding=ROUND_HALF_UP)
+
+def create_bitmaps_table(engine, bitmaps_table='retention_bitmaps'):
+    """Создает таблицу с битмапами пользователей по парам (когорта, период)."""
+    create_table_query = f"""
+    CREATE TABLE IF NOT EXISTS {bitmaps_table} (
+        granularity TEXT,
+        cohort_start DATE,
+        period_start DATE,
+        encoding TEXT,
+        users BYTEA,
+        cardinality BIGINT,
+        PRIMARY KEY (granularity, cohort_start, period_start)
+    );
+    """
+    execute_query(
+        engine,
+        create_table_query,
+        f"Таблица {bitmaps_table} успешно создана.",
+        f"Ошибка при создании таблицы {bitmaps_table}"
+    )
+
+def load_bitmaps(engine, granularity='month', bitmaps_table='retention_bitmaps'):
+    """Читает битмапы в словарь {(cohort_start, period_start): множество}."""
+    query = f"""
+    SELECT cohort_start, period_start, encoding, users
+    FROM {bitmaps_table}
+    WHERE granularity = :granularity;
+    """
+    with engine.connect() as conn:
+        rows = conn.execute(text(query), {'granularity': granularity}).fetchall()
+    return {
+        (cohort, period): _deserialize(encoding, users)
+        for cohort, period, encoding, users in rows
+    }
+
+def _read_activity(engine, input_table, granularity, last_batch, max_batch, date_format):
+    """Читает пары (user_id, period_start) оплаченных заказов из пачек после last_batch."""
+    query = f"""
+    SELECT DISTINCT
+        user_id,
+        DATE_TRUNC('{granularity}', order_date)::DATE AS period_start
+    FROM ({_paid_orders(input_table, date_format)}
+    ) AS paid
+    WHERE {batch_filter(last_batch, max_batch)} AND order_date IS NOT NULL;
+    """
+    with engine.connect() as conn:
+        activity = pd.read_sql(text(query), conn)
+    logger.info(f"Для битмапов retention прочитано {len(activity)} пар (клиент, период).")
+    return activity
+
+def _merge_activity(bitmaps, activity):
+    """Добавляет новые пары (клиент, период) в битмапы и возвращает изменённые ключи.
+
+    Когорта клиента — первый период его активности. Уже известные клиенты
+    находятся пересечением с битмапами первых периодов когорт. Если в пачке
+    у клиента есть период раньше его когорты, прежние периоды клиента
+    переносятся в новую когорту; опустевшие битмапы удаляются из словаря,
+    но их ключи тоже попадают в изменённые.
+    """
+    batch_users = _bitmap(activity['user_id'].to_numpy())
+    cohort_of = {}
+    for (cohort, period), users in bitmaps.items():
+        if cohort == period:
+            cohort_of.update((int(u), cohort) for u in _intersection(users, batch_users))
+
+    moves = {}
+    first_periods = activity.groupby('user_id')['period_start'].min()
+    for user, first in first_periods.items():
+        cohort = cohort_of.get(int(user))
+        if cohort is not None and first < cohort:
+            moves.setdefault((cohort, first), []).append(int(user))
+        if cohort is None or first < cohort:
+            cohort_of[int(user)] = first
+
+    changed = set()
+    periods_by_cohort = {}
+    if moves:
+        for cohort, period in bitmaps:
+            periods_by_cohort.setdefault(cohort, []).append(period)
+    for (old_cohort, new_cohort), users in moves.items():
+        movers = _bitmap(users)
+        for period in periods_by_cohort[old_cohort]:
+            key, target = (old_cohort, period), (new_cohort, period)
+            if key not in bitmaps:
+                continue
+            moved = _intersection(bitmaps[key], movers)
+            if not len(moved):
+                continue
+            rest = _difference(bitmaps[key], moved)
+            if len(rest):
+                bitmaps[key] = rest
+            else:
+                del bitmaps[key]
+            bitmaps[target] = _union(bitmaps[target], moved) if target in bitmaps else moved
+            changed.update((key, target))
+
+    activity = activity.assign(cohort_start=activity['user_id'].map(cohort_of))
+    for (cohort, period), group in activity.groupby(['cohort_start', 'period_start']):
+        key = (cohort, period)
+        users = _bitmap(group['user_id'].to_numpy())
+        bitmaps[key] = _union(bitmaps[key], users) if key in bitmaps else users
+        changed.add(key)
+    return sorted(changed)
+
+def _save_bitmaps(engine, bitmaps, keys, granularity, bitmaps_table):
+    """Записывает изменённые битмапы одним upsert и удаляет опустевшие."""
+    if not keys:
+        return
+    rows = [
+        {
+            'granularity': granularity,
+            'cohort_start': cohort,
+            'period_start': period,
+            'encoding': ENCODING,
+            'users': _serialize(bitmaps[(cohort, period)]),
+            'cardinality': len(bitmaps[(cohort, period)]),
+        }
+        for cohort, period in keys if (cohort, period) in bitmaps
+    ]
+    removed = [
+        {'granularity': granularity, 'cohort_start': cohort, 'period_start': period}
+        for cohort, period in keys if (cohort, period) not in bitmaps
+    ]
+    upsert_query = f"""
+    INSERT INTO {bitmaps_table} (
+        granularity, cohort_start, period_start, encoding, users, cardinality)
+    VALUES (
+        :granularity, :cohort_start, :period_start, :encoding, :users, :cardinality)
+    ON CONFLICT (granularity, cohort_start, period_start) DO UPDATE SET
+        encoding = EXCLUDED.encoding,
+        users = EXCLUDED.users,
+        cardinality = EXCLUDED.cardinality;
+    """
+    delete_query = f"""
+    DELETE FROM {bitmaps_table}
+    WHERE granularity = :granularity 
+        AND cohort_start = :cohort_start 
+        AND period_start = :period_start;
+    """
+    with engine.begin() as conn:
+        if rows:
+            conn.execute(text(upsert_query), rows)
+        if removed:
+            conn.execute(text(delete_query), removed)
+    logger.info(f"В таблицу {bitmaps_table} записано {len(rows)} битмапов, "
+                f"удалено {len(removed)}.")
+
+def build_bitmaps(
+    engine,
+    input_table='orders',
+    bitmaps_table='retention_bitmaps',
+    granularity='month',
+    rebuild=False,
+    date_format='DD.MM.YYYY HH24:MI'
+    ):
+    """Строит или дополняет битмапы активности по когортам.
+
+    Читаются только заказы из пачек загрузки после прошлого запуска.
+    Заказы задним числом вливаются в сохранённые битмапы: если они раньше
+    когорты клиента, клиент переносится в более раннюю когорту.
+    """
+    if granularity not in GRANULARITIES:
+        raise ValueError(
+            f"Неизвестная гранулярность retention: {granularity}. "
+            f"Допустимые значения: {', '.join(GRANULARITIES)}")
+    create_watermarks_table(engine)
+    create_bitmaps_table(engine, bitmaps_table)
+    watermark_name = batch_watermark(f"{bitmaps_table}_{granularity}")
+    max_batch = get_max_batch(engine, input_table)
+    last_batch = None if rebuild else get_watermark(engine, watermark_name)
+    if max_batch is None:
+        logger.info(f"Нет заказов для построения {bitmaps_table}.")
+        return {}
+
+    bitmaps = {} if last_batch is None else load_bitmaps(engine, granularity, bitmaps_table)
+    if last_batch is not None and last_batch >= max_batch:
+        logger.info(f"Новых заказов нет, битмапы {bitmaps_table} актуальны.")
+        return bitmaps
+
+    activity = _read_activity(
+        engine, input_table, granularity, last_batch, max_batch, date_format)
+    if last_batch is None:
+        execute_query(
+            engine,
+            f"DELETE FROM {bitmaps_table} WHERE granularity = '{granularity}';",
+            error_message=f"Ошибка при очистке таблицы {bitmaps_table}"
+        )
+    changed = _merge_activity(bitmaps, activity) if not activity.empty else []
+    _save_bitmaps(engine, bitmaps, changed, granularity, bitmaps_table)
+    set_watermark(engine, watermark_name, max_batch)
+    return bitmaps
+
+def retention_curve(bitmaps, granularity='month', mode='classic', horizon=COHORT_HORIZON):
+    """Считает удержание когорт по смещению от начала когорты.
+
+    classic — активны в периоде N, rolling — активны в периоде N или позже,
+    full — активны в каждом периоде с 1 по N. Возвращает датафрейм
+    (cohort_start, period_offset, cohort_size, retained_users, retention_rate).
+    """
+    if mode not in RETENTION_MODES:
+        raise ValueError(
+            f"Неизвестный режим retention: {mode}. "
+            f"Допустимые значения: {', '.join(RETENTION_MODES)}")
+    periods_by_cohort = {}
+    for cohort, period in bitmaps:
+        periods_by_cohort.setdefault(cohort, []).append(period)
+
+    rows = []
+    for cohort, periods in sorted(periods_by_cohort.items()):
+        size = len(bitmaps[(cohort, cohort)])
+        last_period = max(periods)
+        retained = None
+        for offset in range(1, horizon + 1):
+            period = _shift(cohort, granularity, offset)
+            if period > last_period:
+                break
+            empty = _bitmap([])
+            if mode == 'classic':
+                retained = bitmaps.get((cohort, period), empty)
+            elif mode == 'full':
+                current = bitmaps.get((cohort, period), empty)
+                retained = current if retained is None else _intersection(retained, current)
+            else:
+                retained = empty
+                for later in periods:
+                    if later >= period:
+                        retained = _union(retained, bitmaps[(cohort, later)])
+            rows.append((cohort, offset, size, len(retained), _rate(len(retained), size)))
+    return pd.DataFrame(rows, columns=[
+        'cohort_start', 'period_offset', 'cohort_size', 'retained_users', 'retention_rate'
+    ])
+
+def retention_matrix(
+    engine,
+    input_table='orders',
+    bitmaps_table='retention_bitmaps',
+    output_table='retention_matrix',
+    granularity='month',
+    mode='classic',
+    horizon=COHORT_HORIZON
+    ):
+    """Записывает кривые удержания по битмапам в длинную таблицу."""
+    bitmaps = build_bitmaps(engine, input_table, bitmaps_table, granularity)
+    curve = retention_curve(bitmaps, granularity, mode, horizon)
+
+    create_table_query = f"""
+    CREATE TABLE IF NOT EXISTS {output_table} (
+        granularity TEXT,
+        mode TEXT,
+        cohort_start DATE,
+        period_offset INT,
+        cohort_size BIGINT,
+        retained_users BIGINT,
+        retention_rate NUMERIC(5, 2),
+        PRIMARY KEY (granularity, mode, cohort_start, period_offset)
+    );
+    """
+    execute_query(
+        engine,
+        create_table_query,
+        f"Таблица {output_table} успешно создана.",
+        f"Ошибка при создании таблицы {output_table}"
+    )
+    if curve.empty:
+        return
+    rows = [
+        dict(zip(curve.columns, values), granularity=granularity, mode=mode)
+        for values in curve.itertuples(index=False)
+    ]
+    upsert_query = f"""
+    INSERT INTO {output_table} (
+        granularity, mode, cohort_start, period_offset,
+        cohort_size, retained_users, retention_rate)
+    VALUES (
+        :granularity, :mode, :cohort_start, :period_offset,
+        :cohort_size, :retained_users, :retention_rate)
+    ON CONFLICT (granularity, mode, cohort_start, period_offset) DO UPDATE SET
+        cohort_size = EXCLUDED.cohort_size,
+        retained_users = EXCLUDED.retained_users,
+        retention_rate = EXCLUDED.retention_rate;
+    """
+    with engine.begin() as conn:
+        conn.execute(text(upsert_query), [
+            {key: (int(value) if isinstance(value, np.integer) else value)
+             for key, value in row.items()}
+            for row in rows
+        ])
+    logger.info(f"Данные для таблицы {output_table} успешно добавлены.")
+
+def calculate_rr_bitmaps(
+    engine,
+    input_table='orders',
+    bitmaps_table='retention_bitmaps',
+    output_table='rr_cohorts',
+    horizon=COHORT_HORIZON,
+    as_of=None
+    ):
+    """Формирует rr_cohorts по битмапам вместо COUNT(DISTINCT) по заказам.
+
+    Формат совпадает с calculate_rr: "RR Month 1" — месяц начала когорты,
+    "RR Month {horizon}" — последний в горизонте; месяцы позже as_of
+    остаются пустыми. Битмапы помесячные, поэтому as_of учитывается
+    с точностью до месяца.
+    """
+    bitmaps = build_bitmaps(engine, input_table, bitmaps_table, 'month')
+    current_month = pd.Timestamp(as_of or date.today()).to_period('M').to_timestamp().date()
+    months = range(horizon, 0, -1)
+    names = ['cohort', 'total_users'] + [f'"RR Month {m}"' for m in months]
+
+    column_definitions = ",\n        ".join(
+        ['cohort TEXT', 'total_users BIGINT'] +
+        [f'"RR Month {m}" NUMERIC(5, 2)' for m in months]
+    )
+    execute_query(
+        engine,
+        f"""
+        CREATE TABLE IF NOT EXISTS {output_table} (
+            {column_definitions},
+            PRIMARY KEY (cohort)
+        );
+        """,
+        f"Таблица {output_table} успешно создана.",
+        f"Ошибка при создании таблицы {output_table}"
+    )
+
+    rows = []
+    for cohort in sorted({cohort for cohort, _ in bitmaps}):
+        if cohort > current_month:
+            continue
+        size = len(bitmaps[(cohort, cohort)])
+        row = {'cohort': cohort.strftime('%Y-%m'), 'total_users': size}
+        for m in months:
+            period = _shift(cohort, 'month', m - 1)
+            users = bitmaps.get((cohort, period))
+            row[f'm{m}'] = (
+                _rate(len(users) if users is not None else 0, size)
+                if period <= current_month else None
+            )
+        rows.append(row)
+
+    placeholders = ", ".join([':cohort', ':total_users'] + [f':m{m}' for m in months])
+    updates = ",\n        ".join(f"{name} = EXCLUDED.{name}" for name in names[1:])
+    upsert_query = f"""
+    INSERT INTO {output_table} ({", ".join(names)})
+    VALUES ({placeholders})
+    ON CONFLICT (cohort) DO UPDATE SET
+        {updates};
+    """
+    # Когорты, которых больше нет в битмапах или которые позже as_of, удаляются.
+    delete_query = f"""
+    DELETE FROM {output_table} WHERE NOT (cohort = ANY(:cohorts));
+    """
+    with engine.begin() as conn:
+        conn.execute(text(delete_query), {'cohorts': [row['cohort'] for row in rows]})
+        if rows:
+            conn.execute(text(upsert_query), rows)
+    logger.info(f"Данные для таблицы {output_table} по битмапам успешно добавлены.")
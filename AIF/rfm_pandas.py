@@ -0,0 +1,301 @@
+import logging
+from datetime import date
+from decimal import Decimal, ROUND_HALF_UP, ROUND_FLOOR, ROUND_CEILING
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+from database import execute_query, copy_dataframe
+from query import RFM_SEGMENTS, RFM_SCORING, create_rfm_tables
+
+logger = logging.getLogger()
+
+RFM_COLUMNS = [
+    'customer_id', 
+    'recency_days', 
+    'frequency', 
+    'monetary', 
+    'recency_score', 
+    'frequency_score', 
+    'monetary_score', 
+    'rfm_group', 
+    'percent_rfm',
+    'cats'
+]
+
+SEGMENT_BY_GROUP = {
+    group: name for name, groups in RFM_SEGMENTS.items() for group in groups
+}
+
+def read_paid_orders(engine, input_table='orders'):
+    """Читает из базы только нужные для RFM столбцы оплаченных заказов."""
+    query = f"""
+    SELECT 
+        "OrderCustomerIdsMindboxId",
+        "OrderFirstActionDateTimeUtc",
+        "OrderTotalPrice",
+        "OrderLineStatusIdsExternalId"
+    FROM {input_table}
+    WHERE "OrderLineStatusIdsExternalId" = 'Paid';
+    """
+    with engine.connect() as conn:
+        orders = pd.read_sql(text(query), conn)
+    logger.info(f"Из таблицы {input_table} прочитано {len(orders)} оплаченных заказов.")
+    return orders
+
+def _exact(value):
+    """Переводит число в точное значение Python, как NUMERIC в Postgres; NaN — в None."""
+    if value is None or pd.isna(value):
+        return None
+    if isinstance(value, Decimal):
+        return value
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    # repr даёт кратчайшую запись float, совпадающую с приведением к NUMERIC.
+    return Decimal(repr(float(value)))
+
+def _integers(values):
+    """Приводит значения к целым int64 без пропусков."""
+    return pd.Series(values, dtype='Int64').dropna().to_numpy(dtype=np.int64)
+
+def _thresholds(values, scoring, scale=1):
+    """Считает пороги low/mid/high так же, как rfm_thresholds в SQL.
+
+    values — целые числа (для сумм — копейки, scale=100). Пороги считаются
+    в точной арифметике Decimal: AVG и STDDEV в SQL работают с NUMERIC,
+    и на float граница вида mean ± std могла отличаться в последнем знаке
+    и менять балл клиента.
+    """
+    values = _integers(values)
+    n = len(values)
+    if scoring == 'stddev':
+        if n == 0:
+            return None, None, None
+        total = int(values.sum())
+        mean = Decimal(total) / (n * scale)
+        if n < 2:
+            # STDDEV по одной строке — NULL, и границы тоже NULL.
+            return None, mean, None
+        # Сумма квадратов в целых Python: в int64 она может переполниться.
+        squares = int((values.astype(object) ** 2).sum())
+        std = (Decimal(n * squares - total * total) / (n * (n - 1))).sqrt() / scale
+        return mean - std, mean, mean + std
+    if scoring == 'quantile':
+        if n == 0:
+            return None, None, None
+        values = np.sort(values)
+        bounds = []
+        # PERCENTILE_CONT — линейная интерполяция между соседними значениями.
+        for q in (Decimal('0.25'), Decimal('0.5'), Decimal('0.75')):
+            position = q * (n - 1)
+            lower = int(position)
+            value = Decimal(int(values[lower]))
+            if lower + 1 < n:
+                value += (position - lower) * int(values[lower + 1] - values[lower])
+            bounds.append(value / scale)
+        return tuple(bounds)
+    raise ValueError(
+        f"Неизвестный способ скоринга RFM: {scoring}. "
+        f"Допустимые значения: {', '.join(RFM_SCORING)}")
+
+def _score(values, low, mid, high, ascending, scale=1):
+    """Переводит целые значения в баллы 1-4, как CASE в SQL.
+
+    Сравнение точное: порог переводится в целое (v <= b равносильно
+    v <= floor(b) для целого v). NULL в значении или в пороге не проходит
+    ни одно условие и даёт 1.
+    """
+    values = pd.Series(values, dtype='Int64')
+    present = values.notna().to_numpy()
+    values = values.fillna(0).to_numpy(dtype=np.int64)
+    if ascending:
+        bounds, rounding, passes = (low, mid, high), ROUND_FLOOR, np.less_equal
+    else:
+        bounds, rounding, passes = (high, mid, low), ROUND_CEILING, np.greater_equal
+    conditions = [
+        present & passes(values, int((bound * scale).to_integral_value(rounding)))
+        if bound is not None else np.zeros(len(values), dtype=bool)
+        for bound in bounds
+    ]
+    return np.select(conditions, [4, 3, 2], default=1).astype(np.int64)
+
+def _percent(count, total):
+    """Округляет долю группы так же, как ROUND(numeric, 2) в Postgres."""
+    return (Decimal(count) * 100 / Decimal(total)).quantize(
+        Decimal('0.01'), rounding=ROUND_HALF_UP)
+
+def compute_rfm(
+    orders, 
+    reference_date=None, 
+    scoring='stddev', 
+    date_format='%d.%m.%Y %H:%M'
+    ):
+    """Считает RFM в памяти по датафрейму заказов.
+
+    Возвращает таблицу со столбцами витрины rfm и словарь порогов.
+    С reference_date заказы позже этой даты не учитываются.
+    """
+    reference = pd.Timestamp(reference_date or date.today())
+    if "OrderLineStatusIdsExternalId" in orders.columns:
+        orders = orders[orders["OrderLineStatusIdsExternalId"] == 'Paid']
+
+    order_dates = pd.to_datetime(
+        orders["OrderFirstActionDateTimeUtc"], 
+        format=date_format, 
+        exact=False, 
+        errors='coerce'
+    )
+    if reference_date is not None:
+        keep = (order_dates < reference + pd.Timedelta(days=1)).to_numpy()
+        orders, order_dates = orders[keep], order_dates[keep]
+    # Суммы считаются в целых копейках: SUM по NUMERIC в SQL точен,
+    # а сумма float накапливала бы ошибку округления.
+    cents = (pd.to_numeric(orders["OrderTotalPrice"], errors='coerce') * 100).round()
+    grouped = pd.DataFrame({
+        'customer_id': orders["OrderCustomerIdsMindboxId"].to_numpy(),
+        'order_date': order_dates.to_numpy(),
+        'cents': cents.astype('Int64').to_numpy(),
+    }).groupby('customer_id', sort=False)
+    rfm = grouped.agg(
+        last_order_date=('order_date', 'max'),
+        frequency=('order_date', 'size'),
+        cents=('cents', 'sum'),
+        priced=('cents', 'count'),
+    ).reset_index()
+    # Как SUM в SQL: без единой цены сумма — NULL, а не 0.
+    rfm['cents'] = rfm['cents'].astype('Int64').where(rfm['priced'] > 0)
+    rfm['monetary'] = rfm['cents'].to_numpy(dtype=float, na_value=np.nan) / 100
+
+    # EXTRACT(DAY FROM interval) отбрасывает дробную часть к нулю.
+    rfm['recency_days'] = np.trunc(
+        (reference - rfm['last_order_date']) / pd.Timedelta(days=1)).astype('Int64')
+
+    thresholds = {}
+    for column, metric, ascending, scale in (
+        ('recency_days', 'recency', True, 1),
+        ('frequency', 'frequency', False, 1),
+        ('cents', 'monetary', False, 100),
+    ):
+        low, mid, high = _thresholds(rfm[column], scoring, scale)
+        thresholds.update({
+            f'{metric}_low': low, f'{metric}_mid': mid, f'{metric}_high': high
+        })
+        rfm[f'{metric}_score'] = _score(rfm[column], low, mid, high, ascending, scale)
+
+    rfm['rfm_group'] = (
+        rfm['recency_score'].astype(str) 
+        + rfm['frequency_score'].astype(str) 
+        + rfm['monetary_score'].astype(str)
+    )
+    group_counts = rfm['rfm_group'].value_counts()
+    total = int(group_counts.sum())
+    percents = {
+        group: _percent(int(count), total) for group, count in group_counts.items()
+    }
+    rfm['percent_rfm'] = rfm['rfm_group'].map(percents)
+    rfm['cats'] = rfm['rfm_group'].map(SEGMENT_BY_GROUP)
+
+    rfm['frequency'] = rfm['frequency'].astype('Int64')
+    thresholds['customers'] = len(rfm)
+    thresholds['reference_date'] = reference.date()
+    return rfm[RFM_COLUMNS], thresholds
+
+def _sql_value(value):
+    """Форматирует число для вставки в SQL без потери точности, NaN — в NULL."""
+    value = _exact(value)
+    if value is None:
+        return "NULL"
+    return str(value)
+
+def rfm_analysis_pandas(
+    engine, 
+    orders=None, 
+    input_table='orders', 
+    output_table='rfm', 
+    thresholds_table='rfm_thresholds',
+    stage_table='rfm_stage',
+    scoring='stddev',
+    reference_date=None
+    ):
+    """Формирует таблицу RFM в памяти и записывает её через COPY.
+
+    orders должен содержать всю историю оплаченных заказов; если он не
+    передан, нужные столбцы читаются из input_table одним запросом.
+    """
+    if orders is None:
+        orders = read_paid_orders(engine, input_table)
+    rfm, thresholds = compute_rfm(orders, reference_date, scoring)
+    logger.info(f"RFM рассчитан в памяти для {len(rfm)} клиентов.")
+
+    create_rfm_tables(engine, output_table, thresholds_table)
+    execute_query(
+        engine,
+        f"""
+        DROP TABLE IF EXISTS {stage_table};
+        CREATE UNLOGGED TABLE {stage_table} (LIKE {output_table});
+        """,
+        error_message=f"Ошибка при создании таблицы {stage_table}"
+    )
+    copy_dataframe(engine, rfm, stage_table)
+
+    upsert_query = f"""
+    INSERT INTO {output_table} ({", ".join(RFM_COLUMNS)})
+    SELECT {", ".join(RFM_COLUMNS)} FROM {stage_table}
+    ON CONFLICT (customer_id) DO UPDATE SET
+        recency_days = EXCLUDED.recency_days,
+        frequency = EXCLUDED.frequency,
+        monetary = EXCLUDED.monetary,
+        recency_score = EXCLUDED.recency_score,
+        frequency_score = EXCLUDED.frequency_score,
+        monetary_score = EXCLUDED.monetary_score,
+        rfm_group = EXCLUDED.rfm_group,
+        percent_rfm = EXCLUDED.percent_rfm,
+        cats = EXCLUDED.cats
+    WHERE ({output_table}.recency_days, {output_table}.frequency, 
+           {output_table}.monetary, {output_table}.rfm_group, 
+           {output_table}.percent_rfm, {output_table}.cats)
+        IS DISTINCT FROM (EXCLUDED.recency_days, EXCLUDED.frequency, 
+                          EXCLUDED.monetary, EXCLUDED.rfm_group, 
+                          EXCLUDED.percent_rfm, EXCLUDED.cats);
+    """
+    execute_query(
+        engine,
+        upsert_query,
+        f"Данные для таблицы {output_table} успешно добавлены.",
+        "Ошибка при добавлении данных в таблицу RFM"
+    )
+
+    threshold_columns = [
+        f"{metric}_{bound}" 
+        for metric in ('recency', 'frequency', 'monetary') 
+        for bound in ('low', 'mid', 'high')
+    ]
+    thresholds_query = f"""
+    INSERT INTO {thresholds_table} (
+        scoring, reference_date, customers, {", ".join(threshold_columns)}, 
+        computed_at
+    )
+    VALUES (
+        '{scoring}', 
+        DATE '{thresholds['reference_date']}', 
+        {thresholds['customers']}, 
+        {", ".join(_sql_value(thresholds[c]) for c in threshold_columns)}, 
+        NOW()
+    )
+    ON CONFLICT (scoring) DO UPDATE SET
+        reference_date = EXCLUDED.reference_date,
+        customers = EXCLUDED.customers,
+        {", ".join(f"{c} = EXCLUDED.{c}" for c in threshold_columns)},
+        computed_at = EXCLUDED.computed_at;
+    """
+    execute_query(
+        engine,
+        thresholds_query,
+        f"Пороги RFM ({scoring}) сохранены в таблице {thresholds_table}.",
+        "Ошибка при сохранении порогов RFM"
+    )
+    execute_query(
+        engine,
+        f"DROP TABLE IF EXISTS {stage_table};",
+        error_message=f"Ошибка при удалении таблицы {stage_table}"
+    )
+    return rfm
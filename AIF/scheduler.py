@@ -0,0 +1,536 @@
+import json
+import time
+import hashlib
+import logging
+import calendar
+from datetime import date, datetime
+from functools import partial
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from database import (
+    execute_query, create_watermarks_table, create_fingerprints_table,
+    get_fingerprints, set_fingerprint, exported_snapshot, snapshot_transaction,
+    shadow_build, load_session_profiles, session_profile, create_query_plans_table,
+    capture_plans, ensure_load_batch_columns, get_max_batch, pinned_views
+)
+from query import (
+    COHORT_HORIZON, rfm_analysis, create_cohort_changes_table,
+    create_cohort_metrics_table, calculate_cohorts_all, calculate_cohorts_paid, calculate_cohort_metrics,
+    calculate_arppu, calculate_arppu_cumulative, calculate_ltv_cohorts,
+    calculate_cumulative_ltv, calculate_rr, calculate_ac, calculate_cdr, paid_only,
+    transpon_ltv, transpon_revenue, transpon_cumulative_ltv, transpon_arppu,
+    transpon_cumulative_arppu, transpon_rr, transpon_ac
+)
+from rfm_pandas import rfm_analysis_pandas
+from retention import calculate_rr_bitmaps
+from matviews import create_matviews, refresh_matview
+from metrics import stage, current_run_id
+
+logger = logging.getLogger()
+
+BASE_TABLES = {
+    'orders': "OrderIdsMindboxId",
+    'events': "CustomerActionIdsMindboxId",
+}
+
+def build_steps(config, horizon=COHORT_HORIZON, as_of=None):
+    """Возвращает граф шагов витрин на дату as_of (None — текущая дата).
+
+    Шаг — {'run': функция(engine), 'deps': шаги-источники, 'reads': базовые
+    таблицы, 'period': 'day' | 'month', если результат зависит от даты расчёта,
+    'snapshot': False, если шаг ходит в базу не только через execute_query,
+    'shadow': живая таблица, если шаг пересобирает её целиком, 'profile':
+    имя профиля параметров сессии, если оно отличается от имени шага}.
+    """
+    shards = config['mart_shards']
+    # Шарды RFM пишут в промежуточную таблицу из отдельных соединений,
+    # а изменения транзакции снимка им не видны.
+    rfm_snapshot = config['rfm_engine'] != 'pandas' and shards <= 1
+    if config['rfm_engine'] == 'pandas':
+        rfm = partial(
+            rfm_analysis_pandas, scoring=config['rfm_scoring'], reference_date=as_of)
+    else:
+        rfm = partial(
+            rfm_analysis,
+            scoring=config['rfm_scoring'],
+            incremental=config['rfm_incremental'],
+            as_of=as_of,
+            shards=shards
+        )
+    if config['rr_engine'] == 'bitmap':
+        rr = {
+            'run': partial(calculate_rr_bitmaps, horizon=horizon, as_of=as_of),
+            'deps': (),
+            'reads': ('orders',),
+            'period': 'month',
+            'snapshot': False,
+            'shadow': 'rr_cohorts',
+        }
+    else:
+        rr = {
+            'run': partial(calculate_rr, horizon=horizon),
+            'deps': ('cohort_metrics',),
+            'shadow': 'rr_cohorts',
+        }
+
+    return {
+        'rfm': {
+            'run': rfm, 
+            'deps': (), 
+            'reads': ('orders',), 
+            'period': 'day', 
+            'snapshot': rfm_snapshot,
+        },
+        'cohorts_all': {
+            'run': calculate_cohorts_all, 'deps': (), 'reads': ('events',)},
+        'cohorts_paid': {
+            'run': calculate_cohorts_paid, 'deps': (), 'reads': ('orders',)},
+        'cohort_metrics': {
+            'run': partial(
+                calculate_cohort_metrics,
+                horizon=horizon,
+                incremental=config['cohort_incremental'],
+                as_of=as_of,
+                shards=shards
+            ),
+            'deps': ('cohorts_all', 'cohorts_paid'),
+            'reads': ('orders',),
+            'period': 'month',
+            # Инкрементальные шаги дописывают живую таблицу и не строятся с нуля.
+            'shadow': None if config['cohort_incremental'] else 'cohort_metrics',
+        },
+        'arppu': {
+            'run': partial(calculate_arppu, horizon=horizon),
+            'deps': ('cohort_metrics',),
+            'shadow': 'cohorts_revenue_arppu_data',
+        },
+        'arppu_cumulative': {
+            'run': partial(calculate_arppu_cumulative, horizon=horizon),
+            'deps': ('cohort_metrics',),
+            'shadow': 'arppu_cumulative',
+        },
+        'ltv_cohorts': {
+            'run': partial(calculate_ltv_cohorts, horizon=horizon),
+            'deps': ('cohort_metrics',),
+            'shadow': 'ltv_cohorts',
+        },
+        'cumulative_ltv': {
+            'run': partial(calculate_cumulative_ltv, horizon=horizon),
+            'deps': ('cohort_metrics',),
+            'shadow': 'cumulative_ltv',
+        },
+        'rr': rr,
+        'ac': {
+            'run': partial(calculate_ac, horizon=horizon),
+            'deps': ('cohort_metrics',),
+            'shadow': 'ac_cohort',
+        },
+        'paid_only': {'run': paid_only, 'deps': (), 'reads': ('orders',)},
+        # В инкрементальном режиме месяц первого пожертвования берётся из cohorts_paid.
+        'cdr': {
+            'run': partial(
+                calculate_cdr, incremental=config['cdr_incremental'], as_of=as_of),
+            'deps': ('cohorts_paid',),
+            'reads': ('orders',),
+            'shadow': None if config['cdr_incremental'] else 'cdr',
+        },
+        'transpon_ltv': {
+            'run': transpon_ltv, 'deps': ('ltv_cohorts',), 'shadow': 'ltv_t'},
+        'transpon_revenue': {
+            'run': transpon_revenue, 'deps': ('ltv_cohorts',), 'shadow': 'revenue_t'},
+        'transpon_cumulative_ltv': {
+            'run': transpon_cumulative_ltv, 'deps': ('cumulative_ltv',), 'shadow': 'ltv_cum_t'},
+        'transpon_arppu': {
+            'run': transpon_arppu, 'deps': ('arppu',), 'shadow': 'arppu_t'},
+        'transpon_cumulative_arppu': {
+            'run': transpon_cumulative_arppu, 'deps': ('arppu_cumulative',), 
+            'shadow': 'arppu_cum_t'},
+        'transpon_rr': {'run': transpon_rr, 'deps': ('rr',), 'shadow': 'rr_t'},
+        'transpon_ac': {'run': transpon_ac, 'deps': ('ac',), 'shadow': 'ac_t'},
+    }
+
+def matview_steps(steps, matviews):
+    """Переводит шаги на обновление материализованных представлений.
+
+    matviews — результат create_matviews; хеш определения входит во входы
+    шага, поэтому смена бэкенда или запроса вызывает пересчёт.
+    """
+    steps = dict(steps)
+    for name, (matview, definition) in matviews.items():
+        step = dict(steps[name])
+        step['run'] = partial(refresh_matview, name=matview)
+        step['matview'] = definition
+        step['snapshot'] = False
+        step.pop('shadow', None)
+        if name == 'cdr':
+            # Представление CDR считает первый месяц по заказам, без cohorts_paid.
+            step['deps'] = ()
+        steps[name] = step
+    return steps
+
+def table_stats(engine, tables=BASE_TABLES):
+    """Снимает число строк, максимальный идентификатор и последнюю пачку загрузки.
+
+    Пачка загрузки меняется при любой загрузке, даже если перезаписанные
+    строки не изменили ни число строк, ни максимальный идентификатор.
+    """
+    stats = {}
+    for table, id_column in tables.items():
+        data, _ = execute_query(
+            engine,
+            f'SELECT COUNT(*), MAX("{id_column}") FROM {table};',
+            error_message=f"Ошибка при чтении статистики таблицы {table}",
+            fetch_results=True
+        )
+        count, max_id = data[0]
+        max_batch = get_max_batch(engine, table)
+        stats[table] = [
+            int(count), 
+            int(max_id) if max_id is not None else None, 
+            int(max_batch) if max_batch is not None else None
+        ]
+    return stats
+
+def _step_inputs(step, stats, fingerprints, today):
+    """Собирает входы шага: статистику базовых таблиц, отпечатки зависимостей и период."""
+    inputs = {table: stats[table] for table in step.get('reads', ())}
+    inputs.update({dep: fingerprints[dep] for dep in step['deps']})
+    if step.get('matview'):
+        inputs['matview'] = step['matview']
+    if step.get('period') == 'day':
+        inputs['period'] = today.isoformat()
+    elif step.get('period') == 'month':
+        inputs['period'] = today.strftime('%Y-%m')
+    return inputs
+
+def _fingerprint(inputs):
+    return hashlib.md5(
+        json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()
+
+def _changed_inputs(stored_inputs, inputs):
+    """Возвращает имена входов, отличающихся от сохранённых."""
+    if isinstance(stored_inputs, str):
+        stored_inputs = json.loads(stored_inputs)
+    stored_inputs = stored_inputs or {}
+    return sorted(
+        key for key in set(stored_inputs) | set(inputs)
+        if stored_inputs.get(key) != json.loads(json.dumps(inputs.get(key), default=str))
+    )
+
+def _uses_snapshot(step):
+    """Снимок подходит только шагам, читающим одни базовые таблицы.
+
+    Витрины, записанные предыдущими шагами после экспорта снимка, в нём
+    не видны, поэтому шаги с зависимостями работают без снимка и читают
+    базовые таблицы через представления с закреплёнными пачками (см. _pin_reads).
+    """
+    return not step['deps'] and step.get('snapshot', True)
+
+def _pin_reads(steps, views):
+    """Переводит шаги, читающие базовые таблицы вне снимка, на представления views.
+
+    views — {таблица: представление} из pinned_views. Обновление
+    материализованного представления не принимает input_table и остаётся как есть.
+    """
+    steps = dict(steps)
+    for name, step in steps.items():
+        if step.get('reads') and not _uses_snapshot(step) and not step.get('matview'):
+            step = dict(step)
+            step['run'] = partial(step['run'], input_table=views[step['reads'][0]])
+            steps[name] = step
+    return steps
+
+def _run_step_body(engine, step, snapshot_id=None, keep_versions=None):
+    """Выполняет шаг в теневой таблице, в транзакции со снимком или напрямую."""
+    if keep_versions is not None and step.get('shadow'):
+        shadow_build(
+            engine, 
+            step['shadow'], 
+            lambda table: step['run'](engine, output_table=table),
+            keep_versions
+        )
+    elif snapshot_id is not None and _uses_snapshot(step):
+        with snapshot_transaction(engine, snapshot_id):
+            step['run'](engine)
+    else:
+        step['run'](engine)
+
+def _run_step(engine, 
+              name, 
+              step, 
+              fingerprint=None, 
+              inputs=None, 
+              snapshot_id=None, 
+              keep_versions=None, 
+              settings=None, 
+              plans_run_id=None):
+    """Выполняет шаг и возвращает (успех, время в секундах).
+
+    С keep_versions шаги с 'shadow' строятся в теневой таблице и
+    подменяют живую; хранится keep_versions прежних версий. settings —
+    параметры сессии, действующие во всех транзакциях шага. С plans_run_id
+    планы запросов шага сохраняются в pipeline_query_plans. Метрики шага
+    пишутся этапом mart:<шаг>, rows_in — строки базовых таблиц из inputs.
+    """
+    logger.info(f"Шаг {name} запущен" + 
+                (f" с параметрами {settings}." if settings else "."))
+    rows_in = None
+    if inputs is not None:
+        rows_in = sum(inputs[table][0] for table in step.get('reads', ())) or None
+    started = time.perf_counter()
+    try:
+        plans = capture_plans(plans_run_id, name) if plans_run_id else nullcontext()
+        with stage(f"mart:{name}", rows_in), session_profile(settings), plans:
+            _run_step_body(engine, step, snapshot_id, keep_versions)
+        if fingerprint is not None:
+            set_fingerprint(engine, name, fingerprint, inputs)
+    except Exception as e:
+        elapsed = time.perf_counter() - started
+        logger.error(f"Шаг {name} завершился ошибкой за {elapsed:.1f} с: {e}")
+        return False, elapsed
+    elapsed = time.perf_counter() - started
+    logger.info(f"Шаг {name} выполнен за {elapsed:.1f} с.")
+    return True, elapsed
+
+def run_steps(engine, 
+              steps, 
+              max_workers=4, 
+              stats=None, 
+              stored=None, 
+              force=False, 
+              snapshot_id=None, 
+              keep_versions=None, 
+              as_of=None, 
+              profiles=None, 
+              plans_run_id=None):
+    """Запускает шаги по графу зависимостей в пуле из max_workers потоков.
+
+    Шаг стартует, когда все его зависимости выполнены. Если зависимость
+    упала или была пропущена, шаг пропускается, остальные ветки графа
+    продолжают работу. Если передана статистика базовых таблиц stats,
+    шаги с неизменившимися входами (по сохранённым отпечаткам stored)
+    не пересчитываются. Возвращает {имя: (состояние, секунды)}, где
+    состояние — 'ok', 'unchanged', 'failed' или 'skipped'.
+
+    С snapshot_id шаги без зависимостей выполняются каждый в одной
+    транзакции, импортирующей этот снимок. С keep_versions полностью
+    пересобираемые витрины строятся в теневых таблицах. Период в отпечатках
+    берётся от as_of, поэтому расчёт на фиксированную дату не устаревает.
+    profiles — профили параметров сессии (см. load_session_profiles):
+    шаг получает профиль 'default', дополненный своим. С plans_run_id
+    запросы шагов выполняются под EXPLAIN ANALYZE (см. capture_plans).
+    """
+    unknown = {d for step in steps.values() for d in step['deps']} - set(steps)
+    if unknown:
+        raise ValueError(f"Неизвестные зависимости шагов: {', '.join(sorted(unknown))}")
+
+    stored = stored or {}
+    profiles = profiles or {}
+    today = as_of or date.today()
+    results = {}
+    fingerprints = {}
+    pending = dict(steps)
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while pending or running:
+            changed = True
+            while changed:
+                changed = False
+                for name, step in list(pending.items()):
+                    states = [results[d][0] for d in step['deps'] if d in results]
+                    if any(state not in ('ok', 'unchanged') for state in states):
+                        failed = [
+                            d for d in step['deps'] 
+                            if results.get(d, ('ok',))[0] not in ('ok', 'unchanged')
+                        ]
+                        logger.warning(f"Шаг {name} пропущен: не выполнены {', '.join(failed)}.")
+                        results[name] = ('skipped', 0.0)
+                        del pending[name]
+                        changed = True
+                        continue
+                    if len(states) < len(step['deps']):
+                        continue
+                    del pending[name]
+                    fingerprint = inputs = None
+                    if stats is not None:
+                        inputs = _step_inputs(step, stats, fingerprints, today)
+                        fingerprint = _fingerprint(inputs)
+                        fingerprints[name] = fingerprint
+                        if name not in stored:
+                            reason = "нет сохранённого отпечатка"
+                        elif force:
+                            reason = "принудительный пересчёт"
+                        elif stored[name][0] == fingerprint:
+                            logger.info(f"Шаг {name} пропущен: входные данные не изменились.")
+                            results[name] = ('unchanged', 0.0)
+                            changed = True
+                            continue
+                        else:
+                            reason = "изменились " + ", ".join(
+                                _changed_inputs(stored[name][1], inputs))
+                        logger.info(f"Шаг {name} пересчитывается: {reason}.")
+                    settings = {
+                        **profiles.get('default', {}), 
+                        **profiles.get(step.get('profile', name), {})
+                    }
+                    future = pool.submit(
+                        _run_step, engine, name, step, fingerprint, inputs, 
+                        snapshot_id, keep_versions, settings, plans_run_id)
+                    running[future] = name
+
+            if not running:
+                for name in pending:
+                    logger.error(f"Шаг {name} не запущен: цикл в зависимостях.")
+                    results[name] = ('skipped', 0.0)
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                ok, elapsed = future.result()
+                results[name] = ('ok' if ok else 'failed', elapsed)
+    return results
+
+def _run_marts(engine, 
+               config, 
+               horizon, 
+               snapshot_id=None, 
+               matviews=None, 
+               profiles=None, 
+               plans_run_id=None):
+    steps = build_steps(config, horizon, config['as_of'])
+    if matviews:
+        steps = matview_steps(steps, matviews)
+    pinned = nullcontext()
+    if snapshot_id is not None:
+        outside = sorted(
+            name for name, step in steps.items() if step.get('reads') and step.get('matview'))
+        if outside:
+            logger.warning(f"Шаги {', '.join(outside)} обновляют материализованные представления "
+                           f"вне снимка и могут увидеть строки, загруженные после его экспорта.")
+        with snapshot_transaction(engine, snapshot_id):
+            stats = table_stats(engine)
+        batches = {table: stats[table][2] for table in BASE_TABLES}
+        # Шаги вне транзакции снимка видят те же пачки загрузки, что и он.
+        pinned = pinned_views(engine, batches)
+    else:
+        stats = table_stats(engine)
+    with pinned as views:
+        if views:
+            steps = _pin_reads(steps, views)
+        return run_steps(
+            engine, 
+            steps, 
+            config['mart_workers'],
+            stats=stats,
+            stored=get_fingerprints(engine),
+            force=config['force_marts'],
+            snapshot_id=snapshot_id,
+            keep_versions=config['mart_keep_versions'] if config['mart_shadow'] else None,
+            as_of=config['as_of'],
+            profiles=profiles,
+            plans_run_id=plans_run_id
+        )
+
+def run_marts(engine, config, horizon=COHORT_HORIZON):
+    """Формирует витрины параллельно с учётом зависимостей.
+
+    Витрины, чьи входные данные не изменились с прошлого запуска,
+    пропускаются, если не задан FORCE_MARTS=1. С MART_SNAPSHOT=1 (по
+    умолчанию) все шаги видят базовые таблицы в одном состоянии, даже если
+    загрузка идёт параллельно: шаги без зависимостей — в транзакции
+    экспортированного снимка, остальные (cohort_metrics, cdr) — через
+    представления только с пачками загрузки, которые видел снимок.
+    С MART_BACKEND=matviews витрины
+    ведутся материализованными представлениями <витрина>_mv, которые
+    обновляются CONCURRENTLY и не блокируют чтение. AS_OF задаёт дату
+    расчёта витрин (по умолчанию — текущая). Параметры сессии шагов
+    (work_mem, jit и т. п.) берутся из MART_PROFILES и MART_PROFILE_<ШАГ>.
+    С QUERY_PLANS=1 планы всех запросов шагов с временем, буферами
+    и сбросом на диск сохраняются в pipeline_query_plans.
+    """
+    profiles = load_session_profiles(config['mart_profiles'])
+    # Общие служебные таблицы создаются заранее, чтобы потоки не гонялись за CREATE TABLE.
+    create_watermarks_table(engine)
+    create_cohort_changes_table(engine)
+    create_fingerprints_table(engine)
+    ensure_load_batch_columns(engine)
+    plans_run_id = None
+    if config['query_plans']:
+        create_query_plans_table(engine)
+        plans_run_id = current_run_id() or datetime.now().strftime('%Y%m%d%H%M%S')
+        logger.info(f"Планы запросов сохраняются в pipeline_query_plans, запуск {plans_run_id}.")
+    matviews = None
+    if config['mart_backend'] == 'matviews':
+        if config['as_of'] is not None:
+            logger.warning("Материализованные представления считаются на текущую дату, "
+                           "AS_OF к ним не применяется.")
+        matviews = create_matviews(engine, config, horizon)
+
+    started = time.perf_counter()
+    if config['mart_snapshot']:
+        with exported_snapshot(engine) as snapshot_id:
+            results = _run_marts(
+                engine, config, horizon, snapshot_id, matviews, profiles, plans_run_id)
+    else:
+        results = _run_marts(
+            engine, config, horizon, matviews=matviews, profiles=profiles, 
+            plans_run_id=plans_run_id)
+    elapsed = time.perf_counter() - started
+
+    logger.info("Время выполнения шагов:")
+    for name, (state, seconds) in sorted(results.items(), key=lambda item: -item[1][1]):
+        logger.info(f"  {name}: {state}, {seconds:.1f} с")
+    failed = [name for name, (state, _) in results.items() if state in ('failed', 'skipped')]
+    if failed:
+        logger.warning(f"Витрины сформированы за {elapsed:.1f} с, "
+                       f"не выполнены: {', '.join(sorted(failed))}.")
+    else:
+        logger.info(f"Все витрины сформированы за {elapsed:.1f} с.")
+    return results
+
+def _month_ends(start, end):
+    """Возвращает последние дни месяцев с start по end; последний — сам end."""
+    dates = []
+    year, month = start.year, start.month
+    while (year, month) <= (end.year, end.month):
+        last_day = date(year, month, calendar.monthrange(year, month)[1])
+        dates.append(min(last_day, end))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return dates
+
+def backfill_cohort_metrics(engine, 
+                            start, 
+                            end, 
+                            horizon=COHORT_HORIZON, 
+                            max_workers=4, 
+                            output_table='cohort_metrics_history', 
+                            profiles=None):
+    """Пересчитывает cohort_metrics на конец каждого месяца с start по end.
+
+    Расчёты на разные даты as_of независимы и идут параллельно в пуле
+    из max_workers потоков; результаты хранятся в output_table с ключом
+    (as_of, cohort_month, month). Каждый расчёт получает профиль
+    параметров сессии cohort_metrics. Возвращает {as_of: (успех, секунды)}.
+    """
+    create_cohort_metrics_table(engine, output_table, keep_snapshots=True)
+    dates = _month_ends(start, end)
+    steps = {
+        f"{output_table}_{as_of.isoformat()}": {
+            'run': partial(
+                calculate_cohort_metrics,
+                output_table=output_table,
+                horizon=horizon,
+                as_of=as_of,
+                keep_snapshots=True
+            ),
+            'deps': (),
+            'profile': 'cohort_metrics',
+        }
+        for as_of in dates
+    }
+    results = run_steps(engine, steps, max_workers, profiles=profiles)
+    return {
+        as_of: (state == 'ok', seconds)
+        for as_of, (state, seconds) in zip(dates, (results[name] for name in steps))
+    }
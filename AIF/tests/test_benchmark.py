@@ -0,0 +1,72 @@
+from datetime import date
+import pandas as pd
+import pytest
+
+# benchmark импортирует config, которому нужны python-dotenv и настройки окружения.
+benchmark = pytest.importorskip('benchmark')
+
+END = date(2024, 1, 1)
+
+def _generate(tmp_path, monkeypatch, rows=500, events_per_order=3):
+    # Маленькие чанки и файлы событий, чтобы проверить склейку и нарезку.
+    monkeypatch.setattr(benchmark, 'GENERATE_CHUNK_ROWS', 200)
+    monkeypatch.setattr(benchmark, 'EVENTS_FILE_ROWS', 600)
+    return benchmark.generate_dataset(
+        str(tmp_path), rows, events_per_order=events_per_order, months=6, end=END)
+
+def _read(path):
+    return pd.read_csv(path, sep=';')
+
+def test_parse_rows():
+    assert benchmark.parse_rows('100k') == 100_000
+    assert benchmark.parse_rows('2.5M') == 2_500_000
+    assert benchmark.parse_rows('1500') == 1500
+
+def test_generates_mindbox_export(tmp_path, monkeypatch):
+    _generate(tmp_path, monkeypatch)
+
+    orders = _read(tmp_path / 'orders.csv')
+    assert list(orders.columns) == [
+        'OrderIdsMindboxId', 'OrderCustomerIdsMindboxId', 'OrderFirstActionIdsMindboxId',
+        'OrderFirstActionDateTimeUtc', 'OrderTotalPrice', 'OrderLineStatusIdsExternalId',
+    ]
+    assert len(orders) == 500
+    assert orders['OrderIdsMindboxId'].is_unique
+    assert set(orders['OrderLineStatusIdsExternalId']) <= set(benchmark.STATUSES)
+    dates = pd.to_datetime(orders['OrderFirstActionDateTimeUtc'], format=benchmark.DATE_FORMAT)
+    assert dates.min() >= pd.Timestamp(END) - pd.DateOffset(months=6)
+    assert dates.max() < pd.Timestamp(END)
+
+    parts = sorted(tmp_path.glob('events_*.csv'))
+    assert [p.name for p in parts] == ['events_001.csv', 'events_002.csv', 'events_003.csv']
+    events = pd.concat(_read(p) for p in parts)
+    assert len(events) == 1500
+    assert events['CustomerActionIdsMindboxId'].is_unique
+    # Все покупатели встречаются среди клиентов с событиями.
+    assert orders['OrderCustomerIdsMindboxId'].max() < (
+        benchmark.CUSTOMER_ID_BASE + 500 // benchmark.ORDERS_PER_CUSTOMER)
+
+def test_same_seed_is_reproducible_and_reused(tmp_path, monkeypatch):
+    first, second = tmp_path / 'a', tmp_path / 'b'
+    _generate(first, monkeypatch)
+    _generate(second, monkeypatch)
+    assert (first / 'orders.csv').read_bytes() == (second / 'orders.csv').read_bytes()
+
+    # Набор с теми же параметрами не перегенерируется.
+    (first / 'orders.csv').write_text('marker')
+    _generate(first, monkeypatch)
+    assert (first / 'orders.csv').read_text() == 'marker'
+
+    # Другие параметры — набор пересоздаётся, лишние файлы событий удаляются.
+    _generate(first, monkeypatch, rows=100, events_per_order=1)
+    assert len(_read(first / 'orders.csv')) == 100
+    assert [p.name for p in first.glob('events_*.csv')] == ['events_001.csv']
+
+def test_compare_flags_only_slow_long_stages():
+    def report(**stages):
+        return {'scales': {'100k': {'stages': {
+            name: {'wall_seconds': seconds} for name, seconds in stages.items()}}}}
+
+    baseline = report(load=10.0, parse=0.2, marts=5.0)
+    current = report(load=12.0, parse=0.5, marts=5.2, extra=1.0)
+    assert benchmark.compare(current, baseline, threshold=10.0) == [('100k', 'load', 10.0, 12.0)]
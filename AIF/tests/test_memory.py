@@ -0,0 +1,87 @@
+import pandas as pd
+import pytest
+import memory
+import utils
+from memory import MB, MIN_CHUNK_ROWS, MAX_CHUNK_ROWS, WORKING_FACTOR
+
+@pytest.fixture
+def rss(monkeypatch):
+    """Подменяет текущий RSS процесса, чтобы расчёт не зависел от теста."""
+    state = {'mb': 100.0}
+    monkeypatch.setattr(memory, 'current_rss_mb', lambda: state['mb'])
+    return state
+
+def write_csv(path, rows, tail=""):
+    with open(path, 'w') as f:
+        f.write("OrderIdsMindboxId;OrderTotalPrice;OrderLineStatusIdsExternalId\n")
+        for i in range(rows):
+            f.write(f"{i};{i}.5;Paid\n")
+        f.write(tail)
+    return path
+
+def test_chunk_rows_fill_available_budget(rss):
+    # 400 МБ свободно, по 100 байт на строку с запасом WORKING_FACTOR.
+    expected = int(400 * MB / (100 * WORKING_FACTOR))
+    assert memory._chunk_rows(100, 500) == min(MAX_CHUNK_ROWS, expected)
+    assert memory._chunk_rows(10 ** 4, 500) == int(400 * MB / (10 ** 4 * WORKING_FACTOR))
+
+def test_chunk_rows_are_clamped(rss):
+    assert memory._chunk_rows(1, 500) == MAX_CHUNK_ROWS
+    assert memory._chunk_rows(10 ** 9, 500) == MIN_CHUNK_ROWS
+    rss['mb'] = 600
+    assert memory._chunk_rows(100, 500) == MIN_CHUNK_ROWS
+
+def test_frame_chunk_rows_uses_frame_size(rss):
+    assert memory.frame_chunk_rows(None, 500) is None
+    assert memory.frame_chunk_rows(pd.DataFrame({'a': []}), 500) is None
+    df = pd.DataFrame({'a': range(1000), 'b': ['x' * 50] * 1000})
+    row_bytes = df.memory_usage(deep=True, index=False).sum() / len(df)
+    assert memory.frame_chunk_rows(df, 500) == memory._chunk_rows(row_bytes, 500)
+
+def test_shrink_if_over_budget(rss):
+    assert memory.shrink_if_over_budget(8000, 500) == 8000
+    rss['mb'] = 600
+    assert memory.shrink_if_over_budget(8000, 500) == 4000
+    assert memory.shrink_if_over_budget(MIN_CHUNK_ROWS + 1, 500) == MIN_CHUNK_ROWS
+    assert memory.shrink_if_over_budget(MIN_CHUNK_ROWS, 500) == MIN_CHUNK_ROWS
+
+def test_fits_in_budget_and_file_chunk_rows(rss, tmp_path):
+    path = write_csv(tmp_path / 'orders.csv', 2000)
+    estimated = memory.estimate_frame_mb(path)
+    assert estimated > 0
+    assert memory.fits_in_budget([path], 100 + estimated * WORKING_FACTOR + 1)
+    assert not memory.fits_in_budget([path], 100 + estimated * WORKING_FACTOR / 2)
+    assert MIN_CHUNK_ROWS <= memory.file_chunk_rows(path, 500) <= MAX_CHUNK_ROWS
+
+def test_iter_datasets_keeps_dtypes_of_first_rows(rss, tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, 'file_chunk_rows', lambda file, budget_mb: 4000)
+    # Пропуск в id после пробной выборки не должен менять тип столбца между чанками.
+    write_csv(tmp_path / 'orders.csv', memory.SAMPLE_ROWS + 100, tail=";1.5;Paid\n")
+    chunks = list(utils.iter_datasets(tmp_path, 500))
+    assert sum(len(chunk) for _, chunk in chunks) == memory.SAMPLE_ROWS + 101
+    assert {str(chunk["OrderIdsMindboxId"].dtype) for _, chunk in chunks} == {'float64'}
+    assert {table for table, _ in chunks} == {'orders'}
+
+def test_iter_datasets_reads_late_fraction_in_integer_column(rss, tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, 'file_chunk_rows', lambda file, budget_mb: 4000)
+    path = tmp_path / 'orders.csv'
+    with open(path, 'w') as f:
+        f.write("OrderIdsMindboxId;OrderTotalPrice;OrderLineStatusIdsExternalId\n")
+        for i in range(memory.SAMPLE_ROWS + 2000):
+            f.write(f"{i};100;Paid\n")
+        f.write("-1;99.5;Paid\n")
+    chunks = [chunk for _, chunk in utils.iter_datasets(tmp_path, 500)]
+    prices = pd.concat(chunks)["OrderTotalPrice"]
+    assert len(prices) == memory.SAMPLE_ROWS + 2001
+    assert prices.iloc[-1] == 99.5
+    assert {str(chunk["OrderTotalPrice"].dtype) for chunk in chunks} == {'float64'}
+
+def test_iter_datasets_falls_back_on_type_conflict(rss, tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, 'file_chunk_rows', lambda file, budget_mb: 4000)
+    write_csv(tmp_path / 'orders.csv', memory.SAMPLE_ROWS + 100, tail="abc;1.5;Paid\n")
+    chunks = [chunk for _, chunk in utils.iter_datasets(tmp_path, 500)]
+    ids = pd.concat(chunks)["OrderIdsMindboxId"]
+    # Уже отданные чанки не повторяются, остаток дочитан без фиксированных типов.
+    assert len(ids) == memory.SAMPLE_ROWS + 101
+    assert list(ids.astype(str).iloc[-2:]) == [f"{memory.SAMPLE_ROWS + 99}", 'abc']
+    assert pd.to_numeric(ids.iloc[:-1]).is_unique
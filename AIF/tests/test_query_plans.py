@@ -0,0 +1,76 @@
+from database import _split_statements, _is_explainable, _plan_rows, _plan_summary
+
+def test_split_on_top_level_semicolons():
+    statements = _split_statements("""
+    DELETE FROM cdr WHERE month > DATE '2024-01-01';
+    INSERT INTO cdr SELECT 1;
+    """)
+    assert [s.strip() for s in statements] == [
+        "DELETE FROM cdr WHERE month > DATE '2024-01-01'",
+        "INSERT INTO cdr SELECT 1",
+    ]
+
+def test_split_ignores_semicolons_in_literals_and_comments():
+    query = """
+    SELECT ';' AS a, 'it''s; fine' AS b, "odd;name" FROM t; -- хвост; без оператора
+    DO $$
+    BEGIN
+        IF TRUE THEN PERFORM 1; END IF;
+    END $$;
+    DO $body$ BEGIN PERFORM 2; END $body$;
+    SELECT $1
+    """
+    statements = [s.strip() for s in _split_statements(query)]
+    assert len(statements) == 4
+    assert statements[0].startswith("SELECT ';'") and statements[0].endswith('FROM t')
+    assert statements[1].startswith("-- хвост") and statements[1].endswith("END $$")
+    assert statements[2] == "DO $body$ BEGIN PERFORM 2; END $body$"
+    assert statements[3] == "SELECT $1"
+
+def test_only_dml_is_explained():
+    assert _is_explainable("  -- комментарий\n  WITH x AS (SELECT 1) SELECT * FROM x")
+    assert _is_explainable("insert into t values (1)")
+    assert not _is_explainable("CREATE TABLE t (a INT)")
+    assert not _is_explainable("SET LOCAL work_mem = '64MB'")
+    assert not _is_explainable("-- только комментарий")
+
+PLAN = [{
+    'Planning Time': 0.5,
+    'Execution Time': 120.0,
+    'Plan': {
+        'Node Type': 'ModifyTable',
+        'Actual Rows': 0,
+        'Shared Hit Blocks': 10,
+        'Shared Read Blocks': 4,
+        'Temp Read Blocks': 7,
+        'Temp Written Blocks': 8,
+        'Plans': [{
+            'Node Type': 'Sort',
+            'Actual Rows': 42,
+            'Sort Space Type': 'Disk',
+            'Sort Space Used': 2048,
+            'Plans': [{'Node Type': 'Hash', 'Disk Usage': 512, 'Actual Rows': 42}],
+        }],
+    },
+}]
+
+def test_plan_rows_of_modify_table_come_from_its_input():
+    assert _plan_rows(PLAN) == 42
+    assert _plan_rows([{'Plan': {'Node Type': 'Seq Scan', 'Actual Rows': 5}}]) == 5
+
+def test_plan_summary_sums_spill_over_all_nodes():
+    assert _plan_summary(PLAN) == {
+        'planning_ms': 0.5,
+        'execution_ms': 120.0,
+        'actual_rows': 0,
+        'shared_hit_blocks': 10,
+        'shared_read_blocks': 4,
+        'temp_read_blocks': 7,
+        'temp_written_blocks': 8,
+        'spill_kb': 2560,
+    }
+
+def test_in_memory_sort_is_not_spill():
+    plan = [{'Plan': {
+        'Node Type': 'Sort', 'Sort Space Type': 'Memory', 'Sort Space Used': 100}}]
+    assert _plan_summary(plan)['spill_kb'] == 0
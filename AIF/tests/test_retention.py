@@ -0,0 +1,66 @@
+from datetime import date
+import pandas as pd
+import pytest
+import retention
+from retention import _bitmap, _merge_activity, retention_curve
+
+JAN, FEB, MAR, APR = date(2024, 1, 1), date(2024, 2, 1), date(2024, 3, 1), date(2024, 4, 1)
+
+@pytest.fixture(autouse=True, params=['roaring', 'int64'])
+def encoding(request, monkeypatch):
+    """Прогоняет тесты и на pyroaring, и на запасном варианте с массивами numpy."""
+    if request.param == 'int64':
+        monkeypatch.setattr(retention, 'RoaringBitmap', None)
+    elif retention.RoaringBitmap is None:
+        pytest.skip("pyroaring не установлен")
+    return request.param
+
+def activity(*pairs):
+    return pd.DataFrame(pairs, columns=['user_id', 'period_start'])
+
+def as_sets(bitmaps):
+    return {key: set(int(u) for u in users) for key, users in bitmaps.items()}
+
+def test_new_users_get_cohort_of_first_period():
+    bitmaps = {}
+    changed = _merge_activity(bitmaps, activity((1, JAN), (1, FEB), (2, FEB)))
+    assert as_sets(bitmaps) == {(JAN, JAN): {1}, (JAN, FEB): {1}, (FEB, FEB): {2}}
+    assert changed == [(JAN, JAN), (JAN, FEB), (FEB, FEB)]
+
+def test_known_users_keep_their_cohort():
+    bitmaps = {(JAN, JAN): _bitmap([1]), (FEB, FEB): _bitmap([2])}
+    changed = _merge_activity(bitmaps, activity((1, MAR), (2, MAR), (3, MAR)))
+    assert as_sets(bitmaps) == {
+        (JAN, JAN): {1}, (JAN, MAR): {1}, 
+        (FEB, FEB): {2}, (FEB, MAR): {2}, 
+        (MAR, MAR): {3},
+    }
+    assert changed == [(JAN, MAR), (FEB, MAR), (MAR, MAR)]
+
+def test_backfilled_period_moves_user_to_earlier_cohort():
+    bitmaps = {
+        (MAR, MAR): _bitmap([1, 2]),
+        (MAR, APR): _bitmap([1]),
+    }
+    changed = _merge_activity(bitmaps, activity((1, JAN)))
+    assert as_sets(bitmaps) == {
+        (JAN, JAN): {1},
+        (JAN, MAR): {1},
+        (JAN, APR): {1},
+        (MAR, MAR): {2},
+    }
+    # Опустевший битмап (MAR, APR) возвращается, чтобы его удалили из базы.
+    assert (MAR, APR) in changed and (MAR, APR) not in bitmaps
+    assert set(changed) == {(JAN, JAN), (JAN, MAR), (JAN, APR), (MAR, MAR), (MAR, APR)}
+
+def test_merge_matches_full_build():
+    history = activity((1, FEB), (1, MAR), (2, FEB), (3, MAR), (3, APR))
+    backfill = activity((2, JAN), (3, FEB), (4, JAN))
+    incremental = {}
+    _merge_activity(incremental, history)
+    _merge_activity(incremental, backfill)
+    full = {}
+    _merge_activity(full, pd.concat([history, backfill], ignore_index=True))
+    assert as_sets(incremental) == as_sets(full)
+    pd.testing.assert_frame_equal(
+        retention_curve(incremental, horizon=3), retention_curve(full, horizon=3))
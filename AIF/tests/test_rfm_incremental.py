@@ -0,0 +1,83 @@
+import os
+import pytest
+
+pytestmark = pytest.mark.skipif(
+    not os.environ.get('TEST_DATABASE_URL'), 
+    reason="нужна тестовая база Postgres в TEST_DATABASE_URL")
+
+ORDERS = 'test_rfm_inc_orders'
+OUTPUT = 'test_rfm_inc'
+THRESHOLDS = 'test_rfm_inc_thresholds'
+METRICS = 'test_rfm_inc_metrics'
+AGE_DAYS = 10
+
+@pytest.fixture
+def engine():
+    from sqlalchemy import create_engine
+
+    engine = create_engine(os.environ['TEST_DATABASE_URL'])
+    yield engine
+    with engine.begin() as conn:
+        for table in (ORDERS, OUTPUT, THRESHOLDS, METRICS):
+            conn.exec_driver_sql(f"DROP TABLE IF EXISTS {table}")
+        conn.exec_driver_sql(
+            f"DELETE FROM etl_watermarks WHERE name LIKE '{OUTPUT}%'")
+
+def _add_orders(conn, batch, rows):
+    """Добавляет оплаченные заказы (клиент, дней назад от CURRENT_DATE)."""
+    for customer, days_ago in rows:
+        conn.exec_driver_sql(f"""
+            INSERT INTO {ORDERS} VALUES (
+                {customer}, 
+                TO_CHAR(CURRENT_DATE - {days_ago}, 'DD.MM.YYYY HH24:MI'), 
+                100, 'Paid', {batch})""")
+
+def _run(engine):
+    from query import _rfm_incremental
+
+    _rfm_incremental(
+        engine, ORDERS, OUTPUT, THRESHOLDS, 'stddev', 
+        drift_tolerance=float('inf'), max_reference_age_days=30, 
+        date_format='DD.MM.YYYY HH24:MI', metrics_table=METRICS)
+
+def test_order_after_reference_date_is_scored_from_current_date(engine):
+    from query import create_rfm_tables
+
+    create_rfm_tables(engine, OUTPUT, THRESHOLDS)
+    with engine.begin() as conn:
+        conn.exec_driver_sql(f"""
+            CREATE TABLE {ORDERS} (
+                "OrderCustomerIdsMindboxId" BIGINT,
+                "OrderFirstActionDateTimeUtc" TEXT,
+                "OrderTotalPrice" DOUBLE PRECISION,
+                "OrderLineStatusIdsExternalId" TEXT,
+                load_batch BIGINT)""")
+        _add_orders(conn, 1, [(1, 30), (2, 40), (3, 60), (4, 150)])
+    _run(engine)
+
+    # Пороги посчитаны AGE_DAYS дней назад: та же картина давностей от старой даты.
+    with engine.begin() as conn:
+        conn.exec_driver_sql(f"""
+            UPDATE {THRESHOLDS} SET 
+                reference_date = reference_date - {AGE_DAYS},
+                recency_low = recency_low - {AGE_DAYS},
+                recency_mid = recency_mid - {AGE_DAYS},
+                recency_high = recency_high - {AGE_DAYS}""")
+        low, mid, high = conn.exec_driver_sql(
+            f"SELECT recency_low, recency_mid, recency_high FROM {THRESHOLDS}").one()
+        # Заказ сегодня — позже reference_date порогов.
+        _add_orders(conn, 2, [(1, 0)])
+    _run(engine)
+
+    with engine.connect() as conn:
+        rows = dict(conn.exec_driver_sql(
+            f"SELECT customer_id, recency_days FROM {OUTPUT}").all())
+        score = conn.exec_driver_sql(
+            f"SELECT recency_score FROM {OUTPUT} WHERE customer_id = 1").scalar()
+    assert rows[1] == 0
+    assert min(rows.values()) >= 0
+    expected = next(
+        (points for points, bound in zip((4, 3, 2), (low, mid, high)) 
+         if 0 <= bound + AGE_DAYS),
+        1)
+    assert score == expected
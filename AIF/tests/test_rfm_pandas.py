@@ -0,0 +1,115 @@
+import os
+from decimal import Decimal
+import pandas as pd
+import pytest
+from rfm_pandas import compute_rfm, rfm_analysis_pandas, _thresholds, _score
+
+REFERENCE_DATE = '2024-03-01'
+
+def make_orders():
+    """Небольшой набор заказов: у клиента 5 покупок ровно на границе mean + std."""
+    rows = [
+        (1, '01.01.2024 10:00', 100.1),
+        (1, '15.01.2024 10:00', 200.2),
+        (2, '20.02.2024 12:30', 0.1),
+        (2, '21.02.2024 12:30', 0.2),
+        (3, '10.12.2023 09:00', 500.0),
+        (4, '28.02.2024 18:45', 50.0),
+        (5, '01.02.2024 08:00', 10.0),
+        (5, '02.02.2024 08:00', 10.0),
+        (5, '03.02.2024 08:00', 10.0),
+        (5, '04.02.2024 08:00', 10.0),
+        (5, '05.02.2024 08:00', 10.0),
+        (6, '29.02.2024 23:00', 75.5),
+        (6, '01.03.2024 10:00', 1.0),
+    ]
+    orders = pd.DataFrame(rows, columns=[
+        "OrderCustomerIdsMindboxId", "OrderFirstActionDateTimeUtc", "OrderTotalPrice"])
+    orders["OrderLineStatusIdsExternalId"] = 'Paid'
+    return orders
+
+def test_stddev_thresholds_are_exact():
+    low, mid, high = _thresholds([1, 1, 1, 5], 'stddev')
+    assert (low, mid, high) == (Decimal(0), Decimal(2), Decimal(4))
+    # На float mean + std давало 3.9999999999999996, и 5 покупок получали 3 балла.
+    assert list(_score([5, 1], low, mid, high, ascending=False)) == [4, 2]
+
+def test_stddev_of_single_value_gives_null_bounds():
+    assert _thresholds([7], 'stddev') == (None, Decimal(7), None)
+    assert list(_score([7], None, Decimal(7), None, ascending=True)) == [3]
+
+def test_monetary_bounds_compare_in_cents():
+    # Суммы 0.30 и 0.31 руб., порог ровно 0.3: 30 копеек проходят >=, как NUMERIC.
+    low, mid, high = _thresholds([30, 30, 30, 31], 'quantile', scale=100)
+    assert (low, mid, high) == (Decimal('0.3'), Decimal('0.3'), Decimal('0.3025'))
+    assert list(_score([30, 31, None], low, mid, high, ascending=False, scale=100)) == [3, 4, 1]
+
+def test_customer_without_prices_has_null_monetary():
+    orders = make_orders()
+    orders.loc[orders["OrderCustomerIdsMindboxId"] == 4, "OrderTotalPrice"] = None
+    rfm, thresholds = compute_rfm(orders, REFERENCE_DATE, 'stddev')
+    rfm = rfm.set_index('customer_id')
+    assert pd.isna(rfm.loc[4, 'monetary'])
+    assert rfm.loc[4, 'monetary_score'] == 1
+
+def test_quantile_thresholds_match_percentile_cont():
+    values = [1, 2, 3, 4, 10]
+    expected = pd.Series(values).quantile([0.25, 0.5, 0.75]).tolist()
+    assert [float(v) for v in _thresholds(values, 'quantile')] == expected
+
+def test_unknown_scoring_is_rejected():
+    with pytest.raises(ValueError):
+        _thresholds([1, 2], 'median')
+
+def test_compute_rfm_scores_fixture():
+    rfm, thresholds = compute_rfm(make_orders(), REFERENCE_DATE, 'stddev')
+    rfm = rfm.set_index('customer_id')
+
+    assert thresholds['customers'] == 6
+    assert thresholds['reference_date'].isoformat() == REFERENCE_DATE
+    # Суммы считаются точно в копейках: 0.1 + 0.2 == 0.3, как SUM по NUMERIC.
+    assert str(rfm.loc[2, 'monetary']) == '0.3'
+    assert str(rfm.loc[1, 'monetary']) == '300.3'
+    assert rfm.loc[6, 'recency_days'] == 0
+    assert rfm.loc[3, 'recency_days'] == 81
+    assert rfm.loc[5, 'frequency_score'] == 4
+    assert rfm.loc[3, 'recency_score'] == 1
+    assert (rfm['rfm_group'] == (
+        rfm['recency_score'].astype(str) 
+        + rfm['frequency_score'].astype(str) 
+        + rfm['monetary_score'].astype(str))).all()
+    assert abs(sum(rfm.groupby('rfm_group')['percent_rfm'].first()) - 100) < Decimal('0.1')
+
+def test_compute_rfm_ignores_orders_after_reference_date():
+    rfm, thresholds = compute_rfm(make_orders(), '2024-02-28', 'quantile')
+    assert 6 not in set(rfm['customer_id'])
+    assert thresholds['customers'] == 5
+
+@pytest.mark.skipif(
+    not os.environ.get('TEST_DATABASE_URL'), 
+    reason="нужна тестовая база Postgres в TEST_DATABASE_URL")
+@pytest.mark.parametrize('scoring', ['stddev', 'quantile'])
+def test_pandas_matches_sql(scoring):
+    from sqlalchemy import create_engine
+    from query import rfm_analysis
+
+    engine = create_engine(os.environ['TEST_DATABASE_URL'])
+    orders = make_orders()
+    with engine.begin() as conn:
+        orders.to_sql('test_rfm_orders', conn, if_exists='replace', index=False)
+    try:
+        rfm_analysis(
+            engine, 'test_rfm_orders', 'test_rfm_sql', 'test_rfm_thresholds_sql', 
+            scoring=scoring, as_of=REFERENCE_DATE)
+        rfm_analysis_pandas(
+            engine, None, 'test_rfm_orders', 'test_rfm_pandas', 'test_rfm_thresholds_pandas', 
+            'test_rfm_stage', scoring=scoring, reference_date=REFERENCE_DATE)
+        with engine.connect() as conn:
+            sql = pd.read_sql("SELECT * FROM test_rfm_sql ORDER BY customer_id", conn)
+            in_memory = pd.read_sql("SELECT * FROM test_rfm_pandas ORDER BY customer_id", conn)
+        pd.testing.assert_frame_equal(sql, in_memory)
+    finally:
+        with engine.begin() as conn:
+            for table in ('test_rfm_orders', 'test_rfm_sql', 'test_rfm_pandas', 
+                          'test_rfm_thresholds_sql', 'test_rfm_thresholds_pandas'):
+                conn.exec_driver_sql(f"DROP TABLE IF EXISTS {table}")
@@ -0,0 +1,164 @@
+import threading
+from datetime import date
+import pytest
+import scheduler
+from scheduler import run_steps
+
+ENGINE = object()
+
+class Recorder:
+    """Собирает шаги: run пишет порядок запуска, failing падает."""
+
+    def __init__(self):
+        self.order = []
+        self.lock = threading.Lock()
+
+    def step(self, name, deps=(), failing=False, **extra):
+        def run(engine):
+            with self.lock:
+                self.order.append(name)
+            if failing:
+                raise RuntimeError(f"{name} упал")
+        return {'run': run, 'deps': deps, **extra}
+
+def states(results):
+    return {name: state for name, (state, _) in results.items()}
+
+def test_steps_run_after_their_dependencies():
+    r = Recorder()
+    steps = {
+        'cohorts': r.step('cohorts'),
+        'metrics': r.step('metrics', ('cohorts',)),
+        'ltv': r.step('ltv', ('metrics',)),
+        'rfm': r.step('rfm'),
+        'ltv_t': r.step('ltv_t', ('ltv', 'rfm')),
+    }
+    results = run_steps(ENGINE, steps, max_workers=3)
+    assert set(states(results).values()) == {'ok'}
+    for name, step in steps.items():
+        for dep in step['deps']:
+            assert r.order.index(dep) < r.order.index(name)
+
+def test_failure_skips_dependents_only():
+    r = Recorder()
+    steps = {
+        'cohorts': r.step('cohorts', failing=True),
+        'metrics': r.step('metrics', ('cohorts',)),
+        'ltv': r.step('ltv', ('metrics',)),
+        'rfm': r.step('rfm'),
+    }
+    assert states(run_steps(ENGINE, steps)) == {
+        'cohorts': 'failed', 'metrics': 'skipped', 'ltv': 'skipped', 'rfm': 'ok'}
+    assert 'metrics' not in r.order and 'ltv' not in r.order
+
+def test_unknown_dependency_is_rejected():
+    r = Recorder()
+    with pytest.raises(ValueError):
+        run_steps(ENGINE, {'ltv': r.step('ltv', ('metrics',))})
+
+def test_cycle_is_skipped():
+    r = Recorder()
+    steps = {
+        'a': r.step('a', ('b',)),
+        'b': r.step('b', ('a',)),
+        'c': r.step('c'),
+    }
+    assert states(run_steps(ENGINE, steps)) == {'a': 'skipped', 'b': 'skipped', 'c': 'ok'}
+
+@pytest.fixture
+def stored(monkeypatch):
+    """Подменяет запись отпечатков в базу словарём {шаг: (отпечаток, входы)}."""
+    saved = {}
+    monkeypatch.setattr(
+        scheduler, 'set_fingerprint', 
+        lambda engine, name, fingerprint, inputs: saved.update({name: (fingerprint, inputs)}))
+    return saved
+
+def fingerprint_steps(r):
+    return {
+        'cohorts_all': r.step('cohorts_all', reads=('events',)),
+        'cohorts_paid': r.step('cohorts_paid', reads=('orders',)),
+        'metrics': r.step(
+            'metrics', ('cohorts_all', 'cohorts_paid'), reads=('orders',), period='month'),
+        'rfm': r.step('rfm', reads=('orders',), period='day'),
+    }
+
+STATS = {'orders': [100, 100, 1], 'events': [500, 500, 1]}
+
+def test_unchanged_inputs_are_skipped(stored):
+    run_steps(ENGINE, fingerprint_steps(Recorder()), stats=STATS, stored={}, 
+              as_of=date(2024, 3, 15))
+    r = Recorder()
+    results = run_steps(ENGINE, fingerprint_steps(r), stats=STATS, stored=dict(stored), 
+                        as_of=date(2024, 3, 20))
+    # Месячный шаг в том же месяце не пересчитывается, дневной — пересчитывается.
+    assert states(results) == {
+        'cohorts_all': 'unchanged', 'cohorts_paid': 'unchanged', 
+        'metrics': 'unchanged', 'rfm': 'ok'}
+    assert r.order == ['rfm']
+
+def test_changed_table_reruns_readers_and_dependents(stored):
+    as_of = date(2024, 3, 15)
+    run_steps(ENGINE, fingerprint_steps(Recorder()), stats=STATS, stored={}, as_of=as_of)
+    r = Recorder()
+    stats = {**STATS, 'events': [600, 600, 2]}
+    results = run_steps(ENGINE, fingerprint_steps(r), stats=stats, stored=dict(stored), 
+                        as_of=as_of)
+    assert states(results) == {
+        'cohorts_all': 'ok', 'cohorts_paid': 'unchanged', 
+        'metrics': 'ok', 'rfm': 'unchanged'}
+    assert stored['metrics'][1]['cohorts_all'] == stored['cohorts_all'][0]
+
+def test_new_load_batch_reruns_readers(stored):
+    as_of = date(2024, 3, 15)
+    run_steps(ENGINE, fingerprint_steps(Recorder()), stats=STATS, stored={}, as_of=as_of)
+    r = Recorder()
+    # Перезаписанные заказы: число строк и максимальный id те же, пачка новая.
+    stats = {**STATS, 'orders': [100, 100, 2]}
+    results = run_steps(ENGINE, fingerprint_steps(r), stats=stats, stored=dict(stored), 
+                        as_of=as_of)
+    assert states(results) == {
+        'cohorts_all': 'unchanged', 'cohorts_paid': 'ok', 'metrics': 'ok', 'rfm': 'ok'}
+
+def test_force_reruns_everything(stored):
+    as_of = date(2024, 3, 15)
+    run_steps(ENGINE, fingerprint_steps(Recorder()), stats=STATS, stored={}, as_of=as_of)
+    r = Recorder()
+    run_steps(ENGINE, fingerprint_steps(r), stats=STATS, stored=dict(stored), 
+              force=True, as_of=as_of)
+    assert sorted(r.order) == ['cohorts_all', 'cohorts_paid', 'metrics', 'rfm']
+
+def test_failed_step_keeps_old_fingerprint(stored):
+    r = Recorder()
+    steps = fingerprint_steps(r)
+    steps['rfm'] = r.step('rfm', reads=('orders',), failing=True)
+    run_steps(ENGINE, steps, stats=STATS, stored={}, as_of=date(2024, 3, 15))
+    assert 'rfm' not in stored
+
+def test_steps_outside_snapshot_read_pinned_views():
+    calls = {}
+
+    def step(name, deps=(), **extra):
+        def run(engine, input_table=None):
+            calls[name] = input_table
+        return {'run': run, 'deps': deps, **extra}
+
+    steps = {
+        'cohorts_paid': step('cohorts_paid', reads=('orders',)),
+        'rr_bitmaps': step('rr_bitmaps', reads=('orders',), snapshot=False),
+        'cohort_metrics': step('cohort_metrics', ('cohorts_paid',), reads=('orders',)),
+        'cohorts_all': step('cohorts_all', reads=('events',)),
+        'ltv': step('ltv', ('cohort_metrics',)),
+    }
+    pinned = scheduler._pin_reads(steps, {'orders': 'orders_pinned', 'events': 'events_pinned'})
+    for name, pinned_step in pinned.items():
+        pinned_step['run'](ENGINE)
+    assert calls == {
+        # Шаги в транзакции снимка и шаги без базовых таблиц читают как раньше.
+        'cohorts_paid': None,
+        'cohorts_all': None,
+        'ltv': None,
+        'rr_bitmaps': 'orders_pinned',
+        'cohort_metrics': 'orders_pinned',
+    }
+    assert steps['cohort_metrics']['run'] is not pinned['cohort_metrics']['run']
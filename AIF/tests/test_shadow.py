@@ -0,0 +1,64 @@
+import os
+import time
+import pytest
+from database import _pair_indexes
+
+def test_indexes_are_paired_by_definition():
+    indexes = [
+        ('rfm_pkey', 'CREATE UNIQUE INDEX rfm_pkey ON public.rfm USING btree (customer_id)'),
+        ('idx_rfm_group', 'CREATE INDEX idx_rfm_group ON public.rfm USING btree (rfm_group)'),
+        ('idx_rfm_cats', 'CREATE INDEX idx_rfm_cats ON public.rfm USING btree (cats)'),
+        ('same_name', 'CREATE INDEX same_name ON public.rfm USING btree (frequency)'),
+    ]
+    shadow_indexes = [
+        ('rfm__shadow_cats_idx', 
+         'CREATE INDEX rfm__shadow_cats_idx ON public.rfm__shadow USING btree (cats)'),
+        ('rfm__shadow_pkey', 
+         'CREATE UNIQUE INDEX rfm__shadow_pkey ON public.rfm__shadow USING btree (customer_id)'),
+        ('rfm__shadow_rfm_group_idx1', 
+         'CREATE INDEX rfm__shadow_rfm_group_idx1 ON public.rfm__shadow USING btree (rfm_group)'),
+        ('same_name', 'CREATE INDEX same_name ON public.rfm__shadow USING btree (frequency)'),
+    ]
+    assert _pair_indexes(indexes, shadow_indexes) == [
+        ('rfm_pkey', 'rfm__shadow_pkey'),
+        ('idx_rfm_group', 'rfm__shadow_rfm_group_idx1'),
+        ('idx_rfm_cats', 'rfm__shadow_cats_idx'),
+    ]
+
+def test_unique_and_plain_indexes_are_not_mixed():
+    indexes = [('u', 'CREATE UNIQUE INDEX u ON t USING btree (a)')]
+    shadow_indexes = [('t__shadow_a_idx', 'CREATE INDEX t__shadow_a_idx ON t__shadow USING btree (a)')]
+    assert _pair_indexes(indexes, shadow_indexes) == []
+
+@pytest.mark.skipif(
+    not os.environ.get('TEST_DATABASE_URL'), 
+    reason="нужна тестовая база Postgres в TEST_DATABASE_URL")
+def test_index_names_survive_repeated_swaps():
+    from sqlalchemy import create_engine
+    from database import shadow_build, _table_indexes, _table_versions
+
+    engine = create_engine(os.environ['TEST_DATABASE_URL'])
+    table = 'test_shadow_mart'
+
+    def build(target):
+        with engine.begin() as conn:
+            conn.exec_driver_sql(f"""
+                CREATE TABLE IF NOT EXISTS {target} (id BIGINT PRIMARY KEY, grp TEXT);
+                INSERT INTO {target} VALUES (1, 'a'), (2, 'b') 
+                ON CONFLICT (id) DO NOTHING;""")
+
+    try:
+        build(table)
+        with engine.begin() as conn:
+            conn.exec_driver_sql(f"CREATE INDEX idx_test_shadow_grp ON {table} (grp)")
+        names = sorted(name for name, _ in _table_indexes(engine, table))
+        for _ in range(2):
+            # Версии называются по времени с точностью до секунды.
+            time.sleep(1.1)
+            shadow_build(engine, table, build, keep_versions=1)
+            assert sorted(name for name, _ in _table_indexes(engine, table)) == names
+    finally:
+        with engine.begin() as conn:
+            for version in _table_versions(engine, table):
+                conn.exec_driver_sql(f"DROP TABLE IF EXISTS {version}")
+            conn.exec_driver_sql(f"DROP TABLE IF EXISTS {table}")
@@ -6,6 +6,7 @@ import requests
 import pandas as pd
 from tqdm import tqdm
 from pathlib import Path
+from memory import SAMPLE_ROWS, file_chunk_rows, shrink_if_over_budget
 
 logger = logging.getLogger()
 
@@ -18,7 +19,8 @@ def calculate_file_hash(file_path):
     return md5_hash.hexdigest()
 
 def download_file(y, file, file_path):
-    """Качает файлы с Яндекс Диска."""
+    """Качает файлы с Яндекс Диска и возвращает число скачанных байт."""
+    downloaded = 0
     try:
         download_link = y.get_download_link(file)
         response = requests.get(download_link, stream=True)
@@ -33,9 +35,11 @@ def download_file(y, file, file_path):
                     if chunk:
                         f.write(chunk)
                         pbar.update(len(chunk))
+                        downloaded += len(chunk)
     except Exception as e:
         logger.error(f"Ошибка при скачивании файла {file}: {str(e)}")
         terminate_script()
+    return downloaded
 
 def read_csv_file(file_path):
     """Читает CSV файлы."""
@@ -78,6 +82,88 @@ def create_datasets(local_path):
         logger.info(f"Количество строк в заказах: {len(new_orders_data)}")
 
     return new_orders_data, new_events_data
+
+def _stable_dtypes(file_path, sample_rows=SAMPLE_ROWS):
+    """Выводит типы столбцов по первым строкам файла для чтения по частям.
+
+    Без явных типов pandas выводит их в каждом чанке заново, и столбец
+    мог стать int в одном чанке и float или строкой в другом. Числовые
+    столбцы читаются как float64: пропуск или дробное значение дальше
+    по файлу не ломают чтение, а типы совпадают с чтением файла целиком.
+    """
+    sample = pd.read_csv(
+        file_path, sep=';', low_memory=False, on_bad_lines='skip', nrows=sample_rows)
+    dtypes = {}
+    for column, dtype in sample.dtypes.items():
+        if sample[column].isna().all():
+            dtypes[column] = 'object'
+        elif pd.api.types.is_bool_dtype(dtype):
+            dtypes[column] = 'boolean'
+        elif pd.api.types.is_numeric_dtype(dtype):
+            dtypes[column] = 'float64'
+        else:
+            dtypes[column] = dtype
+    return dtypes
+
+def _read_chunks(file, rows, budget_mb, dtype=None, skip=0):
+    """Читает файл чанками по rows строк, пропуская первые skip записей.
+
+    Размер чанка уменьшается, если RSS выходит за бюджет.
+    """
+    with pd.read_csv(
+        file,
+        sep=';',
+        low_memory=False,
+        on_bad_lines='skip',
+        dtype=dtype,
+        chunksize=rows
+    ) as reader:
+        while True:
+            try:
+                chunk = reader.get_chunk(rows)
+            except StopIteration:
+                break
+            if skip:
+                dropped = min(skip, len(chunk))
+                skip -= dropped
+                chunk = chunk.iloc[dropped:]
+            if len(chunk):
+                yield chunk
+            del chunk
+            rows = shrink_if_over_budget(rows, budget_mb)
+
+def iter_datasets(local_path, budget_mb):
+    """Читает файлы по частям под бюджет памяти.
+
+    Отдаёт пары (таблица, чанк). Размер чанка подбирается по пробной
+    выборке. Типы столбцов фиксируются по первым строкам файла; если
+    дальше по файлу значение в них не укладывается, остаток файла
+    дочитывается без фиксированных типов. Ошибка разбора CSV
+    пробрасывается, чтобы загрузка откатилась целиком.
+    """
+    for file in Path(local_path).glob("*.csv"):
+        table = 'orders' if file.name == 'orders.csv' else 'events'
+        rows = file_chunk_rows(file, budget_mb)
+        total = 0
+        try:
+            try:
+                for chunk in _read_chunks(file, rows, budget_mb, _stable_dtypes(file)):
+                    total += len(chunk)
+                    yield table, chunk
+            except pd.errors.ParserError:
+                raise
+            except (ValueError, TypeError) as e:
+                logger.warning(
+                    f"Типы столбцов {file.name} не совпали с первыми строками после "
+                    f"{total} записей ({e}). Дочитываем файл без фиксированных типов."
+                )
+                for chunk in _read_chunks(file, rows, budget_mb, skip=total):
+                    total += len(chunk)
+                    yield table, chunk
+        except pd.errors.ParserError as e:
+            logger.error(f"Ошибка при чтении {file} после {total} записей: {e}")
+            raise
+        logger.info(f"Обработаны данные из {file.name} - {total} записей")
         
 def clean_local_files(list_of_files, local_path):
     """Удаляет скачанные файлы с локального диска после обработки."""